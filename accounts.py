@@ -0,0 +1,197 @@
+"""Deleting accounts.
+
+Deleting a user through the ORM loads every message, like and follow they
+have and deletes them one row at a time, so big accounts took minutes and
+held their locks the whole time. delete_account() works in set-based
+chunks instead:
+
+- the user's messages, ACCOUNT_DELETE_CHUNK_SIZE at a time: one UPDATE
+  takes the likes on them off their likers' counters, then one DELETE
+  removes them, and the foreign keys cascade to the likes and the timeline
+  entries pointing at them;
+- then the follows in both directions and the user's own likes, in the
+  same way, adjusting the other side's counters as it goes;
+- then the user's home timeline, and finally the user row.
+
+Each chunk is its own transaction, so other requests are never blocked for
+long and the counters are right after every commit. If a deletion dies
+half-way, running it again picks up where it left off.
+
+Accounts with more than ACCOUNT_DELETE_SYNC_LIMIT rows to delete (going by
+their counters) are deleted by a background job (see jobs.py); the account
+is still there, shrinking, until the job is done. Progress goes to the log.
+"""
+
+from flask import current_app
+from sqlalchemy import func, select
+
+import search
+from fragments import fragment_cache
+from jobs import enqueue, job
+from models import db, Follows, Likes, Message, TimelineEntry, User
+
+users = User.__table__
+messages = Message.__table__
+follows = Follows.__table__
+likes = Likes.__table__
+timeline_entries = TimelineEntry.__table__
+
+
+def account_size(user):
+    """Rows deleting `user` has to remove, roughly: what progress counts."""
+
+    return (user.message_count + user.following_count
+            + user.follower_count + user.like_count)
+
+
+def _ids(column, criterion, chunk_size):
+    """The next `chunk_size` values of `column` for rows matching `criterion`."""
+
+    query = select([column]).where(criterion).order_by(column).limit(chunk_size)
+    return [value for (value,) in db.session.execute(query)]
+
+
+def _decrement(counter, user_ids, by=1):
+    db.session.execute(users.update()
+                       .where(users.c.id.in_(user_ids))
+                       .values({counter: users.c[counter] - by}))
+
+
+def delete_account(user_id, chunk_size=500, progress=None, forget_users=None):
+    """Delete user `user_id` and everything of theirs; see the module docs.
+
+    Calls `progress(done, total)` after each chunk, and
+    `forget_users(*user_ids)` with the users whose rows it changed, so the
+    caller can drop them from its caches. Commits as it goes.
+    """
+
+    user = db.session.query(User).get(user_id)
+    if user is None:
+        return
+    total = account_size(user)
+    done = 0
+
+    def chunk_done(count, changed_user_ids=()):
+        nonlocal done
+        db.session.commit()
+        done += count
+        if forget_users is not None:
+            forget_users(user_id, *changed_user_ids)
+        if progress is not None:
+            progress(min(done, total), total)
+
+    # messages, and the likes on them
+    while True:
+        message_ids = _ids(messages.c.id, messages.c.user_id == user_id, chunk_size)
+        if not message_ids:
+            break
+
+        on_these = likes.c.message_id.in_(message_ids)
+        likers = [liker for (liker,) in
+                  db.session.execute(select([likes.c.user_id]).where(on_these).distinct())]
+        liked_here = (select([func.count(likes.c.id)])
+                      .where(on_these)
+                      .where(likes.c.user_id == users.c.id)
+                      .as_scalar())
+        if likers:
+            _decrement('like_count', likers, by=liked_here)
+        db.session.execute(messages.delete().where(messages.c.id.in_(message_ids)))
+        _decrement('message_count', [user_id], by=len(message_ids))
+        chunk_done(len(message_ids), likers)
+        fragment_cache.forget_messages(*message_ids)
+
+    # the follows in both directions: (our column, their column, their
+    # counter, our counter)
+    directions = [
+        (follows.c.user_following_id, follows.c.user_being_followed_id,
+         'follower_count', 'following_count'),
+        (follows.c.user_being_followed_id, follows.c.user_following_id,
+         'following_count', 'follower_count'),
+    ]
+    for ours, theirs, their_counter, our_counter in directions:
+        while True:
+            other_ids = _ids(theirs, ours == user_id, chunk_size)
+            if not other_ids:
+                break
+            _decrement(their_counter, other_ids)
+            db.session.execute(follows.delete()
+                               .where(ours == user_id)
+                               .where(theirs.in_(other_ids)))
+            _decrement(our_counter, [user_id], by=len(other_ids))
+            chunk_done(len(other_ids), other_ids)
+
+    # the user's own likes
+    while True:
+        message_ids = _ids(likes.c.message_id, likes.c.user_id == user_id, chunk_size)
+        if not message_ids:
+            break
+        db.session.execute(likes.delete()
+                           .where(likes.c.user_id == user_id)
+                           .where(likes.c.message_id.in_(message_ids)))
+        _decrement('like_count', [user_id], by=len(message_ids))
+        chunk_done(len(message_ids))
+
+    # their home timeline, which can be big with fan-out on
+    while True:
+        message_ids = _ids(timeline_entries.c.message_id,
+                           timeline_entries.c.user_id == user_id, chunk_size)
+        if not message_ids:
+            break
+        db.session.execute(timeline_entries.delete()
+                           .where(timeline_entries.c.user_id == user_id)
+                           .where(timeline_entries.c.message_id.in_(message_ids)))
+        chunk_done(0)
+
+    db.session.execute(users.delete().where(users.c.id == user_id))
+    chunk_done(0)
+    fragment_cache.forget_users(user_id)
+    # rows went away behind the ORM's back
+    search.reset()
+
+
+@job('delete_account', concurrency=1)
+def delete_account_job(user_id):
+    """delete_account(), logging progress. One at a time, to go easy on
+    the database."""
+
+    logger = current_app.logger
+
+    def progress(done, total):
+        logger.info(f"deleting user {user_id}: {done}/{total} rows")
+
+    # the web workers' caches of the users changed expire on their own
+    delete_account(user_id, current_app.config.get('ACCOUNT_DELETE_CHUNK_SIZE', 500),
+                   progress)
+    logger.info(f"deleted user {user_id}")
+
+
+class AccountDeleter:
+    """Deletes accounts, in the background if they're big."""
+
+    def __init__(self, app=None):
+        self.chunk_size = 500
+        self.sync_limit = 1000
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.chunk_size = app.config.get('ACCOUNT_DELETE_CHUNK_SIZE', 500)
+        self.sync_limit = app.config.get('ACCOUNT_DELETE_SYNC_LIMIT', 1000)
+
+    def delete(self, user, forget_users=None):
+        """Delete `user`'s account.
+
+        Returns None if it's gone already, or the queued Job if it was too
+        big to do now.
+        """
+
+        if account_size(user) <= self.sync_limit:
+            delete_account(user.id, self.chunk_size, forget_users=forget_users)
+            return None
+
+        queued = enqueue('delete_account', user_id=user.id)
+        db.session.commit()
+        return queued
+
+
+account_deleter = AccountDeleter()
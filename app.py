@@ -1,12 +1,28 @@
 import os
 import pdb
 
-from flask import Flask, render_template, request, flash, redirect, session, g, url_for
+import click
+from flask import Flask, render_template, request, flash, redirect, session, g, url_for, abort, jsonify
+from flask.ctx import _AppCtxGlobals
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
-from flask_bcrypt import check_password_hash
+from sqlalchemy.orm import joinedload, load_only
 from forms import UserAddForm, LoginForm, MessageForm, ProfileForm
-from models import db, connect_db, User, Message, Likes
+from models import db, connect_db, User, Message, Likes, Follows, TimelineEntry
+from caching import TTLCache
+from passwords import hasher, PasswordHasherBusy
+from instrumentation import profiler
+from dbpool import pool_stats
+from fragments import fragment_cache
+from accounts import account_deleter, delete_account
+from live import live
+from pagination import paginate, paginate_ascending
+from replicas import replicas
+import httpcache
+import jobs
+import migrations
+import search
+import timeline
 
 CURR_USER_KEY = "curr_user"
 
@@ -21,25 +37,160 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+# Materialize home timelines when messages are posted (see timeline.py).
+# Run `flask rebuild-timelines` after turning this on for an existing db.
+app.config['TIMELINE_FANOUT'] = os.environ.get('TIMELINE_FANOUT') == '1'
+# how many of their latest messages following someone copies into the timeline
+app.config['TIMELINE_BACKFILL'] = int(os.environ.get('TIMELINE_BACKFILL', 100))
+app.config['MESSAGES_PER_PAGE'] = int(os.environ.get('MESSAGES_PER_PAGE', 50))
+app.config['USERS_PER_PAGE'] = int(os.environ.get('USERS_PER_PAGE', 60))
+# How long (seconds) a worker may reuse the logged-in user's row; 0 disables.
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 30))
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 10000))
+# bcrypt cost for new password hashes; see passwords.py for the pool settings
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+# 'auto' uses Postgres full-text search when available; see search.py
+app.config['SEARCH_BACKEND'] = os.environ.get('SEARCH_BACKEND', 'auto')
+app.config['SEARCH_RESULTS_PER_PAGE'] = int(os.environ.get('SEARCH_RESULTS_PER_PAGE', 20))
+# per-endpoint request/SQL metrics at /metrics (off by default: anyone who
+# can reach it can read them), and a log line with the SQL
+# fingerprints of any request slower than this many ms (0: don't log); see
+# instrumentation.py
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED') == '1'
+app.config['SLOW_REQUEST_MS'] = int(os.environ.get('SLOW_REQUEST_MS', 500))
+# rendered message/user cards; size 0 disables, a redis:// URL shares them
+# between workers (see fragments.py)
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+app.config['FRAGMENT_CACHE_TTL'] = int(os.environ.get('FRAGMENT_CACHE_TTL', 3600))
+app.config['FRAGMENT_CACHE_URL'] = os.environ.get('FRAGMENT_CACHE_URL')
+# connection pool per worker; DATABASE_PGBOUNCER=1 leaves pooling to a
+# PgBouncer in transaction mode (see dbpool.py)
+app.config['DATABASE_POOL_SIZE'] = int(os.environ.get('DATABASE_POOL_SIZE', 5))
+app.config['DATABASE_MAX_OVERFLOW'] = int(os.environ.get('DATABASE_MAX_OVERFLOW', 10))
+app.config['DATABASE_POOL_TIMEOUT'] = float(os.environ.get('DATABASE_POOL_TIMEOUT', 30))
+app.config['DATABASE_POOL_RECYCLE'] = int(os.environ.get('DATABASE_POOL_RECYCLE', 1800))
+app.config['DATABASE_POOL_PRE_PING'] = os.environ.get('DATABASE_POOL_PRE_PING', '1') == '1'
+app.config['DATABASE_PGBOUNCER'] = os.environ.get('DATABASE_PGBOUNCER') == '1'
+# accounts are deleted this many rows per transaction, and in the background
+# if they have more than ACCOUNT_DELETE_SYNC_LIMIT rows (see accounts.py)
+app.config['ACCOUNT_DELETE_CHUNK_SIZE'] = int(os.environ.get('ACCOUNT_DELETE_CHUNK_SIZE', 500))
+app.config['ACCOUNT_DELETE_SYNC_LIMIT'] = int(os.environ.get('ACCOUNT_DELETE_SYNC_LIMIT', 1000))
+# background jobs (see jobs.py): queued, and run by `flask worker`, or with
+# JOBS_IN_PROCESS=1 (the default in development) by threads of the web
+# process; JOBS_EAGER=1 runs them in the request instead
+app.config['JOBS_EAGER'] = os.environ.get('JOBS_EAGER') == '1'
+app.config['JOBS_IN_PROCESS'] = os.environ.get(
+    'JOBS_IN_PROCESS', '1' if app.env == 'development' else '0') == '1'
+app.config['JOBS_CONCURRENCY'] = int(os.environ.get('JOBS_CONCURRENCY', 2))
+app.config['JOBS_POLL_INTERVAL'] = float(os.environ.get('JOBS_POLL_INTERVAL', 1))
+app.config['JOBS_RETRY_DELAY'] = int(os.environ.get('JOBS_RETRY_DELAY', 10))
+app.config['JOBS_STALE_AFTER'] = int(os.environ.get('JOBS_STALE_AFTER', 3600))
+# new messages pushed to open homepages over /stream, if LIVE_BACKEND is set:
+# 'local' delivers within this process, 'postgres' to every process via
+# LISTEN/NOTIFY. Each open stream holds a request thread, so by default they
+# may take half of the WSGI_THREADS the server runs each process with
+# (gunicorn --threads), and none of a worker without threads (see live.py)
+app.config['LIVE_BACKEND'] = os.environ.get('LIVE_BACKEND')
+app.config['LIVE_DATABASE_URL'] = os.environ.get('LIVE_DATABASE_URL')
+app.config['WSGI_THREADS'] = int(os.environ.get('WSGI_THREADS', 1))
+app.config['LIVE_MAX_STREAMS'] = int(os.environ.get('LIVE_MAX_STREAMS',
+                                                    app.config['WSGI_THREADS'] // 2))
+app.config['LIVE_STREAM_SECONDS'] = int(os.environ.get('LIVE_STREAM_SECONDS', 300))
+app.config['LIVE_HEARTBEAT'] = float(os.environ.get('LIVE_HEARTBEAT', 15))
+# read replicas for the read-only pages, comma-separated; a replica more
+# than DATABASE_REPLICA_MAX_LAG seconds behind is skipped (see replicas.py)
+app.config['DATABASE_REPLICA_URLS'] = os.environ.get('DATABASE_REPLICA_URLS', '')
+app.config['DATABASE_REPLICA_MAX_LAG'] = float(os.environ.get('DATABASE_REPLICA_MAX_LAG', 5))
+app.config['DATABASE_REPLICA_CHECK_INTERVAL'] = float(
+    os.environ.get('DATABASE_REPLICA_CHECK_INTERVAL', 1))
+app.config['DATABASE_REPLICA_CONNECT_TIMEOUT'] = int(
+    os.environ.get('DATABASE_REPLICA_CONNECT_TIMEOUT', 2))
+# when served by asgi.py: connections for its async views, and threads for
+# the requests it hands to this app
+app.config['ASYNC_DATABASE_POOL_SIZE'] = int(os.environ.get('ASYNC_DATABASE_POOL_SIZE', 10))
+app.config['ASYNC_WSGI_THREADS'] = int(os.environ.get('ASYNC_WSGI_THREADS', 20))
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+hasher.init_app(app)
+profiler.init_app(app)
+pool_stats.listen(db.engine.pool)
+profiler.add_collector(pool_stats.collector(lambda: db.engine.pool))
+fragment_cache.init_app(app)
+account_deleter.init_app(app)
+live.init_app(app)
+replicas.init_app(app)
+app.jinja_env.globals['static_url'] = httpcache.static_url
 # python -m pdb app.py
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
-def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+# Column values of recently seen logged-in users, keyed by id, so most
+# requests don't have to fetch their own user. Routes that change a user
+# (or their counters) must call forget_cached_users().
+user_cache = TTLCache(maxsize=app.config['USER_CACHE_SIZE'],
+                      ttl=app.config['USER_CACHE_TTL'])
+
+
+def load_current_user():
+    """Return the logged-in user, or None if nobody (valid) is logged in."""
     # left below as get request (not get or 404) since we want g.user to return None 
     #   if no session of current user
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    if CURR_USER_KEY not in session:
+        return None
 
-    else:
-        g.user = None
+    user_id = session[CURR_USER_KEY]
+    record = user_cache.get(user_id)
+    if record is not None:
+        return User.from_cache_record(record)
+
+    # populate_existing: if a list page already loaded this user with only
+    # some columns, fill in the rest in one go rather than one at a time.
+    # From the primary, since it's cached for other requests.
+    with replicas.primary():
+        user = User.query.populate_existing().get(user_id)
+    if user:
+        user_cache.set(user_id, user.cache_record())
+    return user
+
+
+def forget_cached_users(*user_ids):
+    """Drop users from the current-user cache after changing them."""
+
+    user_cache.delete(*user_ids)
+
+
+class load_on_first_use:
+    """Attribute of `g` that is computed the first time a request reads it.
+
+    Setting the attribute (e.g. `g.user = None`) still works as usual.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        value = obj.__dict__[self.name] = self.loader()
+        return value
+
+
+class WarblerGlobals(_AppCtxGlobals):
+    """Flask's `g`, except g.user is only looked up if a request uses it.
+
+    Redirect-only and static-ish requests never touch the database for it.
+    """
+
+    user = load_on_first_use(load_current_user)
+
+
+app.app_ctx_globals_class = WarblerGlobals
 
 
 def do_login(user):
@@ -105,6 +256,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # save the password hash if authenticate() upgraded it
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -125,38 +278,103 @@ def logout():
 # General user routes:###
 #########################
 
+USER_CARD_COLUMNS = (User.id, User.username, User.image_url,
+                     User.header_image_url, User.bio)
+
+
+def followed_among(users):
+    """Ids of the given users that the logged-in user follows."""
+
+    if not g.user:
+        return set()
+    return g.user.following_ids_among(user.id for user in users)
+
+
+def liked_among(messages):
+    """Ids of the given messages that the logged-in user has liked."""
+
+    if not g.user:
+        return set()
+    return g.user.liked_ids_among(message.id for message in messages)
+
+
+def messages_etag(messages, liked_ids, *parts):
+    """ETag for a page of `messages` as the logged-in user sees it.
+
+    Add anything else the page shows as `parts`; see httpcache.py.
+    """
+
+    return httpcache.etag(request.endpoint,
+                          httpcache.user_version(g.user),
+                          [(message.id, message.user_id) for message in messages],
+                          sorted(liked_ids),
+                          messages.next_cursor,
+                          *parts)
+
+
+def authors_version(messages):
+    """Versions of the (already loaded) authors of `messages`."""
+
+    authors = {message.user.id: message.user for message in messages}
+    return [httpcache.user_version(authors[id]) for id in sorted(authors)]
+
+
 @app.route('/users')
+@replicas.reads
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Lists everyone alphabetically, a page at a time; pass `after` to get the
+    next page. Can take a 'q' param in querystring to search usernames, bios
+    and warbles instead, and a 'page' param for further pages of results.
     """
 
-    search = request.args.get('q')
+    q = request.args.get('q', '').strip()
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    if not q:
+        # only the columns the user cards show (no password hashes etc.)
+        query = User.query.options(load_only(*USER_CARD_COLUMNS))
+        users = paginate_ascending(query, User.username,
+                                   cursor=request.args.get('after'),
+                                   per_page=app.config['USERS_PER_PAGE'])
+        return render_template('users/index.html', users=users,
+                               following_ids=followed_among(users))
+
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+        abort(400)
+    per_page = app.config['SEARCH_RESULTS_PER_PAGE']
 
-    return render_template('users/index.html', users=users)
+    users = search.search_users(q, page=page, per_page=per_page)
+    messages = search.search_messages(q, page=page, per_page=per_page)
+
+    return render_template('users/index.html', users=users, messages=messages,
+                           q=q, following_ids=followed_among(users))
 
 
 @app.route('/users/<int:user_id>')
+@replicas.reads
 def users_show(user_id):
-    """Show user profile."""
+    """Show user profile.
+
+    Messages are paginated newest first; pass `before` to get older ones.
+    """
 
     user = User.query.get_or_404(user_id)
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    messages = paginate(Message.query.filter(Message.user_id == user_id),
+                        Message.timestamp, Message.id,
+                        cursor=request.args.get('before'),
+                        per_page=app.config['MESSAGES_PER_PAGE'])
+    liked_ids = liked_among(messages)
+    is_following = bool(g.user) and g.user.id != user_id and g.user.is_following(user)
+
+    tag = messages_etag(messages, liked_ids, httpcache.user_version(user), is_following)
+    return httpcache.conditional(tag, lambda: render_template(
+        'users/show.html', user=user, messages=messages,
+        liked_ids=liked_ids, is_following=is_following))
 
 
 @app.route('/users/<int:user_id>/following')
@@ -167,9 +385,10 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.filter_by(id=user_id).first()
+    user = User.query.get_or_404(user_id)
     following = user.following
-    return render_template('users/following.html', user=user, following=following)
+    return render_template('users/following.html', user=user, following=following,
+                           following_ids=followed_among(following))
 
 
 
@@ -182,7 +401,8 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', followed_user=user.following, user=user)
+    return render_template('users/followers.html', user=user,
+                           following_ids=followed_among(user.followers))
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -195,7 +415,10 @@ def add_follow(follow_id):
 
     followed_user = User.query.get_or_404(follow_id)
     g.user.following.append(followed_user)
+    if timeline.is_enabled():
+        timeline.add_follow(g.user.id, followed_user.id)
     db.session.commit()
+    forget_cached_users(g.user.id, follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -210,7 +433,10 @@ def stop_following(follow_id):
 
     followed_user = User.query.get_or_404(follow_id)
     g.user.following.remove(followed_user)
+    if timeline.is_enabled():
+        timeline.remove_follow(g.user.id, followed_user.id)
     db.session.commit()
+    forget_cached_users(g.user.id, follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -218,14 +444,13 @@ def stop_following(follow_id):
 @app.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
-    user_id = g.user.id
-    user = User.query.get_or_404(user_id)
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
+    user = g.user
     form = ProfileForm()
     if form.validate_on_submit():
-        if not check_password_hash(user.password, form.password.data):
+        if not user.check_password(form.password.data):
             flash("Incorrect password", "danger")
             return redirect("/users/profile")
             # Update the user's information in the database
@@ -236,6 +461,8 @@ def profile():
         g.user.bio = form.bio.data
         g.user.location = form.location.data
         db.session.commit()
+        forget_cached_users(g.user.id)
+        fragment_cache.forget_users(g.user.id)
         flash("Profile updated!", "success")
         return redirect(f"/users/{g.user.id}")
     return render_template("users/edit.html", form=form, form_type="Edit", user=user)
@@ -249,19 +476,13 @@ def delete_user():
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
-        
-    # Find all messages with a user_id matching the one you're trying to delete
-    messages = Message.query.filter_by(user_id=g.user.id)
-    
-    # Delete those messages
-    for message in messages:
-        db.session.delete(message)
-        
+
     do_logout()
 
-    db.session.delete(g.user)
-    db.session.commit()
-    flash("User and User Warbles Deleted", "danger")
+    if account_deleter.delete(g.user, forget_users=forget_cached_users) is None:
+        flash("User and User Warbles Deleted", "danger")
+    else:
+        flash("Your account is being deleted; it'll be gone in a few minutes.", "danger")
     return redirect("/signup")
 
 
@@ -286,7 +507,15 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        if timeline.is_enabled():
+            timeline.fan_out(msg)
+        else:
+            db.session.flush()
+        # to open homepages, once this commits; nobody has liked it yet
+        live.publish(g.user.id, {'id': msg.id,
+                                 'data': str(fragment_cache.message_card(msg, set()))})
         db.session.commit()
+        forget_cached_users(g.user.id)
 
         return redirect(f"/users/{g.user.id}")
 
@@ -301,8 +530,9 @@ def messages_show(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = Message.query.options(joinedload(Message.user)).get_or_404(message_id)
+    return render_template('messages/show.html', message=msg,
+                           liked_ids=liked_among([msg]))
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -320,8 +550,15 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    # their likes go with it, and so does one from each liker's like_count
+    liker_ids = [user_id for (user_id,) in
+                 db.session.query(Likes.user_id).filter(Likes.message_id == msg.id)]
+    if timeline.is_enabled():
+        timeline.remove_message(msg.id)
     db.session.delete(msg)
     db.session.commit()
+    forget_cached_users(g.user.id, *liker_ids)
+    fragment_cache.forget_messages(message_id)
 
     return redirect(f"/users/{g.user.id}")
 
@@ -332,28 +569,113 @@ def messages_destroy(message_id):
 
 
 @app.route('/')
+@replicas.reads
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time
+      (pass `before` to get older ones)
     """
 
     if g.user:
-        followed_users = [user.id for user in g.user.following]
-        followed_users.append(g.user.id)
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(followed_users))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        return render_template('home.html', messages=messages)
+        cursor = request.args.get('before')
+        per_page = app.config['MESSAGES_PER_PAGE']
+
+        if timeline.is_enabled():
+            # materialized timeline: one range scan, however many we follow
+            messages = timeline.timeline_query(g.user.id)
+            sort_columns = (TimelineEntry.timestamp, TimelineEntry.message_id)
+        else:
+            # followed ids go to the database as a subquery, not a loaded list
+            followed_users = (db.session
+                              .query(Follows.user_being_followed_id)
+                              .filter(Follows.user_following_id == g.user.id))
+            messages = Message.query.filter(Message.user_id.in_(followed_users) |
+                                            (Message.user_id == g.user.id))
+            sort_columns = (Message.timestamp, Message.id)
+
+        # load every author with the page instead of one query per message
+        messages = paginate(messages.options(joinedload(Message.user)),
+                            *sort_columns, cursor=cursor, per_page=per_page)
+        liked_ids = liked_among(messages)
+        # the first page keeps itself up to date, from the newest message on it
+        stream_after = None
+        if live.enabled and not cursor:
+            stream_after = max((m.id for m in messages), default=0)
+
+        # a repeat visit with nothing new skips rendering: 304
+        tag = messages_etag(messages, liked_ids, authors_version(messages))
+        return httpcache.conditional(tag, lambda: render_template(
+            'home.html', messages=messages, liked_ids=liked_ids,
+            stream_after=stream_after))
 
     else:
         return render_template('home-anon.html')
 
 
+@app.route('/stream')
+def stream():
+    """New messages by the user and those they follow, as server-sent events.
+
+    Sends the messages after id `after` (or the Last-Event-ID the browser
+    reconnects with) first, then the new ones as they're posted; see
+    live.py.
+    """
+
+    if not live.enabled:
+        abort(404)
+    if not g.user:
+        return ("", 403)
+    if live.full():
+        return ("", 503, {"Retry-After": "30"})
+
+    after = request.headers.get('Last-Event-ID') or request.args.get('after')
+    after = int(after) if after and after.isdigit() else None
+
+    followed_ids = [followed_id for (followed_id,) in
+                    db.session.query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == g.user.id)]
+    # subscribe before looking for missed messages, so none fall in between
+    subscription = live.subscribe(set(followed_ids) | {g.user.id})
+    try:
+        backlog = []
+        if after is not None:
+            missed = (Message.query
+                      .options(joinedload(Message.user))
+                      .filter(Message.user_id.in_(followed_ids + [g.user.id]),
+                              Message.id > after)
+                      .order_by(Message.id.desc())
+                      .limit(app.config['MESSAGES_PER_PAGE'])
+                      .all())
+            liked_ids = liked_among(missed)
+            backlog = [(message.id, None, str(fragment_cache.message_card(message, liked_ids)))
+                       for message in reversed(missed)]
+    except BaseException:
+        subscription.close()
+        raise
+
+    # the stream itself never needs the database: give the connection back
+    db.session.remove()
+
+    response = app.response_class(live.stream(subscription, backlog),
+                                  mimetype='text/event-stream')
+    # in case the client is gone before the stream starts
+    response.call_on_close(subscription.close)
+    response.headers['Cache-Control'] = 'no-store'
+    # don't let nginx buffer the events
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error):
+    """Too many logins/signups queued for the password pool: shed load."""
+
+    return ("Warbler is very busy right now. Please try again in a moment.",
+            503, {"Retry-After": "1"})
+
+
 ################
 # Like routes:##
 ################
@@ -376,38 +698,206 @@ def add_like(message_id):
             flash("You have liked the warble", "success")
         # flash("You have unliked the warble.", "success")
         db.session.commit()
+        forget_cached_users(g.user.id)
         return redirect(f"/messages/{message_id}")
 
 
 @app.route('/users/<int:user_id>/likes', methods=['GET'])
+@replicas.reads
 def show_likes(user_id):
-    """show messages user has liked"""
+    """show messages user has liked, a page at a time"""
     # Get the user
-    user = User.query.filter_by(id=user_id).first()
+    user = User.query.get_or_404(user_id)
+
+    # Get the page of messages the user has liked, without loading them all
+    liked = (Message
+             .query
+             .join(Likes, Likes.message_id == Message.id)
+             .filter(Likes.user_id == user_id)
+             .options(joinedload(Message.user)))
+    messages = paginate(liked, Message.timestamp, Message.id,
+                        cursor=request.args.get('before'),
+                        per_page=app.config['MESSAGES_PER_PAGE'])
+    liked_ids = liked_among(messages)
+
+    tag = messages_etag(messages, liked_ids, httpcache.user_version(user),
+                        authors_version(messages))
+    return httpcache.conditional(tag, lambda: render_template(
+        'messages/likes.html', user=user, likes=messages, liked_ids=liked_ids))
+
+
+##############################################################################
+# JSON API for the like and follow buttons (see static/js/warbler.js)
+#
+# POST adds the like/follow and DELETE removes it. Both are idempotent and
+# answer with the resulting state and the affected users' counters, so the
+# page can update in place instead of reloading.
+
+
+def api_unauthorized():
+    return jsonify(error="You must be logged in."), 401
+
+
+def user_counts(*user_ids):
+    """Current counters for `user_ids`, keyed by id, in one query."""
+
+    rows = (db.session
+            .query(User.id, User.message_count, User.following_count,
+                   User.follower_count, User.like_count)
+            .filter(User.id.in_(user_ids)))
+    return {row.id: dict(message_count=row.message_count,
+                         following_count=row.following_count,
+                         follower_count=row.follower_count,
+                         like_count=row.like_count)
+            for row in rows}
+
+
+@app.route('/api/messages/<int:message_id>/like', methods=['POST', 'DELETE'])
+def api_like(message_id):
+    """Like (POST) or unlike (DELETE) a message as the logged-in user."""
+
+    if not g.user:
+        return api_unauthorized()
+
+    user_id = g.user.id
+    if Message.query.get(message_id) is None:
+        return jsonify(error="No such message."), 404
+    like = Likes.query.filter_by(user_id=user_id, message_id=message_id).first()
+
+    if request.method == 'POST' and not like:
+        db.session.add(Likes(user_id=user_id, message_id=message_id))
+    elif request.method == 'DELETE' and like:
+        db.session.delete(like)
+
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # a simultaneous request liked it first; the end state is the same
+        db.session.rollback()
+    forget_cached_users(user_id)
+
+    return jsonify(message_id=message_id,
+                   liked=request.method == 'POST',
+                   counts=user_counts(user_id))
 
-    # Get the list of messages the user has liked
-    messages = user.likes
-    return render_template('messages/likes.html', user=user, likes=messages)
 
+@app.route('/api/users/<int:user_id>/follow', methods=['POST', 'DELETE'])
+def api_follow(user_id):
+    """Follow (POST) or unfollow (DELETE) a user as the logged-in user."""
+
+    if not g.user:
+        return api_unauthorized()
+
+    follower_id = g.user.id
+    if user_id == follower_id:
+        return jsonify(error="You can't follow yourself."), 400
+
+    if User.query.get(user_id) is None:
+        return jsonify(error="No such user."), 404
+    follow = Follows.query.get((user_id, follower_id))
+
+    # add/delete the row itself rather than going through g.user.following,
+    # which would load the whole list first
+    if request.method == 'POST' and not follow:
+        db.session.add(Follows(user_being_followed_id=user_id,
+                               user_following_id=follower_id))
+        if timeline.is_enabled():
+            timeline.add_follow(follower_id, user_id)
+    elif request.method == 'DELETE' and follow:
+        db.session.delete(follow)
+        if timeline.is_enabled():
+            timeline.remove_follow(follower_id, user_id)
+
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+    forget_cached_users(follower_id, user_id)
+
+    return jsonify(user_id=user_id,
+                   following=request.method == 'POST',
+                   counts=user_counts(follower_id, user_id))
+
+
+##############################################################################
+# CLI commands (run with `FLASK_APP=app.py flask <command>`)
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Bring an existing database's schema up to date."""
+
+    db.create_all()
+    ran = migrations.migrate(db.engine)
+    print(f"Applied: {', '.join(ran)}" if ran else "Schema is up to date.")
+
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines_command():
+    """Recompute every user's materialized home timeline."""
+
+    timeline.rebuild()
+    db.session.commit()
+    print("Timelines rebuilt.")
+
+
+@app.cli.command('recount-stats')
+def recount_stats_command():
+    """Recompute every user's message/follower/following/like counters."""
+
+    User.recount()
+    db.session.commit()
+    print("User counters recomputed.")
+
+
+@app.cli.command('delete-user')
+@click.argument('user_id', type=int)
+def delete_user_command(user_id):
+    """Delete a user and everything of theirs, showing progress."""
+
+    def progress(done, total):
+        print(f"\r{done}/{total} rows", end="", flush=True)
+
+    delete_account(user_id, app.config['ACCOUNT_DELETE_CHUNK_SIZE'], progress,
+                   forget_cached_users)
+    print(f"\nUser {user_id} deleted.")
+
+
+@app.cli.command('worker')
+@click.option('--concurrency', type=int, help="jobs to run at once")
+@click.option('--burst', is_flag=True, help="exit once no jobs are due")
+def worker_command(concurrency, burst):
+    """Run queued background jobs."""
+
+    jobs.Worker(app, concurrency).run(burst=burst)
 
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# Cache policy
 #
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Views may set their own Cache-Control (the timeline and profile pages use
+# ETags; see httpcache.py), and this fills in the rest. Static files linked
+# through static_url() carry a fingerprint of their contents (?v=...), so
+# they can be cached for good; other static files, and ones with an old or
+# made-up ?v=, get revalidated. Any
+# other page is per-user and unversioned, so isn't stored at all.
+
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
 
 @app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+def add_header(resp):
+    """Set the cache policy for responses whose view didn't pick one."""
+
+    if request.endpoint == 'static':
+        v = request.args.get('v')
+        if v and v == httpcache.static_fingerprint(request.view_args['filename']):
+            resp.headers['Cache-Control'] = f"public, max-age={STATIC_MAX_AGE}, immutable"
+        else:
+            resp.headers['Cache-Control'] = "public, no-cache"
+    elif 'Cache-Control' not in resp.headers:
+        resp.headers['Cache-Control'] = "no-store"
+    return resp
 
 
 # To Do:
@@ -0,0 +1,582 @@
+"""Optional async (ASGI) serving mode.
+
+Under WSGI each request holds a worker thread for as long as it waits on
+Postgres. This module serves Warbler as an ASGI application instead:
+
+    uvicorn asgi:application --workers 4
+
+(any ASGI server will do; none is needed otherwise). The read-only pages
+(the homepage, profiles, the user directory, a message, a user's likes)
+are served by async views that query Postgres through psycopg2's
+non-blocking mode on the event loop, and run their independent queries at
+the same time: a profile fetches the user's row (with its stat counts),
+their page of messages (with the viewer's likes) and the follow state
+together. They then render the same templates as app.py, so the pages and
+their ETags are the same either way.
+
+Everything else (forms, the JSON API, the live stream, and any page an
+async view passes on, like search results) goes to the Flask app itself,
+on a pool of ASYNC_WSGI_THREADS threads.
+
+The async views open ASYNC_DATABASE_POOL_SIZE connections of their own,
+outside SQLAlchemy's pool, each statement in its own transaction; that's
+fine for pages that only read. They use the primary, not the read replicas
+of replicas.py. Postgres only.
+"""
+
+import asyncio
+import io
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+import psycopg2
+from flask import g, render_template, request_started
+from psycopg2 import extensions
+from sqlalchemy import exists, select, tuple_
+from werkzeug.exceptions import HTTPException, NotFound
+from werkzeug.wrappers import Request
+
+import httpcache
+from app import CURR_USER_KEY, app, authors_version, messages_etag, user_cache
+from live import live
+from models import db, Follows, Likes, Message, TimelineEntry, User
+from pagination import Page, decode_cursor, decode_key, encode_cursor, encode_key
+
+users = User.__table__
+messages = Message.__table__
+follows = Follows.__table__
+likes = Likes.__table__
+timeline_entries = TimelineEntry.__table__
+
+# what pages show of a user, as in the current-user cache (no secrets)
+USER_COLUMNS = [users.c[name] for name in User.CACHE_COLUMNS]
+# authors come with their messages under these labels
+AUTHOR_COLUMNS = [column.label(f"author_{column.name}") for column in USER_COLUMNS]
+USER_CARD_COLUMNS = [users.c.id, users.c.username, users.c.image_url,
+                     users.c.header_image_url, users.c.bio]
+
+
+##############################################################################
+# Postgres, without blocking the event loop
+
+# (statement, seconds) for each query of the request being served, for
+# the request profiler (instrumentation.py)
+query_log = ContextVar('query_log', default=None)
+
+
+class AsyncDatabase:
+    """A small pool of psycopg2 connections in non-blocking mode."""
+
+    def __init__(self, engine, size):
+        self.dialect = engine.dialect
+        self.connect_args = engine.dialect.create_connect_args(engine.url)
+        self.size = size
+        self._idle = []
+        # (event loop, its semaphore): servers run one loop, tests several
+        self._slots = None, None
+
+    async def _wait(self, connection):
+        """Wait until `connection` has finished what it's doing."""
+
+        loop = asyncio.get_running_loop()
+        fd = connection.fileno()
+        while True:
+            state = connection.poll()
+            if state == extensions.POLL_OK:
+                return
+            ready = loop.create_future()
+            if state == extensions.POLL_READ:
+                loop.add_reader(fd, ready.set_result, None)
+                try:
+                    await ready
+                finally:
+                    loop.remove_reader(fd)
+            else:
+                loop.add_writer(fd, ready.set_result, None)
+                try:
+                    await ready
+                finally:
+                    loop.remove_writer(fd)
+
+    @asynccontextmanager
+    async def connection(self):
+        loop = asyncio.get_running_loop()
+        if self._slots[0] is not loop:
+            self._slots = loop, asyncio.Semaphore(self.size)
+
+        async with self._slots[1]:
+            if self._idle:
+                connection = self._idle.pop()
+            else:
+                cargs, cparams = self.connect_args
+                connection = psycopg2.connect(*cargs, async_=1, **cparams)
+                await self._wait(connection)
+
+            try:
+                yield connection
+            except BaseException:
+                # it may be half way through something; don't reuse it
+                connection.close()
+                raise
+            self._idle.append(connection)
+
+    async def fetch(self, statement):
+        """Run a SQLAlchemy `statement`; its rows, as dicts."""
+
+        compiled = statement.compile(dialect=self.dialect)
+        sql = str(compiled)
+        async with self.connection() as connection:
+            with connection.cursor() as cursor:
+                started = time.perf_counter()
+                cursor.execute(sql, compiled.construct_params())
+                await self._wait(connection)
+                log = query_log.get()
+                if log is not None:
+                    log.append((sql, time.perf_counter() - started))
+                names = [column.name for column in cursor.description]
+                return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    async def fetch_one(self, statement):
+        rows = await self.fetch(statement)
+        return rows[0] if rows else None
+
+    def close(self):
+        while self._idle:
+            self._idle.pop().close()
+
+
+##############################################################################
+# Turning rows into the objects the templates expect
+#
+# They're plain (transient) model instances: nothing can lazy-load through
+# them, so the views fetch everything the templates use.
+
+
+def user_from_row(row, prefix=''):
+    return User(**{column.name: row[prefix + column.name] for column in users.c
+                   if prefix + column.name in row})
+
+
+def message_page(rows, per_page):
+    """A newest-first Page of messages, and the ids of those the viewer liked."""
+
+    items = []
+    liked_ids = set()
+    for row in rows[:per_page]:
+        message = Message(id=row['id'], text=row['text'], timestamp=row['timestamp'],
+                          user_id=row['user_id'], user=user_from_row(row, 'author_'))
+        items.append(message)
+        if row['liked']:
+            liked_ids.add(message.id)
+
+    last = items[-1] if len(rows) > per_page else None
+    next_cursor = encode_cursor(last.timestamp, last.id) if last else None
+    return Page(items, next_cursor), liked_ids
+
+
+def messages_query(from_, criterion, viewer_id, sort_columns, cursor, per_page):
+    """A page of messages (keyset-paginated on `sort_columns`) with their
+    authors, and whether the viewer likes each one."""
+
+    liked = (exists()
+             .where(likes.c.message_id == messages.c.id)
+             .where(likes.c.user_id == viewer_id))
+    query = (select(list(messages.c) + AUTHOR_COLUMNS + [liked.label('liked')])
+             .select_from(from_.join(users, users.c.id == messages.c.user_id))
+             .where(criterion))
+    if cursor:
+        query = query.where(tuple_(*sort_columns) < tuple_(*decode_cursor(cursor)))
+    return (query
+            .order_by(*[column.desc() for column in sort_columns])
+            .limit(per_page + 1))
+
+
+def follows_query(follower_id, followed_id):
+    return select([exists()
+                   .where(follows.c.user_following_id == follower_id)
+                   .where(follows.c.user_being_followed_id == followed_id)
+                   .label('following')])
+
+
+##############################################################################
+# The async views
+#
+# Each one gathers its data, then returns a function that renders the page
+# inside a Flask request context (see AsyncWarbler.respond), or returns
+# None to let the Flask app handle the request after all.
+
+
+class AsyncViews:
+    def __init__(self, database):
+        self.db = database
+
+    async def viewer(self, user_id):
+        """The logged-in user, through the same cache as app.py."""
+
+        if user_id is None:
+            return None
+        record = user_cache.get(user_id)
+        if record is None:
+            row = await self.db.fetch_one(select(USER_COLUMNS).where(users.c.id == user_id))
+            if row is None:
+                return None
+            record = User.make_cache_record(row.__getitem__)
+            user_cache.set(user_id, record)
+        return User(**record)
+
+    async def homepage(self, request, viewer_id):
+        if viewer_id is None:
+            return None
+
+        per_page = app.config['MESSAGES_PER_PAGE']
+        cursor = request.args.get('before')
+        # timeline.is_enabled(), which wants an app context
+        if app.config['TIMELINE_FANOUT']:
+            query = messages_query(
+                messages.join(timeline_entries,
+                              timeline_entries.c.message_id == messages.c.id),
+                timeline_entries.c.user_id == viewer_id, viewer_id,
+                (timeline_entries.c.timestamp, timeline_entries.c.message_id),
+                cursor, per_page)
+        else:
+            followed = (select([follows.c.user_being_followed_id])
+                        .where(follows.c.user_following_id == viewer_id))
+            query = messages_query(
+                messages,
+                messages.c.user_id.in_(followed) | (messages.c.user_id == viewer_id),
+                viewer_id, (messages.c.timestamp, messages.c.id), cursor, per_page)
+
+        viewer, rows = await asyncio.gather(self.viewer(viewer_id), self.db.fetch(query))
+        if viewer is None:
+            return None
+        page, liked_ids = message_page(rows, per_page)
+        stream_after = None
+        if live.enabled and not cursor:
+            stream_after = max((m.id for m in page), default=0)
+
+        def render():
+            tag = messages_etag(page, liked_ids, authors_version(page))
+            return httpcache.conditional(tag, lambda: render_template(
+                'home.html', messages=page, liked_ids=liked_ids,
+                stream_after=stream_after))
+
+        return viewer, render
+
+    async def users_show(self, request, viewer_id, user_id):
+        per_page = app.config['MESSAGES_PER_PAGE']
+        user_query = select(USER_COLUMNS).where(users.c.id == user_id)
+        page_query = messages_query(messages, messages.c.user_id == user_id, viewer_id,
+                                    (messages.c.timestamp, messages.c.id),
+                                    request.args.get('before'), per_page)
+
+        # the profile's row (with its counts), its messages and the follow
+        # button don't depend on each other: ask for them all at once
+        lookups = [self.viewer(viewer_id), self.db.fetch_one(user_query),
+                   self.db.fetch(page_query)]
+        if viewer_id is not None and viewer_id != user_id:
+            lookups.append(self.db.fetch_one(follows_query(viewer_id, user_id)))
+        viewer, user_row, rows, *following = await asyncio.gather(*lookups)
+
+        if user_row is None:
+            raise NotFound()
+        user = user_from_row(user_row)
+        page, liked_ids = message_page(rows, per_page)
+        is_following = bool(viewer) and bool(following) and following[0]['following']
+
+        def render():
+            tag = messages_etag(page, liked_ids, httpcache.user_version(user), is_following)
+            return httpcache.conditional(tag, lambda: render_template(
+                'users/show.html', user=user, messages=page,
+                liked_ids=liked_ids, is_following=is_following))
+
+        return viewer, render
+
+    async def list_users(self, request, viewer_id):
+        if request.args.get('q', '').strip():
+            # searches stay on the Flask side (see search.py)
+            return None
+
+        per_page = app.config['USERS_PER_PAGE']
+        following = (exists()
+                     .where(follows.c.user_following_id == viewer_id)
+                     .where(follows.c.user_being_followed_id == users.c.id))
+        query = select(USER_CARD_COLUMNS + [following.label('following')])
+        cursor = request.args.get('after')
+        if cursor:
+            query = query.where(users.c.username > decode_key(cursor))
+        query = query.order_by(users.c.username).limit(per_page + 1)
+
+        viewer, rows = await asyncio.gather(self.viewer(viewer_id), self.db.fetch(query))
+        items = [user_from_row(row) for row in rows[:per_page]]
+        next_cursor = encode_key(items[-1].username) if len(rows) > per_page else None
+        page = Page(items, next_cursor)
+        following_ids = {row['id'] for row in rows[:per_page] if row['following']}
+        if viewer is None:
+            following_ids = set()
+
+        def render():
+            return render_template('users/index.html', users=page,
+                                   following_ids=following_ids)
+
+        return viewer, render
+
+    async def messages_show(self, request, viewer_id, message_id):
+        if viewer_id is None:
+            return None
+
+        query = messages_query(messages, messages.c.id == message_id, viewer_id,
+                               (messages.c.timestamp, messages.c.id), None, 1)
+        viewer, rows = await asyncio.gather(self.viewer(viewer_id), self.db.fetch(query))
+        if viewer is None:
+            return None
+        if not rows:
+            raise NotFound()
+        page, liked_ids = message_page(rows, 1)
+        message = page.items[0]
+        is_following = False
+        if message.user_id != viewer_id:
+            row = await self.db.fetch_one(follows_query(viewer_id, message.user_id))
+            is_following = row['following']
+
+        def render():
+            return render_template('messages/show.html', message=message,
+                                   liked_ids=liked_ids, is_following=is_following)
+
+        return viewer, render
+
+    async def show_likes(self, request, viewer_id, user_id):
+        per_page = app.config['MESSAGES_PER_PAGE']
+        liked_by = likes.alias('liked_by')
+        page_query = messages_query(
+            messages.join(liked_by, liked_by.c.message_id == messages.c.id),
+            liked_by.c.user_id == user_id, viewer_id,
+            (messages.c.timestamp, messages.c.id), request.args.get('before'), per_page)
+
+        viewer, user_row, rows = await asyncio.gather(
+            self.viewer(viewer_id),
+            self.db.fetch_one(select(USER_COLUMNS).where(users.c.id == user_id)),
+            self.db.fetch(page_query))
+
+        if user_row is None:
+            raise NotFound()
+        user = user_from_row(user_row)
+        page, liked_ids = message_page(rows, per_page)
+
+        def render():
+            tag = messages_etag(page, liked_ids, httpcache.user_version(user),
+                                authors_version(page))
+            return httpcache.conditional(tag, lambda: render_template(
+                'messages/likes.html', user=user, likes=page, liked_ids=liked_ids))
+
+        return viewer, render
+
+
+##############################################################################
+# The ASGI application
+
+
+def wsgi_environ(scope, body):
+    """A WSGI environ for the HTTP request in ASGI `scope`."""
+
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        # WSGI wants the decoded path's bytes, as latin-1
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        # we read the whole body already, so it ends without a Content-Length
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+        else:
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+class AsyncWarbler:
+    """The ASGI application; see the module docs."""
+
+    # endpoints served by the AsyncViews method of the same name
+    ASYNC_ENDPOINTS = {'homepage', 'users_show', 'list_users', 'messages_show',
+                       'show_likes'}
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self.database = None
+        self.views = None
+        self.threads = ThreadPoolExecutor(
+            max_workers=flask_app.config.get('ASYNC_WSGI_THREADS', 20),
+            thread_name_prefix='wsgi')
+
+    def start(self):
+        if self.database is None:
+            with self.app.app_context():
+                engine = db.engine
+            self.database = AsyncDatabase(
+                engine, self.app.config.get('ASYNC_DATABASE_POOL_SIZE', 10))
+            self.views = AsyncViews(self.database)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.database is not None:
+                    self.database.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        self.start()
+
+        body = []
+        more = True
+        while more:
+            message = await receive()
+            body.append(message.get('body', b''))
+            more = message.get('more_body', False)
+        environ = wsgi_environ(scope, b''.join(body))
+
+        if scope['method'] in ('GET', 'HEAD'):
+            handled = await self.try_async_view(environ, send)
+            if handled:
+                return
+        await self.call_flask(environ, send)
+
+    async def try_async_view(self, environ, send):
+        """Serve the request with an async view if there is one that wants
+        it. Returns whether it did."""
+
+        try:
+            endpoint, view_args = self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return False
+        if endpoint not in self.ASYNC_ENDPOINTS:
+            return False
+
+        started = time.perf_counter()
+        queries = []
+        query_log.set(queries)
+
+        request = Request(environ)
+        session = self.app.session_interface.open_session(self.app, request)
+        viewer_id = session.get(CURR_USER_KEY) if session is not None else None
+
+        try:
+            result = await getattr(self.views, endpoint)(request, viewer_id, **view_args)
+        except HTTPException as error:
+            result = None, error
+        if result is None:
+            return False
+
+        viewer, render = result
+        response = self.respond(environ, viewer, render, started, queries)
+        await self.send_wsgi(response, environ, send)
+        return True
+
+    def respond(self, environ, viewer, render, started, queries):
+        """Render a page in a Flask request context, as app.py's view (and
+        Flask's full_dispatch_request()) would."""
+
+        app = self.app
+        with app.request_context(environ):
+            g.user = viewer
+            try:
+                try:
+                    request_started.send(app)
+                    profile = g.get('request_profile')
+                    if profile is not None:
+                        # the request began before the queries we've run
+                        profile.started = started
+                        for sql, seconds in queries:
+                            profile.record_query(sql, seconds)
+
+                    rv = app.preprocess_request()
+                    if rv is None:
+                        if isinstance(render, HTTPException):
+                            raise render
+                        rv = render()
+                except Exception as error:
+                    rv = app.handle_user_exception(error)
+                return app.finalize_request(rv)
+            except Exception as error:
+                # sends got_request_exception, and answers 500
+                return app.handle_exception(error)
+
+    async def send_wsgi(self, wsgi_app, environ, send):
+        """Run `wsgi_app` here, on the event loop; only for ones that don't
+        block (a response we already have)."""
+
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                  for name, value in headers]
+
+        body = b''.join(wsgi_app(environ, start_response))
+        await send({'type': 'http.response.start', 'status': started['status'],
+                    'headers': started['headers']})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def call_flask(self, environ, send):
+        """Run the request through the Flask app on a thread, sending its
+        response as it comes (the live stream never ends)."""
+
+        loop = asyncio.get_running_loop()
+
+        def send_from_thread(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def run():
+            def start_response(status, headers, exc_info=None):
+                send_from_thread({
+                    'type': 'http.response.start',
+                    'status': int(status.split(' ', 1)[0]),
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                for name, value in headers],
+                })
+
+            result = self.app(environ, start_response)
+            try:
+                for chunk in result:
+                    if chunk:
+                        send_from_thread({'type': 'http.response.body', 'body': chunk,
+                                          'more_body': True})
+                send_from_thread({'type': 'http.response.body', 'body': b''})
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+
+        await loop.run_in_executor(self.threads, run)
+
+
+application = AsyncWarbler(app)
@@ -0,0 +1,6 @@
+"""Performance benchmarks for Warbler. Run them from the repo root, e.g.
+
+    python -m benchmarks.login_throughput
+    python -m benchmarks.routes --out baseline.json
+    python -m benchmarks.asgi_throughput --concurrency 1 8 32
+"""
@@ -0,0 +1,190 @@
+"""Benchmark: read-heavy page throughput, WSGI threads vs the async (ASGI) mode.
+
+Drives the read-only pages (home, users, a profile, a message, likes),
+logged in, from CONCURRENCY simultaneous clients for --seconds each, once
+through the Flask app on a pool of --threads threads (as a threaded WSGI
+worker would run it) and once through asgi.application on one event loop,
+and reports requests per second and latency:
+
+    python -m benchmarks.asgi_throughput --concurrency 1 8 32 --threads 8
+
+Both run in this process, without a web server, so the numbers are for one
+worker process. Uses the same data as benchmarks.routes (in
+BENCHMARK_DATABASE_URL, default postgresql:///warbler-bench), seeding it
+unless --reuse is given.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from statistics import mean
+
+from benchmarks.routes import generate_and_seed, percentile, pick_subjects
+
+
+def read_routes(subjects):
+    return [
+        '/',
+        '/users',
+        f"/users/{subjects['celebrity']}",
+        f"/messages/{subjects['message']}",
+        f"/users/{subjects['liker']}/likes",
+    ]
+
+
+def summarize(latencies, seconds):
+    ms = [latency * 1000 for latency in latencies]
+    return {
+        'requests': len(ms),
+        'per_second': round(len(ms) / seconds, 1),
+        'p50_ms': round(percentile(ms, 50), 3),
+        'p95_ms': round(percentile(ms, 95), 3),
+        'p99_ms': round(percentile(ms, 99), 3),
+        'mean_ms': round(mean(ms), 3),
+    }
+
+
+def run_wsgi(app, routes, viewer_id, concurrency, threads, seconds):
+    """`concurrency` clients sharing `threads` request threads.
+
+    Returns each request's latency, waiting for a thread included.
+    """
+
+    from app import CURR_USER_KEY
+
+    local = threading.local()
+
+    def get(url):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+            with local.client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = viewer_id
+        status = local.client.get(url).status_code
+        if status >= 400:
+            raise RuntimeError(f"GET {url} failed: {status}")
+
+    latencies = []
+    deadline = time.monotonic() + seconds
+
+    def client(n):
+        for i in count(n):
+            if time.monotonic() >= deadline:
+                return
+            start = time.perf_counter()
+            pool.submit(get, routes[i % len(routes)]).result()
+            latencies.append(time.perf_counter() - start)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        clients = [threading.Thread(target=client, args=(n,)) for n in range(concurrency)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+
+    return latencies
+
+
+async def run_asgi(application, routes, cookie, concurrency, seconds):
+    """`concurrency` clients as tasks on this event loop; their latencies."""
+
+    latencies = []
+    deadline = time.monotonic() + seconds
+
+    async def get(url):
+        path, _, query = url.partition('?')
+        scope = {'type': 'http', 'method': 'GET', 'path': path,
+                 'query_string': query.encode(), 'root_path': '',
+                 'headers': [(b'cookie', cookie.encode())]}
+        status = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                status.append(message['status'])
+
+        await application(scope, receive, send)
+        if status[0] >= 400:
+            raise RuntimeError(f"GET {url} failed: {status[0]}")
+
+    async def client(n):
+        for i in count(n):
+            if time.monotonic() >= deadline:
+                return
+            start = time.perf_counter()
+            await get(routes[i % len(routes)])
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*[client(n) for n in range(concurrency)])
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--messages', type=int, default=3000)
+    parser.add_argument('--follows', type=int, default=10000)
+    parser.add_argument('--likes', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--reuse', action='store_true',
+                        help="use the data already in the database")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32],
+                        help="simultaneous clients")
+    parser.add_argument('--threads', type=int, default=8,
+                        help="WSGI request threads (like gunicorn --threads)")
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--out', help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    # the app connects to DATABASE_URL when it's imported
+    os.environ['DATABASE_URL'] = os.environ.get('BENCHMARK_DATABASE_URL',
+                                                'postgresql:///warbler-bench')
+    from app import app, CURR_USER_KEY
+    from asgi import application
+    from models import db
+
+    if not args.reuse:
+        generate_and_seed(args)
+
+    subjects = pick_subjects()
+    db.session.remove()
+    routes = read_routes(subjects)
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = subjects['viewer']
+    cookie = "; ".join(f"{c.name}={c.value}" for c in client.cookie_jar)
+
+    # warm up both: caches, connections, compiled templates
+    run_wsgi(app, routes, subjects['viewer'], args.threads, args.threads, 1)
+    asyncio.run(run_asgi(application, routes, cookie, args.threads, 1))
+
+    results = []
+    print(f"{'mode':<6}{'clients':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for concurrency in args.concurrency:
+        for mode in ('wsgi', 'asgi'):
+            if mode == 'wsgi':
+                latencies = run_wsgi(app, routes, subjects['viewer'], concurrency,
+                                     args.threads, args.seconds)
+            else:
+                latencies = asyncio.run(run_asgi(application, routes, cookie,
+                                                 concurrency, args.seconds))
+            stats = summarize(latencies, args.seconds)
+            results.append(dict(mode=mode, concurrency=concurrency, **stats))
+            print(f"{mode:<6}{concurrency:>8}{stats['per_second']:>9.1f}"
+                  f"{stats['p50_ms']:>9.2f}{stats['p95_ms']:>9.2f}{stats['p99_ms']:>9.2f}")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'threads': args.threads, 'subjects': subjects,
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
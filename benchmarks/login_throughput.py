@@ -0,0 +1,81 @@
+"""Benchmark: logins (bcrypt password checks) per second per core.
+
+Simulates CONCURRENCY request threads all logging in at once, and compares
+checking inline on each request thread with checking on the bounded
+password pool from passwords.py:
+
+    python -m benchmarks.login_throughput --rounds 12 --concurrency 1 4 16
+
+No database is needed; a login's cost is almost entirely the bcrypt check.
+"""
+
+import argparse
+import os
+import threading
+import time
+
+from passwords import PasswordHasher, PasswordHasherBusy, bcrypt
+
+
+def run(check, concurrency, seconds):
+    """Call `check()` from `concurrency` threads for `seconds`.
+
+    Returns (completed checks, rejected checks).
+    """
+
+    done = [0] * concurrency
+    rejected = [0] * concurrency
+    deadline = time.monotonic() + seconds
+
+    def client(n):
+        while time.monotonic() < deadline:
+            try:
+                check()
+                done[n] += 1
+            except PasswordHasherBusy:
+                rejected[n] += 1
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return sum(done), sum(rejected)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=12, help="bcrypt cost")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16],
+                        help="simultaneous logins to simulate")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="password pool size (default: CPU count)")
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    hasher = PasswordHasher()
+    hasher.configure({'BCRYPT_LOG_ROUNDS': args.rounds,
+                      'PASSWORD_HASH_WORKERS': args.workers})
+    pw_hash = hasher.hash("password")
+
+    modes = {
+        'inline': lambda: bcrypt.check_password_hash(pw_hash, "password"),
+        'pool': lambda: hasher.check(pw_hash, "password"),
+    }
+
+    print(f"bcrypt cost {args.rounds}, {cores} cores, pool of {args.workers}")
+    print(f"{'mode':<8}{'clients':>8}{'logins/s':>12}{'per core':>12}{'rejected':>10}")
+
+    for concurrency in args.concurrency:
+        for name, check in modes.items():
+            done, rejected = run(check, concurrency, args.seconds)
+            rate = done / args.seconds
+            busy_cores = min(concurrency, cores, args.workers if name == 'pool' else cores)
+            print(f"{name:<8}{concurrency:>8}{rate:>12.1f}"
+                  f"{rate / busy_cores:>12.1f}{rejected:>10}")
+
+
+if __name__ == '__main__':
+    main()
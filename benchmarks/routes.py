@@ -0,0 +1,242 @@
+"""Benchmark: latency and SQL cost of Warbler's main pages and actions.
+
+Seeds a database with generated data of the given size, then drives each
+route through the Flask test client, logged in, and records p50/p95/p99
+latency plus the SQL statements run and rows fetched per request:
+
+    python -m benchmarks.routes --users 2000 --messages 20000 \\
+        --follows 100000 --likes 50000 --out after.json --baseline before.json
+
+The data goes into BENCHMARK_DATABASE_URL (default
+postgresql:///warbler-bench, which must exist); it's dropped and reseeded
+unless --reuse is given. The same sizes and --seed always give the same
+data, so runs on different code can be compared. With --baseline, routes
+more than --tolerance times slower at p95, or running more SQL than in the
+baseline, are listed and the exit status is 1.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from math import ceil
+from statistics import mean, median
+
+GENERATOR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         'generator', 'create_csvs.py')
+
+
+def percentile(values, p):
+    """The nearest-rank `p`th percentile of `values`."""
+
+    ordered = sorted(values)
+    return ordered[max(0, ceil(p / 100 * len(ordered)) - 1)]
+
+
+def summarize(samples):
+    """Sum up (seconds, queries, rows) samples for one route."""
+
+    ms = [seconds * 1000 for seconds, queries, rows in samples]
+    return {
+        'requests': len(samples),
+        'p50_ms': round(percentile(ms, 50), 3),
+        'p95_ms': round(percentile(ms, 95), 3),
+        'p99_ms': round(percentile(ms, 99), 3),
+        'mean_ms': round(mean(ms), 3),
+        'queries': median(queries for seconds, queries, rows in samples),
+        'rows': median(rows for seconds, queries, rows in samples),
+    }
+
+
+def compare(routes, baseline, tolerance):
+    """Regressions in `routes` against the `baseline` routes, as messages."""
+
+    regressions = []
+    for name, now in routes.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if now['p95_ms'] > before['p95_ms'] * tolerance:
+            regressions.append(f"{name}: p95 {before['p95_ms']:.1f}ms -> "
+                               f"{now['p95_ms']:.1f}ms")
+        if now['queries'] > before['queries']:
+            regressions.append(f"{name}: {before['queries']:g} -> "
+                               f"{now['queries']:g} queries")
+    return regressions
+
+
+def generate_and_seed(args):
+    """Make the dataset with the generator and load it with seed.py."""
+
+    from seed import seed
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        subprocess.run([sys.executable, GENERATOR, '--out', data_dir,
+                        '--users', str(args.users), '--messages', str(args.messages),
+                        '--follows', str(args.follows), '--likes', str(args.likes),
+                        '--seed', str(args.seed), '--until', '2020-01-01'],
+                       check=True, stdout=subprocess.DEVNULL)
+        seed(data_dir, loaded=print)
+
+
+def pick_subjects():
+    """The users and message the routes are pointed at.
+
+    The viewer follows the most people, so has the busiest timeline; the
+    profile shown is the most followed user, who posts the most too.
+    """
+
+    from models import User, Message, Follows
+
+    viewer = User.query.order_by(User.following_count.desc(), User.id).first()
+    followed = (Follows.query
+                .with_entities(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == viewer.id))
+    return dict(
+        viewer=viewer.id,
+        celebrity=User.query.order_by(User.follower_count.desc(), User.id).first().id,
+        liker=User.query.order_by(User.like_count.desc(), User.id).first().id,
+        # follow/unfollow someone the viewer doesn't follow yet
+        stranger=(User.query
+                  .filter(User.id != viewer.id, ~User.id.in_(followed))
+                  .order_by(User.id).first().id),
+        message=Message.query.order_by(Message.id).first().id,
+    )
+
+
+def benchmark_routes(subjects):
+    """(name, method, url) for each route, in the order they run.
+
+    Each follow is undone by the unfollow after it, and each like by the
+    unlike, so every round starts from the same data.
+    """
+
+    return [
+        ('home', 'GET', '/'),
+        ('users', 'GET', '/users'),
+        ('user', 'GET', f"/users/{subjects['celebrity']}"),
+        ('likes', 'GET', f"/users/{subjects['liker']}/likes"),
+        ('new message', 'GET', '/messages/new'),
+        ('follow', 'POST', f"/users/follow/{subjects['stranger']}"),
+        ('unfollow', 'POST', f"/users/stop-following/{subjects['stranger']}"),
+        ('like', 'POST', f"/users/add_like/{subjects['message']}"),
+        ('unlike', 'POST', f"/users/add_like/{subjects['message']}"),
+    ]
+
+
+def run(app, engine, routes, viewer_id, requests, warmup):
+    """Request every route `warmup + requests` times, round-robin.
+
+    Returns {name: [(seconds, queries, rows), ...]}, warmup rounds left out.
+    """
+
+    from app import CURR_USER_KEY
+    from instrumentation import count_queries
+
+    samples = {name: [] for name, method, url in routes}
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = viewer_id
+
+        for i in range(warmup + requests):
+            for name, method, url in routes:
+                with count_queries(engine) as log:
+                    start = time.perf_counter()
+                    resp = client.open(url, method=method)
+                    seconds = time.perf_counter() - start
+
+                if resp.status_code >= 400:
+                    sys.exit(f"{method} {url} failed: {resp.status}")
+                if i >= warmup:
+                    samples[name].append((seconds, len(log), log.rows))
+
+    return samples
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--messages', type=int, default=3000)
+    parser.add_argument('--follows', type=int, default=10000)
+    parser.add_argument('--likes', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--reuse', action='store_true',
+                        help="use the data already in the database")
+    parser.add_argument('--requests', type=int, default=200,
+                        help="measured requests per route")
+    parser.add_argument('--warmup', type=int, default=10,
+                        help="unmeasured requests per route first")
+    parser.add_argument('--out', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="JSON results to compare against")
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help="p95 slowdown that counts as a regression")
+    args = parser.parse_args()
+
+    # the app connects to DATABASE_URL when it's imported
+    os.environ['DATABASE_URL'] = os.environ.get('BENCHMARK_DATABASE_URL',
+                                                'postgresql:///warbler-bench')
+    from app import app
+    from models import db
+
+    if not args.reuse:
+        generate_and_seed(args)
+
+    subjects = pick_subjects()
+    db.session.remove()
+    routes = benchmark_routes(subjects)
+    samples = run(app, db.engine, routes, subjects['viewer'],
+                  args.requests, args.warmup)
+
+    results = {
+        'meta': {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'database': db.engine.dialect.name,
+            'timeline_fanout': app.config['TIMELINE_FANOUT'],
+            'dataset': dict(users=args.users, messages=args.messages,
+                            follows=args.follows, likes=args.likes,
+                            seed=args.seed, reused=args.reuse),
+            'subjects': subjects,
+        },
+        'routes': {name: summarize(samples[name]) for name, method, url in routes},
+    }
+
+    print(f"{'route':<14}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'queries':>9}{'rows':>9}")
+    for name, stats in results['routes'].items():
+        print(f"{name:<14}{stats['p50_ms']:>9.2f}{stats['p95_ms']:>9.2f}"
+              f"{stats['p99_ms']:>9.2f}{stats['queries']:>9g}{stats['rows']:>9g}")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results['routes'], baseline['routes'], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"no regressions against {args.baseline}")
+
+
+if __name__ == '__main__':
+    main()
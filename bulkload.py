@@ -0,0 +1,162 @@
+"""Bulk loading of CSV files into Warbler's tables (used by seed.py).
+
+Files are streamed in fixed-size chunks, so memory use stays flat however
+big they are. On Postgres each chunk goes in with COPY FROM STDIN; other
+databases get one batched executemany INSERT per chunk.
+
+The first line of each CSV names the columns it fills; anything it leaves
+out gets the column's server default. Empty fields load as NULL.
+"""
+
+import csv
+import io
+import re
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import islice
+
+from models import SEARCH_INDEX_DDL, TRIGRAM_INDEX_DDL, trigrams_available
+
+DEFAULT_CHUNK_SIZE = 10000
+
+
+class LoadStats:
+    """How a load went: rows written and the time it took."""
+
+    def __init__(self, table, rows, seconds):
+        self.table = table
+        self.rows = rows
+        self.seconds = seconds
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0
+
+    def __str__(self):
+        return (f"{self.table}: {self.rows:,} rows in {self.seconds:.1f}s "
+                f"({self.rows_per_second:,.0f} rows/s)")
+
+
+def chunks(rows, size):
+    """Split an iterator of rows into lists of at most `size` rows."""
+
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def load_csv(engine, table, path, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """Stream the CSV file at `path` into `table`; return LoadStats.
+
+    The whole file loads in one transaction. `progress`, if given, is
+    called with the running LoadStats after every chunk.
+    """
+
+    if engine.dialect.name == 'postgresql':
+        write = _copy_chunk
+    else:
+        write = _insert_chunk
+
+    start = time.perf_counter()
+    loaded = 0
+
+    with open(path, newline='') as f, engine.begin() as conn:
+        reader = csv.reader(f)
+        columns = next(reader)
+
+        for chunk in chunks(reader, chunk_size):
+            write(conn, table, columns, chunk)
+            loaded += len(chunk)
+            if progress:
+                progress(LoadStats(table.name, loaded, time.perf_counter() - start))
+
+    return LoadStats(table.name, loaded, time.perf_counter() - start)
+
+
+def _copy_chunk(conn, table, columns, rows):
+    """COPY rows (lists of CSV fields) into `table` on Postgres."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    quote = conn.dialect.identifier_preparer.quote
+    statement = (f"COPY {quote(table.name)} ({', '.join(map(quote, columns))}) "
+                 "FROM STDIN WITH (FORMAT csv)")
+
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(statement, buffer)
+    finally:
+        cursor.close()
+
+
+def _insert_chunk(conn, table, columns, rows):
+    """INSERT rows into `table` in one executemany."""
+
+    convert = [_converter(table.c[name]) for name in columns]
+    conn.execute(table.insert(), [
+        {name: fn(value) if value != '' else None
+         for name, fn, value in zip(columns, convert, row)}
+        for row in rows
+    ])
+
+
+def _converter(column):
+    # COPY parses the text itself; executemany needs Python values
+    # (SQLite in particular won't take strings for DateTime columns)
+    python_type = column.type.python_type
+    if python_type is datetime:
+        return datetime.fromisoformat
+    if python_type is int:
+        return int
+    return str
+
+
+@contextmanager
+def indexes_deferred(engine, tables):
+    """Drop the secondary indexes on `tables` for the duration of the block.
+
+    Maintaining an index row by row is much slower than building it once
+    over the loaded data, so bulk loads go inside this and the indexes are
+    rebuilt on the way out. Primary keys and unique constraints stay, since
+    they're what keeps the loaded data valid.
+    """
+
+    indexes = [index for table in tables for index in table.indexes]
+    with engine.begin() as conn:
+        raw_indexes = [statement for table in tables
+                       for statement in _raw_index_ddl(conn, table.name)]
+
+        for index in indexes:
+            index.drop(conn)
+        for statement in raw_indexes:
+            conn.execute(f"DROP INDEX IF EXISTS {_index_name(statement)}")
+
+    yield
+
+    with engine.begin() as conn:
+        for index in indexes:
+            index.create(conn)
+        for statement in raw_indexes:
+            conn.execute(statement)
+
+
+def _raw_index_ddl(conn, table_name):
+    """The Postgres-only search indexes models.py creates for this table."""
+
+    if conn.dialect.name != 'postgresql':
+        return []
+
+    statements = list(SEARCH_INDEX_DDL.get(table_name, []))
+    if trigrams_available(conn):
+        statements.extend(TRIGRAM_INDEX_DDL.get(table_name, []))
+    return statements
+
+
+def _index_name(statement):
+    return re.search(r'INDEX IF NOT EXISTS (\w+)', statement).group(1)
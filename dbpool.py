@@ -0,0 +1,177 @@
+"""Database connection pool settings and health metrics.
+
+Each worker process keeps its own pool. Without limits, a burst of new
+workers (or of traffic) opens connections faster than Postgres likes, so the
+pool is sized and tuned from the environment (see app.py):
+
+- DATABASE_POOL_SIZE connections are kept open, plus up to
+  DATABASE_MAX_OVERFLOW more under load;
+- a request waits DATABASE_POOL_TIMEOUT seconds for a free connection
+  before giving up;
+- connections are replaced after DATABASE_POOL_RECYCLE seconds, before
+  firewalls or Postgres time them out, and DATABASE_POOL_PRE_PING tests
+  each one as it's checked out, so a dropped connection costs a retry
+  rather than a failed request.
+
+With DATABASE_PGBOUNCER=1 the app expects a PgBouncer in transaction
+pooling mode in front of Postgres. PgBouncer does the pooling then, so
+the app opens a connection per checkout and never holds one between
+transactions (NullPool). Nothing may rely on session state in that mode:
+no SET, no session advisory locks, no LISTEN.
+
+pool_stats counts the checkouts, waits and timeouts of the app's own pool
+(not the replicas' or any other engine's); its gauges are added to /metrics
+(instrumentation.py).
+"""
+
+import time
+from threading import Lock
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc
+from sqlalchemy.pool import NullPool, QueuePool
+
+from instrumentation import Histogram
+
+WAIT_BUCKETS = (.0001, .001, .005, .01, .05, .1, .5, 1, 5, 10, 30)
+
+
+def pool_options(config, sa_url):
+    """create_engine() pool options for the database at `sa_url`."""
+
+    if sa_url.drivername.startswith('sqlite'):
+        # SQLite's pools are chosen by Flask-SQLAlchemy and take no sizes
+        return {}
+
+    if config.get('DATABASE_PGBOUNCER'):
+        return {'poolclass': NullPool}
+
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_size': config.get('DATABASE_POOL_SIZE', 5),
+        'max_overflow': config.get('DATABASE_MAX_OVERFLOW', 10),
+        'pool_timeout': config.get('DATABASE_POOL_TIMEOUT', 30),
+        'pool_recycle': config.get('DATABASE_POOL_RECYCLE', 1800),
+        'pool_pre_ping': config.get('DATABASE_POOL_PRE_PING', True),
+    }
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, with the engine's pool set up by pool_options()."""
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        # options is updated in place; newer Flask-SQLAlchemy versions also
+        # want (sa_url, options) back, which super() returns
+        result = super().apply_driver_hacks(app, sa_url, options)
+        options.update(pool_options(app.config, sa_url))
+        return result
+
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool that records how long each checkout waits in its
+    PoolStats, if it has one (see PoolStats.listen)."""
+
+    stats = None
+
+    def recreate(self):
+        # engine.dispose() swaps in a new pool; the event listeners carry
+        # over, and so must this
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+    def _do_get(self):
+        if self.stats is None:
+            return super()._do_get()
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.stats.timed_out()
+            raise
+        finally:
+            self.stats.waited(time.perf_counter() - started)
+
+
+class PoolStats:
+    """Counts of what one pool has been doing, once listen()ing to it."""
+
+    def __init__(self):
+        self._lock = Lock()
+        # a gauge: not reset, connections checked out now will come back
+        self.in_use = 0
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.opened = 0
+            self.timeouts = 0
+            self.wait = Histogram(WAIT_BUCKETS)
+
+    def waited(self, seconds):
+        with self._lock:
+            self.wait.observe(seconds)
+
+    def timed_out(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def _connected(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.opened += 1
+
+    def _checked_out(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self.in_use += 1
+
+    def _checked_in(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.in_use -= 1
+
+    def listen(self, pool):
+        event.listen(pool, 'connect', self._connected)
+        event.listen(pool, 'checkout', self._checked_out)
+        event.listen(pool, 'checkin', self._checked_in)
+        if isinstance(pool, TimedQueuePool):
+            pool.stats = self
+
+    def collector(self, get_pool):
+        """A /metrics collector for these stats and the pool `get_pool()`."""
+
+        def collect():
+            pool = get_pool()
+            with self._lock:
+                lines = [
+                    "# HELP warbler_db_pool_in_use Connections checked out right now.",
+                    "# TYPE warbler_db_pool_in_use gauge",
+                    f"warbler_db_pool_in_use {self.in_use}",
+                    "# HELP warbler_db_connections_opened_total New database connections.",
+                    "# TYPE warbler_db_connections_opened_total counter",
+                    f"warbler_db_connections_opened_total {self.opened}",
+                    "# HELP warbler_db_pool_timeouts_total Checkouts that gave up waiting.",
+                    "# TYPE warbler_db_pool_timeouts_total counter",
+                    f"warbler_db_pool_timeouts_total {self.timeouts}",
+                    "# HELP warbler_db_pool_checkout_wait_seconds Time waited for a connection.",
+                    "# TYPE warbler_db_pool_checkout_wait_seconds histogram",
+                ]
+                lines.extend(self.wait.lines('warbler_db_pool_checkout_wait_seconds'))
+
+            if isinstance(pool, QueuePool):
+                lines.extend([
+                    "# HELP warbler_db_pool_size Connections the pool keeps open.",
+                    "# TYPE warbler_db_pool_size gauge",
+                    f"warbler_db_pool_size {pool.size()}",
+                    "# HELP warbler_db_pool_idle Open connections waiting to be used.",
+                    "# TYPE warbler_db_pool_idle gauge",
+                    f"warbler_db_pool_idle {pool.checkedin()}",
+                    "# HELP warbler_db_pool_overflow Connections open beyond the pool size.",
+                    "# TYPE warbler_db_pool_overflow gauge",
+                    f"warbler_db_pool_overflow {max(pool.overflow(), 0)}",
+                ])
+            return lines
+
+        return collect
+
+
+# the app's pool; app.py listens to it
+pool_stats = PoolStats()
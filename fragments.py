@@ -0,0 +1,150 @@
+"""Cache of rendered message and user cards.
+
+Pages full of cards spend most of their time in Jinja, re-rendering markup
+that hardly ever changes. Templates call message_card(message) and
+user_card(user) instead of rendering the card inline; each card is looked
+up by (card template, id) and used if its version still matches:
+
+- a message can't be edited, so its card's version is its author's
+  profile version;
+- a user card's version is the user's profile version, a hash of the
+  profile fields the card shows.
+
+The only per-viewer part of a card is its like or follow button, so that
+state is part of the key too: a card has at most three versions (pressed,
+not pressed, no button), which are shared by every viewer.
+
+Cards live in an in-process LRU (FRAGMENT_CACHE_SIZE entries, each kept at
+most FRAGMENT_CACHE_TTL seconds; a size of 0 turns caching off). Set
+FRAGMENT_CACHE_URL to a redis:// URL to share them between workers instead
+(needs the redis package). Versions keep either kind from serving stale
+cards; the views also forget cards explicitly when profiles or messages
+change or go away, to free the space.
+"""
+
+import hashlib
+import json
+
+from flask import current_app, g
+from markupsafe import Markup
+
+from caching import TTLCache
+
+MESSAGE_CARD = 'messages/card.html'
+PROFILE_MESSAGE_CARD = 'messages/profile_card.html'
+USER_CARD = 'users/card.html'
+
+MESSAGE_CARDS = [MESSAGE_CARD, PROFILE_MESSAGE_CARD]
+USER_CARDS = [USER_CARD]
+
+# the states a card's button can be in; None means no button
+BUTTON_STATES = [None, True, False]
+
+# the profile fields each kind of card shows; user cards stick to the
+# columns the user directory loads
+PROFILE_FIELDS = ['username', 'image_url', 'header_image_url', 'bio', 'location']
+USER_CARD_FIELDS = ['username', 'image_url', 'header_image_url', 'bio']
+
+
+def profile_version(user, fields=PROFILE_FIELDS):
+    """Version of what cards show about `user`: changes when they edit it."""
+
+    fields = [getattr(user, name) for name in fields]
+    return hashlib.sha1(json.dumps([user.id] + fields).encode()).hexdigest()
+
+
+class RedisBackend:
+    """Cards kept in Redis, shared by every worker.
+
+    Same interface as TTLCache; entries expire after `ttl` seconds and
+    Redis' own maxmemory policy does the LRU eviction.
+    """
+
+    def __init__(self, url, ttl, prefix='warbler:fragment:'):
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key, default=None):
+        value = self.redis.get(self.prefix + key)
+        return json.loads(value) if value is not None else default
+
+    def set(self, key, value):
+        self.redis.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+    def delete(self, *keys):
+        if keys:
+            self.redis.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        for key in self.redis.scan_iter(self.prefix + '*'):
+            self.redis.delete(key)
+
+
+class FragmentCache:
+    """Renders cards through a cache; see the module docs."""
+
+    def __init__(self, app=None):
+        self.backend = TTLCache(maxsize=0)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        url = app.config.get('FRAGMENT_CACHE_URL')
+        ttl = app.config.get('FRAGMENT_CACHE_TTL', 3600)
+        if url:
+            self.backend = RedisBackend(url, ttl)
+        else:
+            self.backend = TTLCache(maxsize=app.config.get('FRAGMENT_CACHE_SIZE', 10000),
+                                    ttl=ttl)
+
+        app.jinja_env.globals.update(message_card=self.message_card,
+                                     user_card=self.user_card)
+
+    def render(self, template, id, version, state, **context):
+        """`template` rendered with `context`, from the cache if it's current."""
+
+        key = f"{template}:{id}:{state}"
+        cached = self.backend.get(key)
+        if cached is not None and cached[0] == version:
+            return Markup(cached[1])
+
+        # straight from Jinja: cards don't need Flask's context processors,
+        # and skipping them keeps misses cheap
+        html = current_app.jinja_env.get_template(template).render(**context)
+        self.backend.set(key, [version, html])
+        return Markup(html)
+
+    def message_card(self, message, liked_ids=None, template=MESSAGE_CARD):
+        """A message's card, with a like button if given the viewer's
+        `liked_ids` (and there is a viewer)."""
+
+        liked = None if liked_ids is None or not g.user else message.id in liked_ids
+        return self.render(template, message.id, profile_version(message.user), liked,
+                           message=message, liked=liked)
+
+    def user_card(self, user, following_ids=None):
+        """A user's card, with a follow button if given the ids the viewer
+        follows (and the viewer isn't `user`)."""
+
+        following = None
+        if following_ids is not None and g.user and g.user.id != user.id:
+            following = user.id in following_ids
+        return self.render(USER_CARD, user.id, profile_version(user, USER_CARD_FIELDS),
+                           following, user=user, following=following)
+
+    def forget_messages(self, *message_ids):
+        self.backend.delete(*[f"{template}:{id}:{state}" for template in MESSAGE_CARDS
+                              for id in message_ids for state in BUTTON_STATES])
+
+    def forget_users(self, *user_ids):
+        self.backend.delete(*[f"{template}:{id}:{state}" for template in USER_CARDS
+                              for id in user_ids for state in BUTTON_STATES])
+
+    def clear(self):
+        self.backend.clear()
+
+
+fragment_cache = FragmentCache()
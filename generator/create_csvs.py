@@ -2,29 +2,48 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows:
+
+    python generator/create_csvs.py --users 100000 --messages 10000000 \\
+        --follows 5000000 --workers 8
+
+Activity is skewed the way real social networks are: follower counts,
+posting and liking follow power laws (--*-skew are the Zipf exponents; 0
+is uniform) and posts bunch up into bursts. The most followed accounts
+post the most, too.
+
+Everything is generated offline, and the same --seed (and --until) always
+gives the same files, whatever --workers is. Each table is made in parts of
+--part-rows rows on a process pool; CSV parts are stitched together in
+order, Parquet parts (--format parquet, needs pyarrow) are left as a
+directory of files.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
 from faker import Faker
-from helpers import get_random_datetime
+from helpers import (AffinePermutation, BurstyClock, PowerLawDegrees, Zipf,
+                     header_image_url, part_rng)
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+# every user's password is "password"
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-fake = Faker()
+NUM_HEADER_IMAGES = 45
 
-# Generate random profile image URLs to use for users
+# Random profile image URLs to use for users
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +51,247 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
+##############################################################################
+# Row generators: each makes the rows numbered [start, stop) of one table
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
+def user_rows(config, start, stop, rng, fake):
+    for i in range(start, stop):
+        # the row number keeps usernames and emails unique at any size
+        username = f"{fake.user_name()}{i + 1}"
+        yield dict(
+            email=f"{username}@{fake.free_email_domain()}",
+            username=username,
+            image_url=rng.choice(image_urls),
+            password=PASSWORD_HASH,
             bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
+            header_image_url=header_image_url(rng.randrange(NUM_HEADER_IMAGES)),
+            location=fake.city(),
+        )
 
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
 
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
+def message_rows(config, start, stop, rng, fake):
+    for i in range(start, stop):
+        yield dict(
             text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
+            timestamp=config['clock'](rng),
+            user_id=user_at_rank(config, config['posting'].sample(rng)),
+        )
+
+
+def follow_rows(config, start, stop, rng, fake):
+    # [start, stop) are popularity ranks; each gets its share of followers,
+    # picked without repeats from everyone else
+    others = config['users'] - 1
+    for rank in range(start + 1, stop + 1):
+        followed = user_at_rank(config, rank)
+        followers = AffinePermutation(others, rng)
+        for j in range(config['followers'].degree(rank, rng)):
+            follower = followers[j] + 1
+            if follower >= followed:
+                follower += 1
+            yield dict(user_being_followed_id=followed, user_following_id=follower)
+
+
+def like_rows(config, start, stop, rng, fake):
+    # [start, stop) are activity ranks; each liker gets a number of likes,
+    # spread without repeats over all messages
+    for rank in range(start + 1, stop + 1):
+        liker = user_at_rank(config, rank)
+        messages = AffinePermutation(config['messages'], rng)
+        for j in range(config['likers'].degree(rank, rng)):
+            yield dict(user_id=liker, message_id=messages[j] + 1)
+
+
+def user_at_rank(config, rank):
+    """Id of the user with popularity `rank` (1 is the most popular).
+
+    Ranks are scattered over the ids so celebrities aren't all the oldest
+    accounts.
+    """
+
+    return config['ranking'][rank - 1] + 1
+
+
+TABLES = {
+    'users': (USERS_CSV_HEADERS, user_rows),
+    'messages': (MESSAGES_CSV_HEADERS, message_rows),
+    'follows': (FOLLOWS_CSV_HEADERS, follow_rows),
+    'likes': (LIKES_CSV_HEADERS, like_rows),
+}
+
+# follows and likes are generated per user rank rather than per row
+PER_USER_TABLES = {'follows', 'likes'}
+
+
+##############################################################################
+# Writing parts
+
+
+def parts_dir(out_dir, table, fmt):
+    # CSV parts are temporary; Parquet parts are the output, one dataset
+    # directory per table
+    return os.path.join(out_dir, f"{table}.parts" if fmt == 'csv' else f"{table}.parquet")
+
+
+def part_path(out_dir, table, part, fmt):
+    return os.path.join(parts_dir(out_dir, table, fmt), f"part-{part:05d}.{fmt}")
+
+
+def write_part(config, table, part, start, stop):
+    """Generate rows [start, stop) of `table` into their own part file."""
+
+    headers, make_rows = TABLES[table]
+    rng = part_rng(config['seed'], table, part)
+    fake = Faker()
+    fake.seed_instance(rng.getrandbits(64))
+
+    rows = Counted(make_rows(config, start, stop, rng, fake))
+    path = part_path(config['out'], table, part, config['format'])
+
+    if config['format'] == 'parquet':
+        write_parquet(path, headers, rows)
+    else:
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=headers)
+            writer.writerows(rows)
+
+    return rows.written
+
+
+class Counted:
+    """Wraps an iterator, counting the items taken from it."""
+
+    def __init__(self, items):
+        self.items = iter(items)
+        self.written = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = next(self.items)
+        self.written += 1
+        return item
+
+
+def write_parquet(path, headers, rows):
+    import pyarrow
+    import pyarrow.parquet
+
+    columns = {name: [] for name in headers}
+    for row in rows:
+        for name in headers:
+            columns[name].append(row[name])
+    pyarrow.parquet.write_table(pyarrow.table(columns), path)
+
+
+def stitch_csv(out_dir, table, num_parts):
+    """Concatenate a table's CSV parts, in order, under one header row."""
+
+    headers = TABLES[table][0]
+
+    with open(os.path.join(out_dir, f"{table}.csv"), 'w', newline='') as out:
+        csv.DictWriter(out, fieldnames=headers).writeheader()
+        for part in range(num_parts):
+            with open(part_path(out_dir, table, part, 'csv'), newline='') as f:
+                shutil.copyfileobj(f, out)
+
+    shutil.rmtree(parts_dir(out_dir, table, 'csv'))
+
+
+def generate(config, counts, part_rows, workers):
+    """Write every table, splitting the work over `workers` processes."""
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for table, count in counts.items():
+            started = datetime.now()
+            directory = parts_dir(config['out'], table, config['format'])
+            shutil.rmtree(directory, ignore_errors=True)
+            os.makedirs(directory)
+
+            if table in PER_USER_TABLES:
+                # split by user rank, aiming for about part_rows rows a part
+                units = config['users']
+                step = max(1, part_rows * units // max(count, 1))
+            else:
+                units, step = count, part_rows
+
+            ranges = [(start, min(start + step, units))
+                      for start in range(0, units, step)]
+            jobs = [pool.submit(write_part, config, table, part, start, stop)
+                    for part, (start, stop) in enumerate(ranges)]
+            written = sum(job.result() for job in jobs)
+
+            if config['format'] == 'csv':
+                stitch_csv(config['out'], table, len(ranges))
+
+            seconds = (datetime.now() - started).total_seconds()
+            print(f"{table}: {written:,} rows in {seconds:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--follows', type=int, default=5000,
+                        help="about how many follows to make")
+    parser.add_argument('--likes', type=int, default=5000,
+                        help="about how many likes to make")
+    parser.add_argument('--follower-skew', type=float, default=1.0)
+    parser.add_argument('--posting-skew', type=float, default=1.0)
+    parser.add_argument('--likes-skew', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--until', type=datetime.fromisoformat,
+                        default=datetime.utcnow().replace(hour=0, minute=0,
+                                                          second=0, microsecond=0),
+                        help="latest message timestamp, in UTC unless it has an "
+                             "offset (default: today)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--part-rows', type=int, default=100000,
+                        help="rows per part file (and per unit of work)")
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('--out', default='generator',
+                        help="output directory (default: generator)")
+    args = parser.parse_args()
+
+    if args.users < 2:
+        parser.error("need at least 2 users")
+    if args.messages < 1 and args.likes:
+        parser.error("can't make likes without messages")
+    max_follows = args.users * (args.users - 1)
+    if args.follows > max_follows:
+        parser.error(f"{args.users} users can only make {max_follows} follows")
+    if args.likes > args.users * args.messages:
+        parser.error("more likes than user/message pairs")
+
+    if args.format == 'parquet':
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError:
+            sys.exit("Parquet output needs pyarrow: pip install pyarrow")
 
-# Generate follows.csv from random pairings of users
+    config = dict(
+        seed=args.seed,
+        users=args.users,
+        messages=args.messages,
+        format=args.format,
+        out=args.out,
+        ranking=AffinePermutation(args.users, part_rng(args.seed, 'ranking')),
+        posting=Zipf(args.users, args.posting_skew),
+        followers=PowerLawDegrees(args.users, args.follower_skew,
+                                  args.follows, cap=args.users - 1),
+        likers=PowerLawDegrees(args.users, args.likes_skew,
+                               args.likes, cap=args.messages),
+        clock=BurstyClock(args.seed, args.until,
+                          bursts=max(1, args.messages // 50)),
+    )
+    counts = dict(users=args.users, messages=args.messages,
+                  follows=args.follows, likes=args.likes)
 
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
+    generate(config, counts, args.part_rows, args.workers)
 
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main()
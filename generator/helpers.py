@@ -1,14 +1,175 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+import random
+from datetime import datetime, timedelta, timezone
+from math import gcd, log
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def part_rng(seed, *key):
+    """A Random for one piece of the output, determined by `seed` and `key`.
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    Every part of every file gets its own stream, so the output is the same
+    however the parts are spread over worker processes.
+    """
 
-    return datetime.fromtimestamp(random_timestamp)
+    return random.Random(":".join(str(k) for k in (seed,) + key))
+
+
+class AffinePermutation:
+    """A pseudo-random ordering of range(n) that's never materialized.
+
+    Maps i to (a * i + c) mod n, which visits every number below n exactly
+    once when a and n are coprime. Taking the first k positions samples k
+    distinct numbers in O(1) memory, e.g. follow pairs out of the n*(n-1)
+    possible ones. It's nowhere near cryptographically random, but it's
+    plenty for test data.
+    """
+
+    def __init__(self, n, rng=random):
+        self.n = n
+        if n <= 1:
+            self.a, self.c = 1, 0
+            return
+
+        self.c = rng.randrange(n)
+        while True:
+            self.a = rng.randrange(1, n)
+            if gcd(self.a, n) == 1:
+                break
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.n:
+            raise IndexError(i)
+        return (self.a * i + self.c) % self.n
+
+    def __len__(self):
+        return self.n
+
+
+def header_image_url(n):
+    """A header image URL; only a string, nothing is fetched."""
+
+    return f"https://picsum.photos/seed/warbler{n}/1280/400"
+
+
+class Zipf:
+    """Ranks 1..n drawn with probability proportional to 1 / rank**s.
+
+    Uses the inverse CDF of the continuous version of the distribution, so
+    each draw is O(1) time and memory however big n is. s=0 is uniform;
+    around 1 gives the usual "few huge, most tiny" skew.
+    """
+
+    def __init__(self, n, s=1.0):
+        self.n = n
+        self.s = s
+
+    def sample(self, rng):
+        u = rng.random()
+        if self.s == 1:
+            x = (self.n + 1) ** u
+        else:
+            t = 1 - self.s
+            x = (((self.n + 1) ** t - 1) * u + 1) ** (1 / t)
+        return min(int(x), self.n)
+
+    def mass(self, first, last):
+        """Approximate sum of 1 / rank**s for ranks first..last."""
+
+        if last < first:
+            return 0
+        # integral over [first - 1/2, last + 1/2]: close even for small ranks
+        low, high = first - 0.5, last + 0.5
+        if self.s == 1:
+            return log(high / low)
+        t = 1 - self.s
+        return (high ** t - low ** t) / t
+
+
+class PowerLawDegrees:
+    """How many edges each rank gets so they total about `total`.
+
+    Rank r gets scale / r**s edges, but never more than `cap` (a user can
+    only follow or be followed by everyone else once). The scale is found
+    by bisection on the approximate total, without a per-rank table.
+    """
+
+    def __init__(self, n, s, total, cap):
+        self.zipf = Zipf(n, s)
+        self.cap = cap
+
+        if total >= cap * n:
+            # everyone is connected to everyone
+            self.scale = float('inf')
+            return
+
+        low, high = 0.0, 1.0
+        while self._total(high) < total:
+            high *= 2
+        for _ in range(60):
+            mid = (low + high) / 2
+            if self._total(mid) < total:
+                low = mid
+            else:
+                high = mid
+        self.scale = high
+
+    def _expected(self, rank, scale):
+        return min(self.cap, scale / rank ** self.zipf.s)
+
+    def _total(self, scale):
+        n, s = self.zipf.n, self.zipf.s
+
+        # ranks up to `capped` hit the cap; the rest follow the power law
+        if s == 0:
+            capped = n if scale >= self.cap else 0
+        else:
+            capped = min(n, int((scale / self.cap) ** (1 / s)))
+        return self.cap * capped + scale * self.zipf.mass(capped + 1, n)
+
+    def degree(self, rank, rng):
+        """Edges for `rank`, rounded up or down at random to keep the total."""
+
+        expected = self._expected(rank, self.scale)
+        whole = int(expected)
+        return whole + (rng.random() < expected - whole)
+
+
+class BurstyClock:
+    """Timestamps that bunch up into bursts of activity.
+
+    There are `bursts` burst start times spread over the `year_gap` years
+    (of 365 days) before `until`, the busiest few drawing far more posts than the rest
+    (Zipf again). A post lands an exponentially distributed time after its
+    burst starts (`burst_hours` on average), and times in the small hours
+    are mostly redrawn, for a daily rhythm.
+
+    Times are naive UTC, as is `until` unless it says otherwise, so the
+    output doesn't depend on the machine's timezone.
+    """
+
+    # relative activity by hour of day
+    HOURLY_ACTIVITY = [3, 2, 1, 1, 1, 2, 4, 6, 7, 7, 7, 8,
+                       9, 8, 7, 7, 8, 9, 10, 10, 10, 9, 7, 5]
+
+    def __init__(self, seed, until, year_gap=2, bursts=1000, burst_hours=6):
+        self.seed = seed
+        if until.tzinfo is None:
+            until = until.replace(tzinfo=timezone.utc)
+        self.end = until.timestamp()
+        self.start = (until - timedelta(days=365 * year_gap)).timestamp()
+        self.popularity = Zipf(bursts, 1.0)
+        self.mean_offset = burst_hours * 3600
+        self.busiest_hour = max(self.HOURLY_ACTIVITY)
+
+    def burst_start(self, burst):
+        # worked out from the seed each time, so every worker agrees
+        return part_rng(self.seed, 'burst', burst).uniform(self.start, self.end)
+
+    def __call__(self, rng):
+        while True:
+            start = self.burst_start(self.popularity.sample(rng))
+            when = datetime.utcfromtimestamp(
+                min(self.end, start + rng.expovariate(1 / self.mean_offset)))
+            if rng.random() * self.busiest_hour < self.HOURLY_ACTIVITY[when.hour]:
+                return when
@@ -0,0 +1,77 @@
+"""HTTP caching: ETags for pages, long-lived caching for static files.
+
+Pages that show a user's timeline or profile get an ETag made from the
+versions of everything on them: the rows of the users shown (their
+counters change with every message, follow and like), the ids of the
+messages on the page, and the viewer's own like/follow state. When a
+browser revalidates with a matching If-None-Match, the view answers 304
+without rendering the template.
+
+Static files are linked as /static/<file>?v=<hash of its contents> (see
+static_url()), so a changed file gets a new URL and the old one can be
+cached forever. Only the current hash earns that; see app.add_header.
+"""
+
+import hashlib
+import os
+
+from flask import current_app, make_response, request, session, url_for
+from werkzeug.security import safe_join
+
+
+def user_version(user):
+    """The values of `user`'s row that can show up on a page, or None."""
+
+    if user is None:
+        return None
+    return sorted(user.cache_record().items())
+
+
+def etag(*parts):
+    """An ETag for a page built from `parts` (anything with a stable repr)."""
+
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def conditional(tag, render):
+    """Answer 304 if the client has the page tagged `tag`, else `render()` it.
+
+    Pages that are about to show flashed messages are never made
+    conditional: the flash is one-off, so a cached copy mustn't keep it.
+    """
+
+    if session.get('_flashes'):
+        return make_response(render())
+
+    if tag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(tag)
+    # keep a copy, but check it's current before every use; it's per-viewer
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+_static_hashes = {}
+
+
+def static_fingerprint(filename):
+    """A hash of a static file's contents, or None if there's no such file."""
+
+    path = safe_join(current_app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        return None
+    mtime = os.path.getmtime(path)
+
+    cached = _static_hashes.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as f:
+            cached = _static_hashes[path] = (mtime, hashlib.md5(f.read()).hexdigest()[:12])
+    return cached[1]
+
+
+def static_url(filename):
+    """URL of a static file with a fingerprint of its contents in it."""
+
+    return url_for('static', filename=filename, v=static_fingerprint(filename))
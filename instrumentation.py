@@ -0,0 +1,320 @@
+"""Measuring what the database does.
+
+count_queries() records a block of code, for the tests (to pin down query
+counts) and the benchmarks. RequestProfiler profiles every request in a
+running app and serves the totals at /metrics.
+"""
+
+import hashlib
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from threading import Lock
+
+from flask import (Response, abort, before_render_template, current_app, g,
+                   has_request_context, request, request_finished, request_started,
+                   template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryLog(list):
+    """The SQL statements run while recording, plus totals.
+
+    It's a list of the statements themselves, so `len(log)` is the number
+    of queries. `rows` counts the rows the statements returned and
+    `seconds` the time spent waiting on the database.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.rows = 0
+        self.seconds = 0.0
+
+
+@contextmanager
+def count_queries(engine):
+    """Record every statement run on `engine` inside the block."""
+
+    log = QueryLog()
+    started = []
+
+    def before(conn, cursor, statement, parameters, context, executemany):
+        log.append(statement)
+        started.append(time.perf_counter())
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        log.seconds += time.perf_counter() - started.pop()
+        # rowcount is the number of rows a SELECT fetched on psycopg2; some
+        # drivers (sqlite3) don't know it and say -1
+        if cursor.description is not None and cursor.rowcount > 0:
+            log.rows += cursor.rowcount
+
+    event.listen(engine, "before_cursor_execute", before)
+    event.listen(engine, "after_cursor_execute", after)
+    try:
+        yield log
+    finally:
+        event.remove(engine, "before_cursor_execute", before)
+        event.remove(engine, "after_cursor_execute", after)
+
+
+##############################################################################
+# Per-request profiling, for production
+
+
+def fingerprint(statement):
+    """`statement` with its parameters and IN lists blanked out.
+
+    Statements that only differ in their values get the same fingerprint,
+    so an N+1 shows up as one fingerprint run N times.
+    """
+
+    sql = _PARAMETERS.sub('?', statement)
+    sql = _IN_LISTS.sub('IN (...)', sql)
+    return ' '.join(sql.split())
+
+
+_PARAMETERS = re.compile(r"%\(\w+\)s|%s|\?|(?<!:):\w+|'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+
+
+def fingerprint_id(fingerprint):
+    """A short, stable name for a fingerprint, to grep logs by."""
+
+    return hashlib.md5(fingerprint.encode()).hexdigest()[:8]
+
+
+class RequestProfile:
+    """What one request did: its SQL, and the time spent rendering."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.slowest = (0.0, None)
+        self.render_seconds = 0.0
+        self.render_started = None
+        # templates render templates (see fragments.py); only time the outer one
+        self.render_depth = 0
+        self.fingerprints = Counter()
+
+    def record_query(self, statement, seconds):
+        self.queries += 1
+        self.db_seconds += seconds
+        self.fingerprints[fingerprint(statement)] += 1
+        if seconds >= self.slowest[0]:
+            self.slowest = (seconds, statement)
+
+
+class Histogram:
+    """A Prometheus histogram: cumulative bucket counts, sum and count."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def lines(self, name, labels=''):
+        """This histogram's samples in the text format, as metric `name`."""
+
+        prefix = f"{labels}," if labels else ""
+        lines = [f'{name}_bucket{{{prefix}le="{bound:g}"}} {count}'
+                 for bound, count in zip(self.buckets, self.counts)]
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {self.count}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f'{name}_sum{suffix} {self.sum:.6f}')
+        lines.append(f'{name}_count{suffix} {self.count}')
+        return lines
+
+
+SECONDS_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+# name: (help, buckets)
+HISTOGRAMS = {
+    'warbler_request_duration_seconds': ("Time to handle a request.", SECONDS_BUCKETS),
+    'warbler_request_db_seconds': ("Time a request spent waiting on SQL.", SECONDS_BUCKETS),
+    'warbler_request_render_seconds': ("Time a request spent rendering templates.",
+                                       SECONDS_BUCKETS),
+    'warbler_request_queries': ("SQL statements run by a request.", QUERY_BUCKETS),
+    'warbler_request_slowest_query_seconds': ("A request's slowest SQL statement.",
+                                              SECONDS_BUCKETS),
+}
+
+
+class RequestProfiler:
+    """Profiles every request, cheaply enough to leave on in production.
+
+    Engine events count each statement and its time, Flask's signals time
+    the request and its template rendering, and the totals go into
+    per-endpoint histograms served at /metrics (Prometheus text format).
+    Requests slower than SLOW_REQUEST_MS are logged with the fingerprints
+    of their statements.
+
+    /metrics is off (a 404) unless METRICS_ENABLED is set, and then isn't
+    meant for the public: block it at the proxy. The metrics live in the
+    worker process: with several workers, each one's /metrics covers only
+    the requests it served, so scrape them individually (or run one worker
+    per metrics port).
+    """
+
+    def __init__(self, app=None):
+        self._lock = Lock()
+        # callables adding more lines to /metrics, e.g. dbpool's gauges
+        self.collectors = []
+        self.reset()
+        if app is not None:
+            self.init_app(app)
+
+    def reset(self):
+        with self._lock:
+            # (endpoint, method, status): count
+            self.requests = Counter()
+            # (metric name, endpoint): Histogram
+            self.histograms = {}
+
+    def init_app(self, app):
+        self.slow_request_ms = app.config.get('SLOW_REQUEST_MS', 0)
+        self.logger = app.logger
+
+        # every engine, so binds and engines made later are covered too
+        event.listen(Engine, "before_cursor_execute", _query_started)
+        event.listen(Engine, "after_cursor_execute", self._query_finished)
+
+        request_started.connect(self._request_started, app)
+        before_render_template.connect(self._render_started, app)
+        template_rendered.connect(self._render_finished, app)
+        request_finished.connect(self._request_finished, app)
+
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+
+    @staticmethod
+    def current():
+        """The profile of the request in progress, if there is one."""
+
+        if not has_request_context():
+            return None
+        return g.get('request_profile')
+
+    def _request_started(self, app, **extra):
+        g.request_profile = RequestProfile()
+
+    def _query_finished(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop('query_started', None)
+        profile = self.current()
+        if started is not None and profile is not None:
+            profile.record_query(statement, time.perf_counter() - started)
+
+    def _render_started(self, app, template, context, **extra):
+        profile = self.current()
+        if profile is not None:
+            if profile.render_depth == 0:
+                profile.render_started = time.perf_counter()
+            profile.render_depth += 1
+
+    def _render_finished(self, app, template, context, **extra):
+        profile = self.current()
+        if profile is None or profile.render_depth == 0:
+            return
+        profile.render_depth -= 1
+        if profile.render_depth == 0:
+            profile.render_seconds += time.perf_counter() - profile.render_started
+
+    def _request_finished(self, app, response, **extra):
+        profile = self.current()
+        if profile is None:
+            return
+
+        seconds = time.perf_counter() - profile.started
+        endpoint = request.endpoint or 'unmatched'
+        self.record(endpoint, request.method, response.status_code, seconds, profile)
+
+        if self.slow_request_ms and seconds * 1000 >= self.slow_request_ms:
+            self.log_slow_request(seconds, profile)
+
+    def record(self, endpoint, method, status, seconds, profile):
+        """Add one finished request to the metrics."""
+
+        observations = {
+            'warbler_request_duration_seconds': seconds,
+            'warbler_request_db_seconds': profile.db_seconds,
+            'warbler_request_render_seconds': profile.render_seconds,
+            'warbler_request_queries': profile.queries,
+            'warbler_request_slowest_query_seconds': profile.slowest[0],
+        }
+
+        with self._lock:
+            self.requests[(endpoint, method, status)] += 1
+            for name, value in observations.items():
+                key = (name, endpoint)
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(HISTOGRAMS[name][1])
+                self.histograms[key].observe(value)
+
+    def log_slow_request(self, seconds, profile):
+        slowest_seconds, slowest = profile.slowest
+        lines = [f"slow request: {request.method} {request.full_path.rstrip('?')} "
+                 f"({request.endpoint}) took {seconds * 1000:.0f}ms: "
+                 f"{profile.queries} queries in {profile.db_seconds * 1000:.0f}ms, "
+                 f"rendering {profile.render_seconds * 1000:.0f}ms"]
+        if slowest:
+            slowest = fingerprint(slowest)
+            lines.append(f"  slowest query {slowest_seconds * 1000:.0f}ms "
+                         f"[{fingerprint_id(slowest)}] {slowest}")
+        for sql, count in profile.fingerprints.most_common():
+            lines.append(f"  {count}x [{fingerprint_id(sql)}] {sql}")
+        self.logger.warning("\n".join(lines))
+
+    def render_metrics(self):
+        """The metrics, in the Prometheus text exposition format."""
+
+        with self._lock:
+            requests = sorted(self.requests.items())
+            histograms = sorted(self.histograms.items())
+
+        lines = ["# HELP warbler_requests_total Requests handled.",
+                 "# TYPE warbler_requests_total counter"]
+        for (endpoint, method, status), count in requests:
+            lines.append(f'warbler_requests_total{{endpoint="{endpoint}",'
+                         f'method="{method}",status="{status}"}} {count}')
+
+        for name, (help, buckets) in HISTOGRAMS.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} histogram")
+            for (metric, endpoint), histogram in histograms:
+                if metric == name:
+                    lines.extend(histogram.lines(name, f'endpoint="{endpoint}"'))
+
+        for collect in self.collectors:
+            lines.extend(collect())
+
+        return "\n".join(lines) + "\n"
+
+    def add_collector(self, collect):
+        """Have /metrics also show the lines `collect()` returns."""
+
+        self.collectors.append(collect)
+
+    def metrics_view(self):
+        if not current_app.config.get('METRICS_ENABLED', False):
+            abort(404)
+        return Response(self.render_metrics(),
+                        mimetype='text/plain; version=0.0.4')
+
+
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    # a connection runs one statement at a time
+    conn.info['query_started'] = time.perf_counter()
+
+
+profiler = RequestProfiler()
@@ -0,0 +1,237 @@
+"""Background jobs, queued in a database table.
+
+Slow side effects of a request (deleting a big account, delivering a
+message to thousands of timelines) are queued rather than done on the
+spot:
+
+    @job('deliver_to_followers')
+    def deliver_to_followers(message_id):
+        ...
+
+    enqueue('deliver_to_followers', message_id=message.id)
+
+enqueue() adds a row to the `jobs` table in the current session, so the
+job is queued if and only if the caller's transaction commits. Arguments
+must be JSON-serializable; pass ids, not objects.
+
+`flask worker` runs the queue: JOBS_CONCURRENCY threads each claim the
+next due job (SELECT ... FOR UPDATE SKIP LOCKED, so any number of workers
+can share a queue without handing out a job twice), run it in its own
+session and commit. A job that raises is retried after JOBS_RETRY_DELAY
+seconds, doubling each time, until it has had `max_attempts` tries; then it
+stays in the table with status 'failed' and its traceback. A job still
+'running' after JOBS_STALE_AFTER seconds is taken to belong to a worker
+that died, and is run again, so jobs must be safe to run more than once.
+`concurrency` caps how many jobs of one kind run at once (across workers,
+give or take a race).
+
+Queued jobs are run by `flask worker`, next to the web processes. With
+JOBS_IN_PROCESS on (the default only in development, FLASK_ENV=development,
+so it needs no worker) the first enqueue() in a process also starts a
+worker on background threads of that process instead. JOBS_EAGER=1 runs each job right away inside enqueue(), in
+the caller's transaction; that's for tests, since it puts the job's time
+back on the request.
+"""
+
+import json
+import os
+import threading
+import traceback
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import func
+
+from models import db, Job
+
+jobs_table = Job.__table__
+
+
+class JobType:
+    """A registered job: its function and how to run it."""
+
+    def __init__(self, fn, max_attempts, concurrency):
+        self.fn = fn
+        self.max_attempts = max_attempts
+        self.concurrency = concurrency
+
+
+# name: JobType
+JOBS = {}
+
+
+def job(name, max_attempts=5, concurrency=None):
+    """Register the decorated function as job `name`."""
+
+    def register(fn):
+        JOBS[name] = JobType(fn, max_attempts, concurrency)
+        return fn
+
+    return register
+
+
+def enqueue(name, delay=0, **args):
+    """Queue job `name` to be run with `args`, `delay` seconds from now.
+
+    Returns the Job, or None if JOBS_EAGER ran it already. The caller
+    commits.
+    """
+
+    if name not in JOBS:
+        raise KeyError(f"no job called {name!r}")
+
+    if current_app.config.get('JOBS_EAGER', False):
+        JOBS[name].fn(**args)
+        return None
+
+    queued = Job(name=name, args=json.dumps(args),
+                 run_at=datetime.utcnow() + timedelta(seconds=delay))
+    db.session.add(queued)
+    if current_app.config.get('JOBS_IN_PROCESS', False):
+        run_in_background(current_app._get_current_object())
+    return queued
+
+
+class Worker:
+    """Runs queued jobs; see the module docs."""
+
+    def __init__(self, app, concurrency=None):
+        config = app.config
+        self.app = app
+        self.logger = app.logger
+        self.concurrency = concurrency or config.get('JOBS_CONCURRENCY', 2)
+        self.poll_interval = config.get('JOBS_POLL_INTERVAL', 1.0)
+        self.retry_delay = config.get('JOBS_RETRY_DELAY', 10)
+        self.stale_after = config.get('JOBS_STALE_AFTER', 3600)
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def claim(self):
+        """Mark the next due job as running and return (id, name, args,
+        attempts), or None if there's nothing to do."""
+
+        now = datetime.utcnow()
+
+        running = dict(db.session.query(Job.name, func.count(Job.id))
+                       .filter(Job.status == 'running')
+                       .group_by(Job.name))
+        busy = [name for name, job_type in JOBS.items()
+                if job_type.concurrency and running.get(name, 0) >= job_type.concurrency]
+
+        due = (Job.status == 'queued') & (Job.run_at <= now)
+        abandoned = ((Job.status == 'running') &
+                     (Job.started_at < now - timedelta(seconds=self.stale_after)))
+        query = Job.query.filter(due | abandoned)
+        if busy:
+            query = query.filter(~Job.name.in_(busy))
+
+        claimed = (query.order_by(Job.run_at, Job.id)
+                   .with_for_update(skip_locked=True)
+                   .first())
+        if claimed is None:
+            db.session.rollback()
+            return None
+
+        claimed.status = 'running'
+        claimed.attempts += 1
+        claimed.started_at = now
+        result = (claimed.id, claimed.name, claimed.args, claimed.attempts)
+        db.session.commit()
+        return result
+
+    def run_one(self):
+        """Claim and run one job. Returns False if none was due."""
+
+        claimed = self.claim()
+        if claimed is None:
+            return False
+
+        id, name, args, attempts = claimed
+        job_type = JOBS.get(name)
+        try:
+            if job_type is None:
+                raise KeyError(f"no job called {name!r}")
+            job_type.fn(**json.loads(args))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            self.failed(id, name, attempts, job_type, traceback.format_exc())
+        else:
+            db.session.execute(jobs_table.delete().where(jobs_table.c.id == id))
+            db.session.commit()
+        return True
+
+    def failed(self, id, name, attempts, job_type, error):
+        if job_type is not None and attempts < job_type.max_attempts:
+            retry_in = self.retry_delay * 2 ** (attempts - 1)
+            values = dict(status='queued',
+                          run_at=datetime.utcnow() + timedelta(seconds=retry_in))
+            self.logger.warning(f"job {id} ({name}) failed, retrying in {retry_in}s:\n{error}")
+        else:
+            values = dict(status='failed')
+            self.logger.error(f"job {id} ({name}) failed for good after "
+                              f"{attempts} attempts:\n{error}")
+
+        db.session.execute(jobs_table.update()
+                           .where(jobs_table.c.id == id)
+                           .values(error=error, **values))
+        db.session.commit()
+
+    def _work(self, burst):
+        while not self.stopping.is_set():
+            # a fresh app context, and so session, per job
+            with self.app.app_context():
+                try:
+                    ran = self.run_one()
+                except Exception:
+                    # the database went away, say; keep going once it's back
+                    self.logger.exception("job worker: couldn't claim a job")
+                    db.session.rollback()
+                    ran = False
+            if not ran:
+                if burst:
+                    return
+                self.stopping.wait(self.poll_interval)
+
+    def start(self, burst=False, daemon=False):
+        self.threads = [threading.Thread(target=self._work, args=(burst,), daemon=daemon,
+                                         name=f"job-worker-{n}")
+                        for n in range(self.concurrency)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        """Stop once the jobs in progress are done."""
+
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+
+    def run(self, burst=False):
+        """Run jobs until stopped (Ctrl-C), or with `burst` until none are due."""
+
+        self.start(burst)
+        try:
+            for thread in self.threads:
+                while thread.is_alive():
+                    thread.join(timeout=1)
+        except KeyboardInterrupt:
+            # let the jobs in progress finish
+            self.stop()
+
+
+# (app, process id): the Worker run_in_background() started; by process,
+# since a forked web worker doesn't inherit the threads
+_background = {}
+_background_lock = threading.Lock()
+
+
+def run_in_background(app):
+    """Start a worker for `app` on daemon threads of this process, unless
+    there's one already (see JOBS_IN_PROCESS)."""
+
+    key = (app, os.getpid())
+    with _background_lock:
+        if key not in _background:
+            _background[key] = Worker(app)
+            _background[key].start(daemon=True)
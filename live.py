@@ -0,0 +1,291 @@
+"""Live updates: new messages pushed to open pages as server-sent events.
+
+The homepage opens an EventSource on /stream (see app.py), which
+subscribes to the authors its user follows. When a message is posted, the
+view publishes it to its author's topic, and each subscribed stream sends
+it on as an SSE event. The page adds it without re-running the feed query.
+
+Live updates are off unless LIVE_BACKEND is set: then the homepage doesn't
+open a stream, /stream is a 404 and publishing does nothing.
+
+Events are published inside the poster's transaction, and are delivered
+only if it commits. What delivers them is set by LIVE_BACKEND:
+
+- 'local': the hub in this process, after the commit. Only
+  streams served by the same process get them, so this suits a single
+  worker process (with threads).
+- 'postgres': NOTIFY, which Postgres sends on commit to every process
+  LISTENing on the channel. Each process keeps one extra connection for
+  LISTEN, opened directly rather than through the pool (and so never
+  through PgBouncer, which can't pass LISTEN on in transaction mode; point
+  LIVE_DATABASE_URL at Postgres itself if the app's URL is a PgBouncer).
+
+Another broker (Redis pub/sub, say) needs only a class with publish()
+that ends up calling hub.dispatch() in every process.
+
+Each stream holds a request thread for as long as it's open, so streams are
+capped at LIVE_MAX_STREAMS per process (by default half of WSGI_THREADS,
+the threads the server runs each process with; a worker without threads
+gets none) and closed after LIVE_STREAM_SECONDS; browsers reconnect by
+themselves, and the stream picks up after the last event they saw
+(Last-Event-ID).
+"""
+
+import json
+import queue
+import select
+import threading
+import time
+from collections import defaultdict
+
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+
+from models import db
+
+CHANNEL = 'warbler_live'
+
+
+def sse(data, event=None, id=None):
+    """One server-sent event, in the wire format."""
+
+    lines = []
+    if id is not None:
+        lines.append(f"id: {id}")
+    if event is not None:
+        lines.append(f"event: {event}")
+    lines.extend(f"data: {line}" for line in data.split("\n"))
+    return "\n".join(lines) + "\n\n"
+
+
+class Subscription:
+    """The events for one stream, queued until it sends them."""
+
+    def __init__(self, hub, topics, maxsize=100):
+        self.hub = hub
+        self.topics = set(topics)
+        self.queue = queue.Queue(maxsize=maxsize)
+        # set if the stream fell so far behind that events were dropped;
+        # it should end, so the browser reconnects and catches up
+        self.overflowed = False
+        self.closed = False
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        """The next event, or None if there's none within `timeout` seconds."""
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.hub.unsubscribe(self)
+
+
+class Hub:
+    """This process's subscriptions, by topic."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = defaultdict(set)
+        self.count = 0
+
+    def subscribe(self, topics):
+        subscription = Subscription(self, topics)
+        with self._lock:
+            for topic in subscription.topics:
+                self._subscriptions[topic].add(subscription)
+            self.count += 1
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for topic in subscription.topics:
+                subscribers = self._subscriptions.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscriptions[topic]
+            self.count -= 1
+
+    def dispatch(self, topic, event):
+        with self._lock:
+            subscribers = list(self._subscriptions.get(topic, ()))
+        for subscription in subscribers:
+            subscription.put(event)
+
+
+class LocalBroker:
+    """Delivers to this process's hub once the session commits."""
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def publish(self, topic, event):
+        db.session.info.setdefault('live_events', []).append((topic, event))
+
+
+class PostgresBroker:
+    """Delivers to every process through LISTEN/NOTIFY."""
+
+    def __init__(self, hub, url, logger):
+        self.hub = hub
+        self.url = url
+        self.logger = logger
+        self.engine = None
+        # seconds between attempts to reconnect
+        self.retry_delay = 5
+        self._listener = None
+        self._start_lock = threading.Lock()
+
+    def publish(self, topic, event):
+        db.session.execute("SELECT pg_notify(:channel, :payload)",
+                           dict(channel=CHANNEL, payload=json.dumps([topic, event])))
+
+    def start(self, engine):
+        """Start listening, if we aren't already, on the database of `engine`
+        (unless we were given another URL)."""
+
+        with self._start_lock:
+            if self._listener is None:
+                self.engine = engine
+                self._listener = threading.Thread(target=self._listen, daemon=True,
+                                                  name='live-listener')
+                self._listener.start()
+
+    def _connect(self):
+        dialect = self.engine.dialect
+        cargs, cparams = dialect.create_connect_args(self.url or self.engine.url)
+        connection = dialect.connect(*cargs, **cparams)
+        try:
+            connection.autocommit = True
+            connection.cursor().execute(f"LISTEN {CHANNEL}")
+        except Exception:
+            connection.close()
+            raise
+        return connection
+
+    def _listen(self):
+        while True:
+            connection = None
+            try:
+                connection = self._connect()
+                while True:
+                    if select.select([connection], [], [], 60) != ([], [], []):
+                        connection.poll()
+                        while connection.notifies:
+                            notify = connection.notifies.pop(0)
+                            self.hub.dispatch(*json.loads(notify.payload))
+            except Exception:
+                # events sent while we're reconnecting are lost; the
+                # streams catch up when they reconnect
+                self.logger.exception("live updates: lost the LISTEN connection")
+            finally:
+                # don't leave the old one open on the server while we retry
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+            time.sleep(self.retry_delay)
+
+
+class LiveUpdates:
+    """Publishing events and subscribing streams to them; see the module docs."""
+
+    def __init__(self, app=None):
+        self.hub = Hub()
+        # None: live updates are off
+        self.broker = None
+        self.max_streams = 0
+        self.stream_seconds = 300
+        self.heartbeat = 15
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        backend = config.get('LIVE_BACKEND')
+        if backend == 'postgres':
+            url = config.get('LIVE_DATABASE_URL')
+            self.broker = PostgresBroker(self.hub, url and make_url(url), app.logger)
+        elif backend == 'local':
+            self.broker = LocalBroker(self.hub)
+        elif backend:
+            raise ValueError(f"unknown LIVE_BACKEND {backend!r}")
+        else:
+            self.broker = None
+        self.max_streams = config.get('LIVE_MAX_STREAMS', 0)
+        self.stream_seconds = config.get('LIVE_STREAM_SECONDS', 300)
+        self.heartbeat = config.get('LIVE_HEARTBEAT', 15)
+
+    def publish(self, topic, event):
+        """Send `event` (JSON-able) to `topic`'s subscribers if the current
+        transaction commits."""
+
+        if self.broker is not None:
+            self.broker.publish(topic, event)
+
+    @property
+    def enabled(self):
+        return self.broker is not None
+
+    def full(self):
+        return self.hub.count >= self.max_streams
+
+    def subscribe(self, topics):
+        if isinstance(self.broker, PostgresBroker):
+            self.broker.start(db.engine)
+        return self.hub.subscribe(topics)
+
+    def stream(self, subscription, backlog=()):
+        """The SSE body for `subscription`: `backlog` first, as
+        (id, event name, data) tuples, then events as they're published.
+
+        Events are dicts with 'id', 'event' and 'data'. The stream ends
+        after `stream_seconds`, or if it falls behind.
+        """
+
+        try:
+            # tell the browser how soon to reconnect when we hang up
+            yield "retry: 1000\n\n"
+            sent = set()
+            for id, name, data in backlog:
+                sent.add(id)
+                yield sse(data, name, id)
+
+            ends = time.monotonic() + self.stream_seconds
+            while time.monotonic() < ends and not subscription.overflowed:
+                event = subscription.get(timeout=self.heartbeat)
+                if event is None:
+                    # keeps proxies from timing us out, and finds out if
+                    # the browser went away
+                    yield ": keepalive\n\n"
+                elif event['id'] not in sent:
+                    yield sse(event['data'], event.get('event'), event['id'])
+        finally:
+            subscription.close()
+
+
+live = LiveUpdates()
+
+
+# The local broker's events wait for their transaction to commit.
+
+@event.listens_for(db.session, 'after_commit')
+def _dispatch_events(session):
+    for topic, payload in session.info.pop('live_events', []):
+        live.hub.dispatch(topic, payload)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_events(session):
+    session.info.pop('live_events', None)
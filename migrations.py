@@ -0,0 +1,144 @@
+"""Schema migrations for existing Warbler databases.
+
+`db.create_all()` builds a fresh database with the current schema, but it
+never changes tables that already exist. Each step here brings an older
+database up to date. Steps check before they change anything and are
+recorded in the `schema_migrations` table, so `flask migrate` is safe to run
+at any time, including right after `db.create_all()`.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, MetaData, Table, Text, inspect
+
+from models import (COUNTER_COLUMNS, SEARCH_INDEX_DDL, TRIGRAM_EXTENSION_DDL,
+                    TRIGRAM_INDEX_DDL, Follows, Job, Message, TimelineEntry, User,
+                    trigrams_available)
+
+migrations_table = Table(
+    'schema_migrations', MetaData(),
+    Column('id', Text, primary_key=True),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+# (id, function) pairs, in the order they must run
+MIGRATIONS = []
+
+
+def migration(id):
+    """Register a migration step; steps run in the order they're defined."""
+
+    def register(fn):
+        MIGRATIONS.append((id, fn))
+        return fn
+
+    return register
+
+
+def _index_names(conn, table):
+    inspector = inspect(conn)
+    names = {index['name'] for index in inspector.get_indexes(table)}
+    names.update(c['name'] for c in inspector.get_unique_constraints(table))
+    return names
+
+
+def _create_index(conn, index):
+    if index.name not in _index_names(conn, index.table.name):
+        index.create(conn)
+
+
+@migration('0001_timeline_entries')
+def add_timeline_entries(conn):
+    """Inbox table for fan-out-on-write timelines."""
+
+    TimelineEntry.__table__.create(conn, checkfirst=True)
+
+
+@migration('0002_user_counters')
+def add_user_counters(conn):
+    """Denormalized counter columns on users, filled in from scratch."""
+
+    existing = {column['name'] for column in inspect(conn).get_columns('users')}
+    for name in COUNTER_COLUMNS:
+        if name not in existing:
+            conn.execute(f"ALTER TABLE users ADD COLUMN {name} "
+                         f"INTEGER NOT NULL DEFAULT 0")
+
+    User.recount(bind=conn)
+
+
+@migration('0003_hot_path_indexes')
+def add_hot_path_indexes(conn):
+    """Indexes for the feed, profile, likes and follow lookups."""
+
+    for model in (Message, Follows, TimelineEntry):
+        for index in model.__table__.indexes:
+            _create_index(conn, index)
+
+    # likes.message_id used to be unique on its own, so only one user could
+    # ever like a message; replace it with uniqueness per (user, message)
+    inspector = inspect(conn)
+    for constraint in inspector.get_unique_constraints('likes'):
+        if constraint['column_names'] == ['message_id']:
+            conn.execute(f"ALTER TABLE likes DROP CONSTRAINT {constraint['name']}")
+
+    if 'uq_likes_user_message' not in _index_names(conn, 'likes'):
+        if conn.dialect.name == 'sqlite':
+            # SQLite can't add constraints to an existing table
+            conn.execute("CREATE UNIQUE INDEX uq_likes_user_message "
+                         "ON likes (user_id, message_id)")
+        else:
+            conn.execute("ALTER TABLE likes ADD CONSTRAINT uq_likes_user_message "
+                         "UNIQUE (user_id, message_id)")
+
+
+@migration('0004_search_indexes')
+def add_search_indexes(conn):
+    """Trigram and full-text indexes for user and message search."""
+
+    if conn.dialect.name != 'postgresql':
+        # other databases use search.py's in-process index instead
+        return
+
+    statements = [s for table in SEARCH_INDEX_DDL.values() for s in table]
+    if trigrams_available(conn):
+        statements.append(TRIGRAM_EXTENSION_DDL)
+        statements.extend(s for table in TRIGRAM_INDEX_DDL.values() for s in table)
+
+    for statement in statements:
+        conn.execute(statement)
+
+
+@migration('0005_jobs')
+def add_jobs(conn):
+    """Table for the background job queue."""
+
+    Job.__table__.create(conn, checkfirst=True)
+
+
+def applied_migrations(engine):
+    """Ids of the migrations already recorded in this database."""
+
+    migrations_table.create(engine, checkfirst=True)
+    return {row.id for row in engine.execute(migrations_table.select())}
+
+
+def migrate(engine):
+    """Run every pending migration, each in its own transaction.
+
+    Returns the ids of the migrations that ran.
+    """
+
+    done = applied_migrations(engine)
+    ran = []
+
+    for id, step in MIGRATIONS:
+        if id in done:
+            continue
+        with engine.begin() as conn:
+            step(conn)
+            conn.execute(migrations_table.insert().values(
+                id=id, applied_at=datetime.utcnow()))
+        ran.append(id)
+
+    return ran
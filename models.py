@@ -1,12 +1,16 @@
 """SQLAlchemy models for Warbler."""
 
+from collections import Counter
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event, func, inspect, select
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import hasher
+from replicas import RoutingSQLAlchemy
+
+db = RoutingSQLAlchemy()
 
 
 class Follows(db.Model):
@@ -26,6 +30,24 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # the primary key leads with user_being_followed_id, which serves
+    # "who follows X"; this index serves "who does X follow" (the feed)
+    __table_args__ = (
+        db.Index('ix_follows_following_followed',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
+
+def _follow_exists(follower_id, followed_id):
+    """Does `follower_id` follow `followed_id`?"""
+
+    if follower_id is None or followed_id is None:
+        return False
+
+    follows = Follows.query.filter_by(user_following_id=follower_id,
+                                      user_being_followed_id=followed_id)
+    return db.session.query(follows.exists()).scalar()
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -45,7 +67,12 @@ class Likes(db.Model):
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+    )
+
+    # a user likes a message at most once; also indexes a user's likes
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id',
+                            name='uq_likes_user_message'),
     )
 
 
@@ -94,6 +121,36 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized stats, kept up to date by the session hooks at the bottom
+    # of this file. `flask recount-stats` recomputes them if they drift.
+    message_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    follower_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     messages = db.relationship('Message')
 
     # define many to many relationship between user and followers
@@ -125,17 +182,117 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    @classmethod
+    def recount(cls, user_ids=None, bind=None):
+        """Recompute the denormalized counters from the underlying tables.
+
+        One bulk UPDATE with correlated subqueries; pass `user_ids` to only
+        fix up some users. Runs on the session unless given another `bind`
+        (e.g. a migration's connection). The caller commits.
+        """
+
+        def count(column, criterion):
+            return select([func.count(column)]).where(criterion).as_scalar()
+
+        users = cls.__table__
+        stmt = users.update().values(
+            message_count=count(Message.id, Message.user_id == users.c.id),
+            following_count=count(Follows.user_being_followed_id,
+                                  Follows.user_following_id == users.c.id),
+            follower_count=count(Follows.user_following_id,
+                                 Follows.user_being_followed_id == users.c.id),
+            like_count=count(Likes.id, Likes.user_id == users.c.id),
+        )
+        if user_ids is not None:
+            stmt = stmt.where(users.c.id.in_(list(user_ids)))
+
+        (bind or db.session).execute(stmt)
+
+    # The columns kept in cache records: what pages show of a user. Never
+    # secrets (the password hash), since the cache may be shared (Redis).
+    CACHE_COLUMNS = ('id', 'username', 'image_url', 'header_image_url', 'bio',
+                     'location', 'message_count', 'follower_count',
+                     'following_count', 'like_count')
+
+    @classmethod
+    def make_cache_record(cls, get):
+        """A cache record from `get(column name)`; for rows as well as users."""
+
+        return {name: get(name) for name in cls.CACHE_COLUMNS}
+
+    def cache_record(self):
+        """This user's CACHE_COLUMNS as a plain dict, safe to keep between
+        requests (unlike the instance itself, which belongs to a session)."""
+
+        return self.make_cache_record(lambda name: getattr(self, name))
+
+    @classmethod
+    def from_cache_record(cls, record):
+        """Rebuild a user from `cache_record()` without querying the database.
+
+        The result is attached to the session like a freshly loaded user, so
+        relationships still lazy-load and changes can be committed. Columns
+        not in the record (email, password) are loaded if something uses them.
+        """
+
+        user = cls(**record)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        if 'followers' not in inspect(self).unloaded:
+            return other_user in self.followers
+        return _follow_exists(other_user.id, self.id)
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_user`?"""
+
+        # reuse the list if something already loaded it; otherwise ask the
+        # follows table about just this pair (a primary key lookup)
+        if 'following' not in inspect(self).unloaded:
+            return other_user in self.following
+        return _follow_exists(self.id, other_user.id)
+
+    def following_ids_among(self, user_ids):
+        """Which of `user_ids` this user follows, as a set, in one query.
+
+        For list pages, which would otherwise call is_following() per user.
+        """
+
+        user_ids = set(user_ids)
+        if not user_ids or self.id is None:
+            return set()
+
+        if 'following' not in inspect(self).unloaded:
+            return {user.id for user in self.following} & user_ids
+
+        rows = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id,
+                        Follows.user_being_followed_id.in_(user_ids)))
+        return {followed_id for (followed_id,) in rows}
+
+    def liked_ids_among(self, message_ids):
+        """Which of `message_ids` this user has liked, as a set, in one query.
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        For message lists, so a page's like buttons cost one query however
+        many likes the user has.
+        """
+
+        message_ids = set(message_ids)
+        if not message_ids or self.id is None:
+            return set()
+
+        if 'likes' not in inspect(self).unloaded:
+            return {message.id for message in self.likes} & message_ids
+
+        rows = (db.session
+                .query(Likes.message_id)
+                .filter(Likes.user_id == self.id,
+                        Likes.message_id.in_(message_ids)))
+        return {message_id for (message_id,) in rows}
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -144,7 +301,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -165,17 +322,27 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the stored hash was made with an old bcrypt cost, it is replaced
+        with one at the current cost; the caller commits.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = user.check_password(password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.hash(password)
                 return user
 
         return False
 
+    def check_password(self, password):
+        """Does `password` match this user's stored hash?"""
+
+        return hasher.check(self.password, password)
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
@@ -195,7 +362,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -207,6 +374,270 @@ class Message(db.Model):
     user = db.relationship('User')
 
 
+# serves profile pages and the feed: one user's messages, newest first
+db.Index('ix_messages_user_timestamp',
+         Message.user_id, Message.timestamp.desc(), Message.id.desc())
+
+
+# Search indexes (see search.py). They are Postgres-only, so they're created
+# with raw DDL rather than db.Index; the expressions must match the ones
+# search.py queries with, or the planner won't use them.
+SEARCH_INDEX_DDL = {
+    'users': [
+        "CREATE INDEX IF NOT EXISTS ix_users_bio_fts "
+        "ON users USING gin (to_tsvector('english', coalesce(bio, '')))",
+    ],
+    'messages': [
+        "CREATE INDEX IF NOT EXISTS ix_messages_text_fts "
+        "ON messages USING gin (to_tsvector('english', text))",
+    ],
+}
+
+# Substring matches on usernames (ILIKE '%q%') need a trigram index, which
+# comes from the pg_trgm contrib extension. Servers built without contrib
+# still work, but those searches scan the users table.
+TRIGRAM_EXTENSION_DDL = "CREATE EXTENSION IF NOT EXISTS pg_trgm"
+
+TRIGRAM_INDEX_DDL = {
+    'users': [
+        "CREATE INDEX IF NOT EXISTS ix_users_username_trgm "
+        "ON users USING gin (username gin_trgm_ops)",
+    ],
+}
+
+
+def trigrams_available(bind):
+    """Can this Postgres server provide the pg_trgm extension?"""
+
+    return bind.execute("SELECT 1 FROM pg_available_extensions "
+                        "WHERE name = 'pg_trgm'").scalar() is not None
+
+
+def _if_trigrams(ddl, target, bind, **kw):
+    return trigrams_available(bind)
+
+
+event.listen(User.__table__, 'before_create',
+             DDL(TRIGRAM_EXTENSION_DDL).execute_if(dialect='postgresql',
+                                                   callable_=_if_trigrams))
+
+for _table in (User.__table__, Message.__table__):
+    for _statement in SEARCH_INDEX_DDL[_table.name]:
+        event.listen(_table, 'after_create',
+                     DDL(_statement).execute_if(dialect='postgresql'))
+    for _statement in TRIGRAM_INDEX_DDL.get(_table.name, []):
+        event.listen(_table, 'after_create',
+                     DDL(_statement).execute_if(dialect='postgresql',
+                                                callable_=_if_trigrams))
+
+
+class TimelineEntry(db.Model):
+    """A message delivered to a user's home timeline.
+
+    Rows are written when a message is posted (fan-out on write), so reading
+    a timeline is a single index range scan instead of an `IN (...)` over
+    everyone the user follows.
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # copied from the message so the timeline can be ordered without a join
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+    )
+
+
+class Job(db.Model):
+    """A piece of work queued to run outside the request (see jobs.py)."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # keyword arguments for the job's function, as JSON
+    args = db.Column(
+        db.Text,
+        nullable=False,
+        default='{}',
+    )
+
+    # 'queued', 'running' or 'failed'; finished jobs are deleted
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    started_at = db.Column(
+        db.DateTime,
+    )
+
+    # traceback of the last failed attempt
+    error = db.Column(
+        db.Text,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    # serves the workers' "next job due" lookup
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+
+##############################################################################
+# Counter maintenance
+#
+# Rather than trusting every route to remember the counters, we watch what
+# each flush writes: new/deleted Message, Follows and Likes objects, and
+# appends/removes on the following, followers and likes collections. The
+# counter UPDATEs run in the same transaction as the change itself.
+#
+# Rows removed by a database cascade are never seen by the ORM, so those
+# adjustments are made in before_flush, while the rows still exist.
+
+COUNTER_COLUMNS = ['message_count', 'follower_count', 'following_count', 'like_count']
+
+# (collection on User, counter on the owner, counter on each member)
+COUNTED_COLLECTIONS = [
+    ('following', 'following_count', 'follower_count'),
+    ('followers', 'follower_count', 'following_count'),
+    ('likes', 'like_count', None),
+]
+
+
+@event.listens_for(db.session, 'before_flush')
+def _counters_before_flush(session, flush_context, instances):
+    """Record collection changes and adjust for upcoming cascades."""
+
+    # users may not have ids yet, so keep the objects until after the flush
+    pending = session.info.setdefault('counter_deltas', [])
+
+    for user in list(session.new) + list(session.dirty):
+        if not isinstance(user, User):
+            continue
+        for attr, own_counter, member_counter in COUNTED_COLLECTIONS:
+            history = inspect(user).attrs[attr].history
+            for members, sign in ((history.added, 1), (history.deleted, -1)):
+                for member in members or ():
+                    pending.append((user, own_counter, sign))
+                    if member_counter:
+                        pending.append((member, member_counter, sign))
+
+    users = User.__table__
+    deleted_like_ids = [o.id for o in session.deleted if isinstance(o, Likes)]
+
+    for obj in session.deleted:
+        if isinstance(obj, Message):
+            # the likes of a deleted message go with it
+            likers = select([Likes.user_id]).where(Likes.message_id == obj.id)
+            if deleted_like_ids:
+                likers = likers.where(~Likes.id.in_(deleted_like_ids))
+            session.execute(users.update()
+                            .where(users.c.id.in_(likers))
+                            .values(like_count=users.c.like_count - 1))
+
+        elif isinstance(obj, User):
+            # ...and so do the follows of a deleted user
+            followed = (select([Follows.user_being_followed_id])
+                        .where(Follows.user_following_id == obj.id))
+            session.execute(users.update()
+                            .where(users.c.id.in_(followed))
+                            .values(follower_count=users.c.follower_count - 1))
+            followers = (select([Follows.user_following_id])
+                         .where(Follows.user_being_followed_id == obj.id))
+            session.execute(users.update()
+                            .where(users.c.id.in_(followers))
+                            .values(following_count=users.c.following_count - 1))
+
+
+@event.listens_for(db.session, 'after_flush')
+def _counters_after_flush(session, flush_context):
+    """Apply counter changes for everything this flush wrote."""
+
+    deltas = Counter()
+
+    for user, column, sign in session.info.pop('counter_deltas', []):
+        deltas[user.id, column] += sign
+
+    for objects, sign in ((session.new, 1), (session.deleted, -1)):
+        for obj in objects:
+            if isinstance(obj, Message):
+                deltas[obj.user_id, 'message_count'] += sign
+            elif isinstance(obj, Likes):
+                deltas[obj.user_id, 'like_count'] += sign
+            elif isinstance(obj, Follows):
+                deltas[obj.user_following_id, 'following_count'] += sign
+                deltas[obj.user_being_followed_id, 'follower_count'] += sign
+
+    by_user = {}
+    for (user_id, column), delta in deltas.items():
+        if delta:
+            by_user.setdefault(user_id, {})[column] = delta
+
+    users = User.__table__
+    for user_id, changes in by_user.items():
+        session.execute(
+            users.update()
+            .where(users.c.id == user_id)
+            .values({column: users.c[column] + delta
+                     for column, delta in changes.items()}))
+
+    session.info['counters_changed'] = set(by_user)
+
+
+@event.listens_for(db.session, 'after_flush_postexec')
+def _counters_expire(session, flush_context):
+    """Make loaded users re-read the counters we just changed."""
+
+    for user_id in session.info.pop('counters_changed', ()):
+        user = session.identity_map.get(identity_key(User, user_id))
+        if user is not None:
+            session.expire(user, COUNTER_COLUMNS)
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -0,0 +1,117 @@
+"""Keyset (cursor) pagination for Warbler's lists.
+
+Instead of OFFSET, each page remembers the sort key of its last row and
+the next page asks for rows strictly past that. With an index on the sort
+columns, page 500 costs the same as page 1.
+
+Message lists are newest first, keyed on (timestamp, id); the user
+directory is alphabetical, keyed on the (unique) username.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+
+from flask import abort
+from sqlalchemy import tuple_
+
+CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class Page:
+    """One page of results plus the cursor for the page after it."""
+
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def encode_cursor(timestamp, id):
+    """Turn a (timestamp, id) sort key into an opaque querystring token."""
+
+    raw = f"{timestamp.strftime(CURSOR_TIME_FORMAT)}|{id}"
+    return urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Turn a token from `encode_cursor` back into a (timestamp, id) key.
+
+    Responds with a 400 if the token was tampered with.
+    """
+
+    try:
+        raw = urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        timestamp, id = raw.split('|')
+        return datetime.strptime(timestamp, CURSOR_TIME_FORMAT), int(id)
+    except (ValueError, UnicodeError):
+        abort(400)
+
+
+def encode_key(value):
+    """Turn a single string sort key into an opaque querystring token."""
+
+    return urlsafe_b64encode(value.encode('utf-8')).decode('ascii')
+
+
+def decode_key(cursor):
+    """Turn a token from `encode_key` back into its key; 400 if mangled."""
+
+    try:
+        return urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+    except (ValueError, UnicodeError):
+        abort(400)
+
+
+def paginate(query, timestamp_col, id_col, cursor=None, per_page=50):
+    """Return a newest-first Page of `query`, keyed on (timestamp_col, id_col).
+
+    Items must have `timestamp` and `id` attributes matching those columns.
+    """
+
+    if cursor:
+        before = decode_cursor(cursor)
+        query = query.filter(tuple_(timestamp_col, id_col) < tuple_(*before))
+
+    # fetch one extra row to find out whether there is another page
+    rows = (query
+            .order_by(timestamp_col.desc(), id_col.desc())
+            .limit(per_page + 1)
+            .all())
+
+    items = rows[:per_page]
+    if len(rows) > per_page:
+        last = items[-1]
+        next_cursor = encode_cursor(last.timestamp, last.id)
+    else:
+        next_cursor = None
+
+    return Page(items, next_cursor)
+
+
+def paginate_ascending(query, key_col, cursor=None, per_page=50):
+    """Return a Page of `query` in ascending order of the unique `key_col`.
+
+    Items must have an attribute named like `key_col`.
+    """
+
+    if cursor:
+        query = query.filter(key_col > decode_key(cursor))
+
+    rows = query.order_by(key_col).limit(per_page + 1).all()
+
+    items = rows[:per_page]
+    if len(rows) > per_page:
+        next_cursor = encode_key(getattr(items[-1], key_col.key))
+    else:
+        next_cursor = None
+
+    return Page(items, next_cursor)
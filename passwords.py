@@ -0,0 +1,96 @@
+"""Password hashing on a bounded worker pool.
+
+bcrypt is deliberately slow (about 250 ms per hash at cost 12) and releases
+the GIL while it works. Running every hash on a shared pool sized to the
+CPU count keeps a burst of logins from oversubscribing the cores. Callers
+that would have to wait too long for a turn get PasswordHasherBusy, which
+the app turns into a 503, instead of queueing without limit.
+
+Configuration (read in `init_app`):
+
+- BCRYPT_LOG_ROUNDS: bcrypt work factor for new hashes (default 12). Hashes
+  made with another cost are upgraded the next time their user logs in.
+- PASSWORD_HASH_WORKERS: pool size (default: number of CPUs).
+- PASSWORD_HASH_MAX_PENDING: hashes allowed to be running or queued at once
+  (default: 4 per worker).
+- PASSWORD_HASH_WAIT: seconds to wait for a free slot before giving up
+  (default 5).
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+
+from flask_bcrypt import Bcrypt
+
+bcrypt = Bcrypt()
+
+
+class PasswordHasherBusy(Exception):
+    """Too many password hashes are already waiting for the pool."""
+
+
+class PasswordHasher:
+    """Runs bcrypt hashing/checking on a bounded thread pool."""
+
+    def __init__(self, app=None):
+        self.configure({})
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.configure(app.config)
+        bcrypt.init_app(app)
+
+    def configure(self, config):
+        """(Re)build the pool from a config mapping; see the module docs."""
+
+        workers = config.get('PASSWORD_HASH_WORKERS') or os.cpu_count() or 1
+        max_pending = config.get('PASSWORD_HASH_MAX_PENDING') or workers * 4
+
+        self.log_rounds = config.get('BCRYPT_LOG_ROUNDS', 12)
+        self.wait = config.get('PASSWORD_HASH_WAIT', 5)
+
+        # threads are only started as work arrives, so this is cheap
+        self._pool = ThreadPoolExecutor(max_workers=workers,
+                                        thread_name_prefix='password-hash')
+        self._slots = BoundedSemaphore(max_pending)
+
+    def _run(self, fn, *args):
+        """Run `fn(*args)` on the pool and wait for its result."""
+
+        slots = self._slots
+        if not slots.acquire(timeout=self.wait):
+            raise PasswordHasherBusy()
+
+        try:
+            future = self._pool.submit(fn, *args)
+        except BaseException:
+            slots.release()
+            raise
+
+        future.add_done_callback(lambda f: slots.release())
+        return future.result()
+
+    def hash(self, password):
+        """Hash `password` at the configured cost."""
+
+        hashed = self._run(bcrypt.generate_password_hash, password, self.log_rounds)
+        return hashed.decode('UTF-8')
+
+    def check(self, pw_hash, password):
+        """Does `password` match the bcrypt hash `pw_hash`?"""
+
+        return self._run(bcrypt.check_password_hash, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        """Was `pw_hash` made with a different cost than we now use?"""
+
+        # bcrypt hashes look like $2b$12$<salt+hash>
+        try:
+            return int(pw_hash.split('$')[2]) != self.log_rounds
+        except (IndexError, ValueError):
+            return True
+
+
+hasher = PasswordHasher()
@@ -0,0 +1,243 @@
+"""Sending the read-only pages' queries to read replicas.
+
+With DATABASE_REPLICA_URLS set (a comma-separated list of database URLs,
+streaming replicas of the primary), views decorated with @replicas.reads
+run their SELECTs on a replica, picked at random for each request:
+
+    @app.route('/users')
+    @replicas.reads
+    def list_users():
+        ...
+
+Everything else goes to the primary: every other view, and anything in a
+replica-reading request that isn't a plain SELECT (flushes, INSERT, UPDATE
+and DELETE statements, raw SQL). Once a session has written, the rest of
+its reads go to the primary too.
+
+Replicas run behind, so:
+
+- each replica's lag is checked at most every DATABASE_REPLICA_CHECK_INTERVAL
+  seconds, and one more than DATABASE_REPLICA_MAX_LAG seconds behind (or
+  that can't be reached) is left out until it catches up;
+- read your writes: a request that commits a write notes the time in the
+  user's session, and their replica reads stay on the primary until the
+  replica's lag is less than the time since;
+- with no replica usable, reads go to the primary. So do the rest of a
+  request's reads if its replica drops the connection part way through.
+
+A replica's lag is only as fresh as its last check, so it's taken to have
+grown by the time since. One request at a time checks each replica; the
+others go by the last check meanwhile, so a replica that hangs holds up
+only that one, and only for DATABASE_REPLICA_CONNECT_TIMEOUT seconds if it
+doesn't answer the connection. The replicas get the same pool settings as
+the primary (see dbpool.py).
+"""
+
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, g, has_app_context, has_request_context, session
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import create_engine, event, exc, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql import CompoundSelect, Select
+
+from dbpool import PooledSQLAlchemy, pool_options
+
+# when the user last committed a write, as a UNIX time
+WROTE_AT_KEY = 'db_wrote_at'
+
+# Seconds since the replica last replayed a transaction, or 0 if it has
+# replayed everything it's received (so an idle primary doesn't look like
+# lag); NULL if we can't tell.
+POSTGRES_LAG_SQL = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END
+"""
+
+
+class Replica:
+    """One read replica, and how far behind it was when last checked."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.lag = None
+        self.checked_at = None
+        self._measuring = False
+        self._lock = threading.Lock()
+
+    def measure_lag(self):
+        """Seconds behind the primary right now, or None if unknown."""
+
+        if self.engine.dialect.name != 'postgresql':
+            # a test stand-in (SQLite, say) has nothing to replay
+            return 0.0
+        with self.engine.connect() as connection:
+            lag = connection.scalar(POSTGRES_LAG_SQL)
+        return None if lag is None else float(lag)
+
+    def behind(self, check_interval, logger):
+        """How far behind it may be now, checking again if it's time; None if
+        it can't be used."""
+
+        with self._lock:
+            due = self.checked_at is None or time.monotonic() - self.checked_at >= check_interval
+            # one request measures, outside the lock; the others go by the
+            # last measurement meanwhile
+            measure = due and not self._measuring
+            if measure:
+                self._measuring = True
+
+        if measure:
+            lag = None
+            try:
+                lag = self.measure_lag()
+            except exc.DBAPIError:
+                logger.warning(f"replica {self.engine.url!r} unreachable", exc_info=True)
+            finally:
+                with self._lock:
+                    self.lag, self.checked_at = lag, time.monotonic()
+                    self._measuring = False
+
+        with self._lock:
+            if self.lag is None:
+                return None
+            return self.lag + (time.monotonic() - self.checked_at)
+
+
+class ReplicaRouter:
+    """The read replicas and which of them a request may use; see the
+    module docs."""
+
+    def __init__(self, app=None):
+        self.replicas = []
+        self.max_lag = 5
+        self.check_interval = 1
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        urls = [url.strip() for url in config.get('DATABASE_REPLICA_URLS', '').split(',')
+                if url.strip()]
+        self.replicas = [Replica(create_engine(url, **self.engine_options(config, url)))
+                         for url in urls]
+        self.max_lag = config.get('DATABASE_REPLICA_MAX_LAG', 5)
+        self.check_interval = config.get('DATABASE_REPLICA_CHECK_INTERVAL', 1)
+
+    @staticmethod
+    def engine_options(config, url):
+        url = make_url(url)
+        options = pool_options(config, url)
+        if url.drivername.startswith('postgresql'):
+            # libpq would otherwise wait as long as TCP does
+            options['connect_args'] = {
+                'connect_timeout': config.get('DATABASE_REPLICA_CONNECT_TIMEOUT', 2)}
+        return options
+
+    def choose(self):
+        """A replica the current user may read from, or None for the primary."""
+
+        if not self.replicas:
+            return None
+
+        max_lag = self.max_lag
+        wrote_at = session.get(WROTE_AT_KEY)
+        if wrote_at is not None:
+            max_lag = min(max_lag, time.time() - wrote_at)
+
+        logger = current_app.logger
+        usable = []
+        for replica in self.replicas:
+            behind = replica.behind(self.check_interval, logger)
+            if behind is not None and behind < max_lag:
+                usable.append(replica)
+        return random.choice(usable) if usable else None
+
+    def reads(self, view):
+        """Decorate a read-only view to read from a replica when it can."""
+
+        @wraps(view)
+        def read_from_replica(*args, **kwargs):
+            g.read_replica = self.choose()
+            try:
+                return view(*args, **kwargs)
+            except (exc.OperationalError, exc.InterfaceError):
+                replica = g.read_replica
+                # was it the replica that failed? look again now
+                if replica is None or replica.behind(0, current_app.logger) is not None:
+                    raise
+                current_app.logger.warning("replica failed mid-request; using the primary")
+                g.read_replica = None
+                current_app.extensions['sqlalchemy'].db.session.rollback()
+                return view(*args, **kwargs)
+
+        return read_from_replica
+
+    @contextmanager
+    def primary(self):
+        """Read from the primary inside the block, whatever the request does.
+
+        For anything kept past the request, like the current-user cache: a
+        lagging replica's rows would outlast its lag there.
+        """
+
+        replica = g.pop('read_replica', None)
+        try:
+            yield
+        finally:
+            if replica is not None:
+                g.read_replica = replica
+
+    def current(self):
+        """The replica engine this request reads from, if any."""
+
+        if not has_app_context():
+            return None
+        replica = g.get('read_replica')
+        return replica.engine if replica is not None else None
+
+
+replicas = ReplicaRouter()
+
+
+class RoutingSession(SignallingSession):
+    """Sends the SELECTs of replica-reading requests to their replica."""
+
+    def get_bind(self, mapper=None, clause=None):
+        if isinstance(clause, (Select, CompoundSelect)):
+            replica = replicas.current()
+            if replica is not None and not self.info.get('wrote'):
+                return replica
+        elif clause is not None:
+            # DML, or raw SQL that might be: stay on the primary from now on
+            self.info['wrote'] = True
+        return super().get_bind(mapper, clause)
+
+
+def _wrote(db_session, flush_context):
+    db_session.info['wrote'] = True
+
+
+def _note_write(db_session):
+    # only worth a cookie if there are replicas to keep the user away from
+    if db_session.info.get('wrote') and replicas.replicas and has_request_context():
+        session[WROTE_AT_KEY] = time.time()
+
+
+class RoutingSQLAlchemy(PooledSQLAlchemy):
+    """Flask-SQLAlchemy with a RoutingSession, and pools from dbpool.py."""
+
+    def create_session(self, options):
+        factory = orm.sessionmaker(class_=RoutingSession, db=self, **options)
+        # on the factory's own class, as live.py does: listeners put on
+        # RoutingSession itself weren't always called
+        event.listen(factory, 'after_flush', _wrote)
+        event.listen(factory, 'after_commit', _note_write)
+        return factory
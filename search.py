@@ -0,0 +1,324 @@
+"""Search over users and messages.
+
+On Postgres, usernames are matched by substring (served by a trigram index
+when the pg_trgm extension is available) and bios and message text through
+full-text (tsvector) indexes. Username hits rank first, shortest (closest)
+usernames first, then bio hits by ts_rank; messages rank by ts_rank, then
+newest first. The indexes are defined in models.py.
+
+Other databases (SQLite test runs) get a pure-Python inverted index instead.
+It is built from the database the first time it is searched, then kept up
+to date by watching committed sessions. Each worker process holds its own
+copy, so it's meant for development and tests, not production.
+
+Set SEARCH_BACKEND to 'postgres' or 'python' to override the choice.
+"""
+
+import re
+from collections import Counter, defaultdict
+from math import log
+from threading import Lock
+
+from flask import current_app
+from sqlalchemy import case, event, func, or_
+from sqlalchemy.orm import joinedload
+
+from models import db, Message, User
+
+# same text search configuration as the indexes in models.py
+TS_CONFIG = 'english'
+
+
+class SearchResults:
+    """One page of ranked search results."""
+
+    def __init__(self, items, page, has_next):
+        self.items = items
+        self.page = page
+        self.has_next = has_next
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def backend():
+    """Which search implementation to use: 'postgres' or 'python'."""
+
+    configured = current_app.config.get('SEARCH_BACKEND', 'auto')
+    if configured != 'auto':
+        return configured
+    return 'postgres' if db.engine.dialect.name == 'postgresql' else 'python'
+
+
+def search_users(q, page=1, per_page=20):
+    """Users whose username contains `q` or whose bio matches it, best first."""
+
+    if backend() == 'postgres':
+        return _page(_postgres_users_query(q), page, per_page)
+    return _python_search('users', User, q, page, per_page)
+
+
+def search_messages(q, page=1, per_page=20):
+    """Messages whose text matches `q`, best first, with their authors."""
+
+    if backend() == 'postgres':
+        return _page(_postgres_messages_query(q), page, per_page)
+    return _python_search('messages', Message, q, page, per_page)
+
+
+def _page(query, page, per_page):
+    # ranked results have no stable key to seek on, so search pages use
+    # OFFSET; the match itself is what the indexes make cheap
+    rows = query.offset((page - 1) * per_page).limit(per_page + 1).all()
+    return SearchResults(rows[:per_page], page, len(rows) > per_page)
+
+
+##############################################################################
+# Postgres
+
+def _escape_like(text):
+    return re.sub(r'([\\%_])', r'\\\1', text)
+
+
+def _postgres_users_query(q):
+    tsquery = func.plainto_tsquery(TS_CONFIG, q)
+    bio = func.to_tsvector(TS_CONFIG, func.coalesce(User.bio, ''))
+    username_hit = User.username.ilike(f"%{_escape_like(q)}%", escape='\\')
+
+    return (User
+            .query
+            .filter(or_(username_hit, bio.op('@@')(tsquery)))
+            .order_by(username_hit.desc(),
+                      case([(username_hit, func.length(User.username))]),
+                      func.ts_rank(bio, tsquery).desc(),
+                      User.id))
+
+
+def _postgres_messages_query(q):
+    tsquery = func.plainto_tsquery(TS_CONFIG, q)
+    text = func.to_tsvector(TS_CONFIG, Message.text)
+
+    return (Message
+            .query
+            .options(joinedload(Message.user))
+            .filter(text.op('@@')(tsquery))
+            .order_by(func.ts_rank(text, tsquery).desc(),
+                      Message.timestamp.desc(),
+                      Message.id.desc()))
+
+
+##############################################################################
+# Pure-Python fallback
+
+def words(text):
+    """Lowercased words in `text`."""
+
+    return re.findall(r'\w+', (text or '').lower())
+
+
+def trigrams(text):
+    """Overlapping three-letter chunks of `text`, lowercased."""
+
+    text = (text or '').lower()
+    return [text[i:i + 3] for i in range(len(text) - 2)]
+
+
+class InvertedIndex:
+    """Maps terms to the documents containing them, for ranked lookups."""
+
+    def __init__(self):
+        self.postings = defaultdict(dict)      # term -> {doc id: count}
+        self.documents = {}                    # doc id -> Counter of terms
+
+    def add(self, doc_id, terms):
+        self.remove(doc_id)
+        counts = Counter(terms)
+        self.documents[doc_id] = counts
+        for term, count in counts.items():
+            self.postings[term][doc_id] = count
+
+    def remove(self, doc_id):
+        for term in self.documents.pop(doc_id, ()):
+            postings = self.postings[term]
+            postings.pop(doc_id, None)
+            if not postings:
+                del self.postings[term]
+
+    def search(self, terms):
+        """{doc id: tf-idf score} for documents containing all of `terms`."""
+
+        terms = set(terms)
+        if not terms:
+            return {}
+
+        # intersect starting from the rarest term
+        postings = sorted((self.postings.get(term, {}) for term in terms), key=len)
+        matches = set(postings[0])
+        for more in postings[1:]:
+            matches &= more.keys()
+
+        total = len(self.documents) or 1
+        scores = {}
+        for doc_id in matches:
+            scores[doc_id] = sum(
+                self.postings[term][doc_id] * log(1 + total / len(self.postings[term]))
+                for term in terms)
+        return scores
+
+
+class UserIndex:
+    """Usernames by trigram (for substring matches) and bios by word."""
+
+    def __init__(self):
+        self.usernames = {}
+        self.username_trigrams = InvertedIndex()
+        self.bios = InvertedIndex()
+
+    def add(self, user_id, username, bio):
+        self.usernames[user_id] = username or ''
+        self.username_trigrams.add(user_id, trigrams(username))
+        self.bios.add(user_id, words(bio))
+
+    def remove(self, user_id):
+        self.usernames.pop(user_id, None)
+        self.username_trigrams.remove(user_id)
+        self.bios.remove(user_id)
+
+    def search(self, q):
+        needle = q.lower()
+        if len(needle) >= 3:
+            # every trigram of the query must appear in a matching username
+            candidates = self.username_trigrams.search(trigrams(needle))
+        else:
+            candidates = self.usernames
+
+        # username hits rank above bio-only hits (bio scores are squashed
+        # below 1), closest usernames first
+        scores = {}
+        for user_id, score in self.bios.search(words(q)).items():
+            scores[user_id] = score / (1 + score)
+
+        for user_id in candidates:
+            username = self.usernames[user_id].lower()
+            if needle in username:
+                scores[user_id] = 1 + len(needle) / len(username)
+
+        return scores
+
+
+class MessageIndex(InvertedIndex):
+    """Message text by word."""
+
+    def add(self, message_id, text):
+        super().add(message_id, words(text))
+
+    def search(self, q):
+        return super().search(words(q))
+
+
+class PythonIndexes:
+    def __init__(self):
+        self.users = UserIndex()
+        self.messages = MessageIndex()
+        self.lock = Lock()
+
+
+_indexes = None
+_build_lock = Lock()
+
+
+def _python_indexes():
+    """The in-process indexes, built from the database on first use."""
+
+    global _indexes
+
+    with _build_lock:
+        if _indexes is None:
+            indexes = PythonIndexes()
+            users = db.session.query(User.id, User.username, User.bio)
+            for user_id, username, bio in users.yield_per(1000):
+                indexes.users.add(user_id, username, bio)
+            messages = db.session.query(Message.id, Message.text)
+            for message_id, text in messages.yield_per(1000):
+                indexes.messages.add(message_id, text)
+            _indexes = indexes
+
+    return _indexes
+
+
+def reset():
+    """Throw away the in-process indexes; they're rebuilt on next search.
+
+    Call this after changing users or messages behind the ORM's back (bulk
+    loads, bulk deletes).
+    """
+
+    global _indexes
+    with _build_lock:
+        _indexes = None
+
+
+def _python_search(kind, model, q, page, per_page):
+    indexes = _python_indexes()
+    with indexes.lock:
+        scores = getattr(indexes, kind).search(q)
+
+    # best score first; ties go the same way as on Postgres
+    if model is Message:
+        ranked = sorted(scores, key=lambda doc_id: (-scores[doc_id], -doc_id))
+    else:
+        ranked = sorted(scores, key=lambda doc_id: (-scores[doc_id], doc_id))
+    start = (page - 1) * per_page
+    ids = ranked[start:start + per_page]
+
+    query = model.query.filter(model.id.in_(ids)) if ids else []
+    if ids and model is Message:
+        query = query.options(joinedload(Message.user))
+    by_id = {item.id: item for item in query}
+
+    items = [by_id[doc_id] for doc_id in ids if doc_id in by_id]
+    return SearchResults(items, page, len(ranked) > start + per_page)
+
+
+# Keep the in-process indexes in step with committed changes. Nothing is
+# recorded until an index has been built.
+
+@event.listens_for(db.session, 'after_flush')
+def _record_changes(session, flush_context):
+    if _indexes is None:
+        return
+
+    changes = session.info.setdefault('search_changes', [])
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, User):
+            changes.append(('user', obj.id, (obj.username, obj.bio)))
+        elif isinstance(obj, Message):
+            changes.append(('message', obj.id, (obj.text,)))
+    for obj in session.deleted:
+        if isinstance(obj, (User, Message)):
+            kind = 'user' if isinstance(obj, User) else 'message'
+            changes.append((kind, obj.id, None))
+
+
+@event.listens_for(db.session, 'after_commit')
+def _apply_changes(session):
+    changes = session.info.pop('search_changes', [])
+    indexes = _indexes
+    if indexes is None or not changes:
+        return
+
+    with indexes.lock:
+        for kind, doc_id, fields in changes:
+            index = indexes.users if kind == 'user' else indexes.messages
+            if fields is None:
+                index.remove(doc_id)
+            else:
+                index.add(doc_id, *fields)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_changes(session):
+    session.info.pop('search_changes', None)
@@ -0,0 +1,71 @@
+// Like and follow buttons without a page reload.
+//
+// Forms marked with data-api-url are sent to the JSON API in app.py
+// instead: POST to like/follow, DELETE to undo. Without JavaScript they
+// still submit normally.
+//
+// The homepage's feed also gets new messages as they're posted.
+
+$(function () {
+  // the form actions used when JavaScript is off, kept in step with state
+  var FORM_ACTIONS = {
+    like: function (id) { return '/users/add_like/' + id; },
+    follow: function (id, on) {
+      return on ? '/users/stop-following/' + id : '/users/follow/' + id;
+    }
+  };
+
+  function updateCounts(counts) {
+    $.each(counts, function (userId, userCounts) {
+      $.each(userCounts, function (name, value) {
+        $('[data-user-stat="' + userId + ':' + name + '"]').text(value);
+      });
+    });
+  }
+
+  function render($form, on) {
+    var $button = $form.find('button');
+    $form.attr('data-active', on ? 'true' : 'false');
+
+    if ($form.data('kind') === 'like') {
+      $button.toggleClass('btn-primary', on).toggleClass('btn-secondary', !on);
+    } else {
+      $button.toggleClass('btn-primary', on).toggleClass('btn-outline-primary', !on);
+      $button.text(on ? 'Unfollow' : 'Follow');
+    }
+    $form.attr('action', FORM_ACTIONS[$form.data('kind')]($form.data('id'), on));
+  }
+
+  $(document).on('submit', 'form[data-api-url]', function (evt) {
+    evt.preventDefault();
+
+    var $form = $(this);
+    var on = $form.attr('data-active') === 'true';
+    var $button = $form.find('button').prop('disabled', true);
+
+    $.ajax({
+      url: $form.data('api-url'),
+      method: on ? 'DELETE' : 'POST',
+      dataType: 'json'
+    }).done(function (resp) {
+      render($form, $form.data('kind') === 'like' ? resp.liked : resp.following);
+      updateCounts(resp.counts);
+    }).fail(function (xhr) {
+      if (xhr.status === 401) {
+        window.location = '/login';
+      }
+    }).always(function () {
+      $button.prop('disabled', false);
+    });
+  });
+
+  // New messages, pushed by the server as they're posted (see live.py).
+  // EventSource reconnects by itself, picking up after the last one seen.
+  var $feed = $('#messages[data-stream-url]');
+  if ($feed.length && window.EventSource) {
+    var stream = new EventSource($feed.data('stream-url'));
+    stream.onmessage = function (evt) {
+      $feed.prepend(evt.data);
+    };
+  }
+});
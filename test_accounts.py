@@ -0,0 +1,128 @@
+"""Account deletion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_accounts.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, Job, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
+
+from app import app, CURR_USER_KEY
+from accounts import account_deleter, delete_account
+from jobs import Worker
+import timeline
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class DeleteAccountTestCase(TestCase):
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        users = [User(email=f"u{n}@test.com", username=f"user{n}",
+                      password="HASHED_PASSWORD") for n in range(3)]
+        db.session.add_all(users)
+        db.session.commit()
+        self.u1, self.u2, self.u3 = [user.id for user in users]
+
+        mine = [Message(text=f"warble {n}", user_id=self.u1) for n in range(5)]
+        theirs = Message(text="someone else's", user_id=self.u2)
+        db.session.add_all(mine + [theirs])
+        db.session.add_all([
+            Follows(user_following_id=self.u1, user_being_followed_id=self.u2),
+            Follows(user_following_id=self.u3, user_being_followed_id=self.u1),
+            Follows(user_following_id=self.u3, user_being_followed_id=self.u2),
+        ])
+        db.session.commit()
+        self.theirs = theirs.id
+        db.session.add_all([Likes(user_id=self.u2, message_id=m.id) for m in mine[:3]] +
+                           [Likes(user_id=self.u3, message_id=mine[0].id),
+                            Likes(user_id=self.u1, message_id=theirs.id),
+                            Likes(user_id=self.u3, message_id=theirs.id)])
+        timeline.rebuild()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.expunge_all()
+        db.drop_all()
+
+    def counters(self):
+        rows = db.session.query(User.id, User.message_count, User.following_count,
+                                User.follower_count, User.like_count).order_by(User.id)
+        return [tuple(row) for row in rows]
+
+    def assertCountersAccurate(self):
+        counters = self.counters()
+        User.recount()
+        db.session.commit()
+        self.assertEqual(counters, self.counters())
+
+    def test_deletes_everything(self):
+        progress = []
+        forgotten = set()
+        delete_account(self.u1, chunk_size=2,
+                       progress=lambda done, total: progress.append((done, total)),
+                       forget_users=lambda *ids: forgotten.update(ids))
+
+        self.assertIsNone(User.query.get(self.u1))
+        self.assertEqual(Message.query.filter_by(user_id=self.u1).count(), 0)
+        self.assertEqual(Follows.query.count(), 1)
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual({entry.user_id for entry in TimelineEntry.query}, {self.u2, self.u3})
+        self.assertEqual(TimelineEntry.query.filter(
+            TimelineEntry.message_id != self.theirs).count(), 0)
+
+        self.assertCountersAccurate()
+        self.assertEqual(self.counters(), [(self.u2, 1, 0, 1, 0), (self.u3, 0, 1, 0, 1)])
+        self.assertEqual(forgotten, {self.u1, self.u2, self.u3})
+
+        # 5 messages + 1 following + 1 follower + 1 like, a few at a time
+        self.assertEqual(progress[-1], (8, 8))
+        self.assertGreater(len(progress), 4)
+        self.assertEqual(progress, sorted(progress))
+
+    def test_missing_user(self):
+        delete_account(12345)
+        self.assertEqual(User.query.count(), 3)
+
+    def test_big_accounts_in_background(self):
+        sync_limit = account_deleter.sync_limit
+        account_deleter.sync_limit = 2
+        eager, in_process = app.config['JOBS_EAGER'], app.config['JOBS_IN_PROCESS']
+        app.config['JOBS_EAGER'] = False
+        app.config['JOBS_IN_PROCESS'] = False
+        try:
+            with app.app_context():
+                queued = account_deleter.delete(User.query.get(self.u1))
+                self.assertEqual(queued.name, 'delete_account')
+                self.assertIsNotNone(User.query.get(self.u1))
+
+            Worker(app).run(burst=True)
+        finally:
+            account_deleter.sync_limit = sync_limit
+            app.config['JOBS_EAGER'], app.config['JOBS_IN_PROCESS'] = eager, in_process
+
+        db.session.expunge_all()
+        self.assertIsNone(User.query.get(self.u1))
+        self.assertEqual(Job.query.count(), 0)
+        self.assertCountersAccurate()
+
+    def test_delete_view(self):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1
+            resp = client.post("/users/delete", follow_redirects=True)
+            self.assertIn("User and User Warbles Deleted", resp.get_data(as_text=True))
+
+        self.assertIsNone(User.query.get(self.u1))
+        self.assertCountersAccurate()
@@ -0,0 +1,181 @@
+"""Async serving mode tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_asgi.py
+
+
+import asyncio
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
+
+from app import app, CURR_USER_KEY, user_cache
+from asgi import application
+from fragments import fragment_cache
+from instrumentation import profiler
+import timeline
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def call(path, cookie=None, method='GET', headers=(), body=b''):
+    """Send a request through the ASGI app; (status, headers, body)."""
+
+    path, _, query = path.partition('?')
+    scope = {
+        'type': 'http', 'method': method, 'path': path,
+        'query_string': query.encode(), 'root_path': '', 'scheme': 'http',
+        'server': ('localhost', 80), 'client': ('127.0.0.1', 1234),
+        'headers': [(name.lower().encode(), value.encode()) for name, value in headers],
+    }
+    if cookie:
+        scope['headers'].append((b'cookie', cookie.encode()))
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(application(scope, receive, send))
+    start = sent[0]
+    return (start['status'], dict(start['headers']),
+            b''.join(message.get('body', b'') for message in sent[1:]))
+
+
+class AsgiTestCase(TestCase):
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        user_cache.clear()
+        fragment_cache.clear()
+
+        users = [User(email=f"{name}@test.com", username=name, password="HASHED_PASSWORD")
+                 for name in ("reader", "author", "stranger")]
+        db.session.add_all(users)
+        db.session.commit()
+        self.reader, self.author, self.stranger = [user.id for user in users]
+
+        db.session.add(Follows(user_being_followed_id=self.author,
+                               user_following_id=self.reader))
+        messages = [Message(text=f"warble {n}", user_id=self.author) for n in range(5)]
+        db.session.add_all(messages)
+        db.session.commit()
+        self.message = messages[0].id
+        db.session.add(Likes(user_id=self.reader, message_id=self.message))
+        db.session.commit()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader
+        self.cookie = "; ".join(f"{cookie.name}={cookie.value}"
+                                for cookie in self.client.cookie_jar)
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+
+    def assertSameAsWsgi(self, path, cookie=True):
+        """The ASGI app answers `path` just as the Flask app does."""
+
+        client = self.client if cookie else app.test_client()
+        expected = client.get(path)
+        status, headers, body = call(path, self.cookie if cookie else None)
+
+        self.assertEqual(status, expected.status_code)
+        self.assertEqual(body.decode(), expected.get_data(as_text=True))
+        self.assertEqual(headers.get(b'etag', b'').decode(),
+                         expected.headers.get('ETag', ''))
+        return body.decode()
+
+    def test_pages(self):
+        for path in ("/", f"/users/{self.author}", f"/users/{self.reader}",
+                     "/users", f"/messages/{self.message}",
+                     f"/users/{self.reader}/likes"):
+            with self.subTest(path=path):
+                self.assertSameAsWsgi(path)
+
+        for path in ("/", f"/users/{self.author}", "/users",
+                     f"/users/{self.reader}/likes"):
+            with self.subTest(path=path, anonymous=True):
+                self.assertSameAsWsgi(path, cookie=False)
+
+    def test_pages_with_fanout(self):
+        app.config['TIMELINE_FANOUT'] = True
+        try:
+            timeline.rebuild()
+            db.session.commit()
+            self.assertSameAsWsgi("/")
+        finally:
+            app.config['TIMELINE_FANOUT'] = False
+
+    def test_pagination(self):
+        per_page = app.config['MESSAGES_PER_PAGE'], app.config['USERS_PER_PAGE']
+        app.config['MESSAGES_PER_PAGE'] = 2
+        app.config['USERS_PER_PAGE'] = 2
+        try:
+            page = self.assertSameAsWsgi(f"/users/{self.author}")
+            self.assertIn("before=", page)
+            cursor = page.split("before=")[1].split('"')[0]
+            self.assertSameAsWsgi(f"/users/{self.author}?before={cursor}")
+
+            page = self.assertSameAsWsgi("/users")
+            cursor = page.split("after=")[1].split('"')[0]
+            self.assertSameAsWsgi(f"/users?after={cursor}")
+        finally:
+            app.config['MESSAGES_PER_PAGE'], app.config['USERS_PER_PAGE'] = per_page
+
+    def test_cached_viewer_has_no_secrets(self):
+        call("/", self.cookie)
+        record = user_cache.get(self.reader)
+        self.assertEqual(set(record), set(User.CACHE_COLUMNS))
+
+        # and the Flask side can use what the async side cached
+        self.assertSameAsWsgi("/")
+
+    def test_profiled(self):
+        profiler.reset()
+        call(f"/users/{self.author}", self.cookie)
+
+        self.assertEqual(profiler.requests[('users_show', 'GET', 200)], 1)
+        queries = profiler.histograms[('warbler_request_queries', 'users_show')]
+        self.assertGreaterEqual(queries.sum, 3)
+
+    def test_not_modified(self):
+        etag = self.client.get(f"/users/{self.author}").headers['ETag']
+        status, headers, body = call(f"/users/{self.author}", self.cookie,
+                                     headers=[('If-None-Match', etag)])
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b'')
+
+    def test_not_found(self):
+        self.assertEqual(call("/users/999999", self.cookie)[0], 404)
+        self.assertEqual(call("/messages/999999", self.cookie)[0], 404)
+        self.assertEqual(call("/users/999999/likes")[0], 404)
+        self.assertEqual(call("/no-such-page")[0], 404)
+
+    def test_falls_back_to_flask(self):
+        # a search
+        status, headers, body = call("/users?q=auth", self.cookie)
+        self.assertEqual(status, 200)
+        self.assertIn(b"@author", body)
+
+        # a redirect for anonymous users
+        status, headers, body = call(f"/messages/{self.message}")
+        self.assertEqual(status, 302)
+
+        # a form
+        status, headers, body = call(
+            "/messages/new", self.cookie, method='POST',
+            headers=[('Content-Type', 'application/x-www-form-urlencoded')],
+            body=b"text=posted+over+asgi")
+        self.assertEqual(status, 302)
+        self.assertEqual(Message.query.filter_by(text="posted over asgi").count(), 1)
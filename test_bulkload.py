@@ -0,0 +1,130 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_bulkload.py
+
+
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from sqlalchemy import create_engine, inspect
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheap password hashes keep the tests fast
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
+
+
+# Now we can import app
+
+from app import app
+from bulkload import chunks, indexes_deferred, load_csv
+
+db.create_all()
+
+USERS_CSV = '''\
+email,username,image_url,password,bio,header_image_url,location
+a@test.com,alpha,/a.png,x,"Likes commas, and ""quotes""",/ha.png,Aville
+b@test.com,beta,/b.png,x,,/hb.png,
+c@test.com,gamma,/c.png,x,Third,/hc.png,Ctown
+'''
+
+MESSAGES_CSV = '''\
+text,timestamp,user_id
+first,2017-01-21 11:04:53.522807,1
+second,2017-10-21 07:01:06.023966,2
+'''
+
+
+class BulkLoadTests:
+    """Loader tests, run against each kind of database."""
+
+    def make_engine(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.engine = self.make_engine()
+        db.metadata.drop_all(self.engine)
+        db.metadata.create_all(self.engine)
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        db.metadata.drop_all(self.engine)
+        self.dir.cleanup()
+
+    def write_csv(self, name, text):
+        path = os.path.join(self.dir.name, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_load_users(self):
+        progress = []
+        stats = load_csv(self.engine, User.__table__,
+                         self.write_csv('users.csv', USERS_CSV),
+                         chunk_size=2, progress=progress.append)
+
+        self.assertEqual(stats.rows, 3)
+        self.assertEqual([p.rows for p in progress], [2, 3])
+
+        rows = self.engine.execute(
+            "SELECT username, bio, location, message_count FROM users ORDER BY id"
+        ).fetchall()
+        self.assertEqual([tuple(row) for row in rows], [
+            ("alpha", 'Likes commas, and "quotes"', "Aville", 0),
+            ("beta", None, None, 0),
+            ("gamma", "Third", "Ctown", 0),
+        ])
+
+    def test_load_messages(self):
+        load_csv(self.engine, User.__table__, self.write_csv('users.csv', USERS_CSV))
+        load_csv(self.engine, Message.__table__,
+                 self.write_csv('messages.csv', MESSAGES_CSV))
+
+        (timestamp,) = self.engine.execute(
+            "SELECT timestamp FROM messages WHERE text = 'second'").fetchone()
+        if isinstance(timestamp, str):
+            timestamp = datetime.fromisoformat(timestamp)
+        self.assertEqual(timestamp, datetime(2017, 10, 21, 7, 1, 6, 23966))
+
+    def test_indexes_deferred(self):
+        tables = [Message.__table__, Follows.__table__]
+
+        def index_names():
+            inspector = inspect(self.engine)
+            return {index['name'] for table in tables
+                    for index in inspector.get_indexes(table.name)}
+
+        before = index_names()
+        self.assertIn('ix_messages_user_timestamp', before)
+
+        with indexes_deferred(self.engine, tables):
+            self.assertNotIn('ix_messages_user_timestamp', index_names())
+            self.assertNotIn('ix_follows_following_followed', index_names())
+
+        self.assertEqual(index_names(), before)
+
+
+class PostgresBulkLoadTestCase(BulkLoadTests, TestCase):
+    def make_engine(self):
+        return db.engine
+
+
+class SQLiteBulkLoadTestCase(BulkLoadTests, TestCase):
+    def make_engine(self):
+        return create_engine('sqlite://')
+
+
+class ChunksTestCase(TestCase):
+    def test_chunks(self):
+        self.assertEqual(list(chunks(range(5), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(chunks([], 2)), [])
@@ -0,0 +1,111 @@
+"""Connection pool tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_dbpool.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import create_engine, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool
+
+from models import db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
+
+from app import app
+from dbpool import PoolStats, TimedQueuePool, pool_options
+
+db.create_all()
+
+
+class PoolOptionsTestCase(TestCase):
+    def test_sized_from_config(self):
+        config = dict(DATABASE_POOL_SIZE=3, DATABASE_MAX_OVERFLOW=1,
+                      DATABASE_POOL_TIMEOUT=2, DATABASE_POOL_RECYCLE=60,
+                      DATABASE_POOL_PRE_PING=False)
+        options = pool_options(config, make_url("postgresql:///warbler-test"))
+        self.assertEqual(options, dict(poolclass=TimedQueuePool, pool_size=3,
+                                       max_overflow=1, pool_timeout=2,
+                                       pool_recycle=60, pool_pre_ping=False))
+
+    def test_pgbouncer(self):
+        options = pool_options(dict(DATABASE_PGBOUNCER=True),
+                               make_url("postgresql:///warbler-test"))
+        self.assertEqual(options, dict(poolclass=NullPool))
+
+    def test_sqlite(self):
+        self.assertEqual(pool_options(dict(DATABASE_POOL_SIZE=3), make_url("sqlite://")), {})
+
+    def test_app_engine(self):
+        pool = db.engine.pool
+        self.assertIsInstance(pool, TimedQueuePool)
+        self.assertEqual(pool.size(), app.config['DATABASE_POOL_SIZE'])
+
+
+class PoolStatsTestCase(TestCase):
+    def setUp(self):
+        self.engine = self.create_engine()
+        self.stats = PoolStats()
+        self.stats.listen(self.engine.pool)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def create_engine(self):
+        return create_engine("postgresql:///warbler-test",
+                             **pool_options(dict(DATABASE_POOL_SIZE=1,
+                                                 DATABASE_MAX_OVERFLOW=0,
+                                                 DATABASE_POOL_TIMEOUT=0.01),
+                                            make_url("postgresql:///warbler-test")))
+
+    def test_checkouts_and_timeouts(self):
+        stats = self.stats
+        collect = stats.collector(lambda: self.engine.pool)
+
+        conn = self.engine.connect()
+        self.assertEqual(stats.in_use, 1)
+        self.assertEqual(stats.opened, 1)
+        with self.assertRaises(exc.TimeoutError):
+            self.engine.connect()
+        self.assertEqual(stats.timeouts, 1)
+        self.assertIn("warbler_db_pool_idle 0", collect())
+
+        conn.close()
+        self.assertEqual(stats.in_use, 0)
+        self.assertEqual(stats.wait.count, 2)
+        lines = collect()
+        self.assertIn("warbler_db_pool_idle 1", lines)
+        self.assertIn("warbler_db_pool_size 1", lines)
+        self.assertIn("warbler_db_pool_timeouts_total 1", lines)
+
+    def test_only_its_own_pool(self):
+        other = self.create_engine()
+        try:
+            other.connect().close()
+            db.engine.connect().close()
+        finally:
+            other.dispose()
+        self.assertEqual((self.stats.opened, self.stats.wait.count), (0, 0))
+
+        # still counting after the engine replaces its pool
+        self.engine.dispose()
+        self.engine.connect().close()
+        self.assertEqual((self.stats.opened, self.stats.wait.count), (1, 1))
+
+    def test_metrics_endpoint(self):
+        enabled = app.config['METRICS_ENABLED']
+        app.config['METRICS_ENABLED'] = True
+        try:
+            with app.test_client() as client:
+                resp = client.get('/metrics')
+        finally:
+            app.config['METRICS_ENABLED'] = enabled
+        body = resp.get_data(as_text=True)
+        self.assertIn("warbler_db_pool_in_use", body)
+        self.assertIn('warbler_db_pool_checkout_wait_seconds_bucket{le="+Inf"}', body)
+        self.assertIn(f"warbler_db_pool_size {app.config['DATABASE_POOL_SIZE']}", body)
@@ -0,0 +1,114 @@
+"""Fragment cache tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_fragments.py
+
+
+import os
+from unittest import TestCase
+
+from bs4 import BeautifulSoup
+
+from models import db, Message, User, Likes
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheap password hashes keep the tests fast
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY, user_cache
+from fragments import (fragment_cache, BUTTON_STATES, MESSAGE_CARD,
+                       PROFILE_MESSAGE_CARD)
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FragmentCacheTestCase(TestCase):
+    """Test cached message and user cards."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        user_cache.clear()
+        fragment_cache.clear()
+
+        self.client = app.test_client()
+
+        self.author = User.signup("author", "author@test.com", "password", None)
+        self.author.id = 111
+        self.reader = User.signup("reader", "reader@test.com", "password", None)
+        self.reader.id = 222
+        db.session.commit()
+
+        db.session.add(Message(id=1000, text="original text", user_id=111))
+        db.session.commit()
+        db.session.add(Likes(user_id=222, message_id=1000))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def get(self, url, user_id):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            return c.get(url).get_data(as_text=True)
+
+    def test_cards_come_from_the_cache(self):
+        self.assertIn("original text", self.get("/users/222/likes", 222))
+
+        # messages can't be edited, so this only shows up once the card goes
+        Message.query.get(1000).text = "sneaky edit"
+        db.session.commit()
+        self.assertIn("original text", self.get("/users/222/likes", 222))
+
+        fragment_cache.forget_messages(1000)
+        self.assertIn("sneaky edit", self.get("/users/222/likes", 222))
+
+    def test_profile_changes_show_at_once(self):
+        self.assertIn("@author", self.get("/users/222/likes", 222))
+        self.assertIn("@author", self.get("/users", 222))
+
+        User.query.get(111).username = "renamed"
+        db.session.commit()
+
+        self.assertIn("@renamed", self.get("/users/222/likes", 222))
+        self.assertIn("@renamed", self.get("/users", 222))
+
+    def test_buttons_are_per_viewer(self):
+        def pressed(html):
+            soup = BeautifulSoup(html, 'html.parser')
+            return [form["data-active"] for form in soup.select(".messages-form")]
+
+        # the reader liked the message; the author didn't
+        self.assertEqual(pressed(self.get("/users/111", 222)), ["true"])
+        self.assertEqual(pressed(self.get("/users/111", 111)), ["false"])
+        self.assertEqual(pressed(self.get("/users/111", 222)), ["true"])
+
+        soup = BeautifulSoup(self.get("/users", 222), 'html.parser')
+        self.assertEqual([form["data-id"] for form in soup.select(".user-card form")],
+                         ["111"])
+
+    def test_deleting_a_message_forgets_its_card(self):
+        def cached_cards():
+            return [state for template in [MESSAGE_CARD, PROFILE_MESSAGE_CARD]
+                    for state in BUTTON_STATES
+                    if fragment_cache.backend.get(f"{template}:1000:{state}")]
+
+        self.get("/users/111", 111)
+        self.assertEqual(cached_cards(), [False])
+
+        with self.client as c:
+            c.post("/messages/1000/delete")
+
+        self.assertEqual(cached_cards(), [])
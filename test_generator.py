@@ -0,0 +1,126 @@
+"""Sample data generator tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_generator.py
+
+
+import csv
+import os
+import subprocess
+import sys
+import tempfile
+from collections import Counter
+from datetime import datetime, timedelta
+from random import Random
+from unittest import TestCase
+
+from generator.helpers import AffinePermutation, BurstyClock, PowerLawDegrees, Zipf
+
+GENERATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'generator', 'create_csvs.py')
+
+
+class HelpersTestCase(TestCase):
+    def test_affine_permutation_visits_everything_once(self):
+        for n in [1, 2, 7, 12, 30, 97]:
+            perm = AffinePermutation(n, Random(n))
+            self.assertEqual(sorted(perm[i] for i in range(n)), list(range(n)))
+
+    def test_zipf_skew(self):
+        rng = Random(0)
+        draws = [Zipf(1000, 1.0).sample(rng) for _ in range(10000)]
+
+        self.assertTrue(all(1 <= rank <= 1000 for rank in draws))
+        # rank 1 alone gets about 1/ln(1000) of the draws; the median is low
+        self.assertGreater(draws.count(1), 1000)
+        self.assertLess(sorted(draws)[5000], 100)
+
+    def test_power_law_degrees(self):
+        rng = Random(0)
+        degrees = PowerLawDegrees(500, 1.0, total=5000, cap=499)
+        counts = [degrees.degree(rank, rng) for rank in range(1, 501)]
+
+        self.assertAlmostEqual(sum(counts), 5000, delta=250)
+        self.assertLessEqual(max(counts), 499)
+        self.assertGreater(counts[0], 50 * sorted(counts)[250])
+
+        everyone = PowerLawDegrees(10, 1.0, total=90, cap=9)
+        self.assertEqual([everyone.degree(rank, rng) for rank in range(1, 11)], [9] * 10)
+
+
+    def test_bursty_clock(self):
+        # a leap day has no date a year or two before it
+        until = datetime(2024, 2, 29)
+        clock = BurstyClock(0, until)
+        rng = Random(0)
+        times = [clock(rng) for _ in range(1000)]
+
+        self.assertTrue(all(until - timedelta(days=730) <= when <= until for when in times))
+        # quieter in the small hours (UTC)
+        hours = Counter(when.hour for when in times)
+        self.assertGreater(hours[19], 2 * hours[3])
+
+
+class CreateCSVsTestCase(TestCase):
+    def generate(self, out, *args, env=None):
+        subprocess.run([sys.executable, GENERATOR, '--out', out,
+                        '--users', '40', '--messages', '120', '--follows', '300',
+                        '--likes', '200',
+                        '--part-rows', '25', '--until', '2020-01-01', *args],
+                       check=True, stdout=subprocess.DEVNULL,
+                       env=env and {**os.environ, **env})
+
+        tables = {}
+        for name in ['users', 'messages', 'follows', 'likes']:
+            with open(os.path.join(out, f"{name}.csv"), newline='') as f:
+                tables[name] = list(csv.DictReader(f))
+        return tables
+
+    def test_sizes_and_uniqueness(self):
+        with tempfile.TemporaryDirectory() as out:
+            tables = self.generate(out)
+
+        self.assertEqual(len(tables['users']), 40)
+        self.assertEqual(len(tables['messages']), 120)
+        self.assertEqual(len({u['username'] for u in tables['users']}), 40)
+        self.assertEqual(len({u['email'] for u in tables['users']}), 40)
+
+        # follows and likes hit their targets roughly, never repeating
+        follows = [(f['user_being_followed_id'], f['user_following_id'])
+                   for f in tables['follows']]
+        self.assertAlmostEqual(len(follows), 300, delta=30)
+        self.assertEqual(len(set(follows)), len(follows))
+        self.assertFalse(any(a == b for a, b in follows))
+
+        likes = [(l['user_id'], l['message_id']) for l in tables['likes']]
+        self.assertAlmostEqual(len(likes), 200, delta=30)
+        self.assertEqual(len(set(likes)), len(likes))
+        self.assertTrue(all(1 <= int(m) <= 120 for u, m in likes))
+
+    def test_activity_is_skewed(self):
+        with tempfile.TemporaryDirectory() as out:
+            tables = self.generate(out, '--users', '200', '--follows', '2000')
+
+        followers = Counter(f['user_being_followed_id'] for f in tables['follows'])
+        counts = sorted(followers.values(), reverse=True)
+        self.assertGreater(counts[0], 10 * counts[len(counts) // 2])
+
+        posts = Counter(m['user_id'] for m in tables['messages'])
+        # the most followed account is also the busiest poster
+        self.assertEqual(posts.most_common(1)[0][0], followers.most_common(1)[0][0])
+
+    def test_same_seed_same_output_whatever_the_workers(self):
+        with tempfile.TemporaryDirectory() as one, tempfile.TemporaryDirectory() as two:
+            self.assertEqual(self.generate(one, '--workers', '1'),
+                             self.generate(two, '--workers', '3'))
+
+    def test_same_output_in_any_timezone(self):
+        with tempfile.TemporaryDirectory() as one, tempfile.TemporaryDirectory() as two:
+            self.assertEqual(self.generate(one, env={'TZ': 'UTC'}),
+                             self.generate(two, env={'TZ': 'America/New_York'}))
+
+    def test_different_seed_different_output(self):
+        with tempfile.TemporaryDirectory() as one, tempfile.TemporaryDirectory() as two:
+            self.assertNotEqual(self.generate(one, '--seed', '1'),
+                                self.generate(two, '--seed', '2'))
@@ -0,0 +1,137 @@
+"""Query instrumentation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_instrumentation.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
+
+from app import app
+from instrumentation import count_queries, fingerprint, profiler
+from benchmarks.routes import compare, percentile
+
+db.create_all()
+
+
+class CountQueriesTestCase(TestCase):
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        for n in range(3):
+            db.session.add(User(email=f"u{n}@test.com", username=f"user{n}",
+                                password="HASHED_PASSWORD"))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+
+    def test_counts_statements_and_rows(self):
+        with count_queries(db.engine) as log:
+            User.query.all()
+            User.query.filter_by(username="user1").all()
+
+        self.assertEqual(len(log), 2)
+        self.assertEqual(log.rows, 4)
+        self.assertTrue(all("FROM users" in statement for statement in log))
+        self.assertGreater(log.seconds, 0)
+
+    def test_stops_recording_after_the_block(self):
+        with count_queries(db.engine) as log:
+            User.query.all()
+        User.query.all()
+
+        self.assertEqual(len(log), 1)
+
+
+class RequestProfilerTestCase(TestCase):
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        db.session.add(User(email="u@test.com", username="user",
+                            password="HASHED_PASSWORD"))
+        db.session.commit()
+        profiler.reset()
+        self.slow_request_ms = profiler.slow_request_ms
+        self.metrics_enabled = app.config['METRICS_ENABLED']
+        app.config['METRICS_ENABLED'] = True
+
+    def tearDown(self):
+        profiler.slow_request_ms = self.slow_request_ms
+        app.config['METRICS_ENABLED'] = self.metrics_enabled
+        db.session.rollback()
+        db.drop_all()
+
+    def metric(self, text, line_start):
+        for line in text.splitlines():
+            if line.startswith(line_start):
+                return float(line.rsplit(" ", 1)[1])
+        self.fail(f"no {line_start} in metrics")
+
+    def test_metrics(self):
+        with app.test_client() as c:
+            c.get("/users")
+            c.get("/users")
+            c.get("/login")
+            resp = c.get("/metrics")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith("text/plain"))
+        text = resp.get_data(as_text=True)
+
+        self.assertEqual(self.metric(text, 'warbler_requests_total{endpoint="list_users",'
+                                           'method="GET",status="200"}'), 2)
+        self.assertEqual(self.metric(text, 'warbler_requests_total{endpoint="login",'), 1)
+        self.assertEqual(self.metric(text, 'warbler_request_queries_count{endpoint="list_users"}'), 2)
+        self.assertGreater(self.metric(text, 'warbler_request_queries_sum{endpoint="list_users"}'), 0)
+        self.assertEqual(self.metric(text, 'warbler_request_queries_bucket{endpoint="login",le="0"}'), 1)
+        self.assertGreater(self.metric(text, 'warbler_request_render_seconds_sum{endpoint="list_users"}'), 0)
+        self.assertIn("# TYPE warbler_request_db_seconds histogram", text)
+
+    def test_metrics_off(self):
+        app.config['METRICS_ENABLED'] = False
+        with app.test_client() as c:
+            self.assertEqual(c.get("/metrics").status_code, 404)
+
+    def test_slow_requests_are_logged(self):
+        profiler.slow_request_ms = 0.001
+        with app.test_client() as c, self.assertLogs(app.logger, "WARNING") as logs:
+            c.get("/users")
+
+        (message,) = logs.output
+        self.assertIn("slow request: GET /users (list_users)", message)
+        self.assertIn("FROM users", message)
+
+    def test_fingerprint(self):
+        self.assertEqual(
+            fingerprint("SELECT * FROM users\n WHERE users.id = %(id_1)s "
+                        "AND name = 'x''y' AND bio::text IN (%(p_1)s, %(p_2)s) AND f(%(a)s, %(b)s) LIMIT 10"),
+            "SELECT * FROM users WHERE users.id = ? AND name = ? "
+            "AND bio::text IN (...) AND f(?, ?) LIMIT ?")
+
+
+class BenchmarkResultsTestCase(TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([7], 95), 7)
+
+    def test_compare(self):
+        baseline = {'home': {'p95_ms': 10.0, 'queries': 3},
+                    'users': {'p95_ms': 10.0, 'queries': 2}}
+        routes = {'home': {'p95_ms': 12.0, 'queries': 3},
+                  'users': {'p95_ms': 20.0, 'queries': 5},
+                  'new': {'p95_ms': 99.0, 'queries': 9}}
+
+        self.assertEqual(compare(routes, baseline, tolerance=1.25), [
+            "users: p95 10.0ms -> 20.0ms",
+            "users: 2 -> 5 queries",
+        ])
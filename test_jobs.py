@@ -0,0 +1,156 @@
+"""Background job queue tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+import os
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, Job
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
+
+from app import app
+import jobs
+from jobs import JOBS, Worker, enqueue, job
+
+db.create_all()
+
+calls = []
+
+
+@job('test_record')
+def record(value):
+    calls.append(value)
+
+
+@job('test_flaky', max_attempts=2)
+def flaky(fail_times):
+    calls.append('flaky')
+    if calls.count('flaky') <= fail_times:
+        raise ValueError("not this time")
+
+
+@job('test_one_at_a_time', concurrency=1)
+def one_at_a_time():
+    calls.append('one')
+
+
+class JobsTestCase(TestCase):
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        calls.clear()
+        self.context = app.app_context()
+        self.context.push()
+        self.config = dict(app.config)
+        # queued jobs wait for the tests' own workers
+        app.config['JOBS_EAGER'] = False
+        app.config['JOBS_IN_PROCESS'] = False
+        self.worker = Worker(app, concurrency=1)
+        self.worker.retry_delay = 0
+
+    def tearDown(self):
+        app.config.update(self.config)
+        db.session.rollback()
+        self.context.pop()
+        db.drop_all()
+
+    def test_eager(self):
+        app.config['JOBS_EAGER'] = True
+        self.assertIsNone(enqueue('test_record', value=1))
+        self.assertEqual(calls, [1])
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_in_process(self):
+        app.config['JOBS_IN_PROCESS'] = True
+        enqueue('test_record', value=1)
+        db.session.commit()
+
+        worker = jobs._background[(app, os.getpid())]
+        worker.poll_interval = 0.05
+        try:
+            for _ in range(100):
+                if calls:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(calls, [1])
+        finally:
+            jobs._background.pop((app, os.getpid()))
+            worker.stop()
+
+    def test_unknown_job(self):
+        with self.assertRaises(KeyError):
+            enqueue('no_such_job')
+
+    def test_queued_until_run(self):
+        enqueue('test_record', value=1)
+        enqueue('test_record', value=2)
+        db.session.commit()
+        self.assertEqual(calls, [])
+
+        self.worker.run(burst=True)
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_only_queued_on_commit(self):
+        enqueue('test_record', value=1)
+        db.session.rollback()
+        self.worker.run(burst=True)
+        self.assertEqual(calls, [])
+
+    def test_delay(self):
+        enqueue('test_record', delay=60, value=1)
+        db.session.commit()
+        self.worker.run(burst=True)
+        self.assertEqual(calls, [])
+
+    def test_retries(self):
+        enqueue('test_flaky', fail_times=1)
+        db.session.commit()
+        self.worker.run(burst=True)
+        self.assertEqual(calls, ['flaky', 'flaky'])
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_gives_up(self):
+        enqueue('test_flaky', fail_times=5)
+        db.session.commit()
+        self.worker.run(burst=True)
+        self.assertEqual(calls, ['flaky', 'flaky'])
+
+        failed = Job.query.one()
+        self.assertEqual((failed.status, failed.attempts), ('failed', 2))
+        self.assertIn("ValueError: not this time", failed.error)
+
+    def test_claims_each_job_once(self):
+        enqueue('test_record', value=1)
+        db.session.commit()
+
+        claimed = self.worker.claim()
+        self.assertEqual(claimed[1], 'test_record')
+        self.assertIsNone(self.worker.claim())
+
+        # ...unless the worker running it seems to have died
+        db.session.query(Job).update(
+            {Job.started_at: datetime.utcnow() - timedelta(seconds=self.worker.stale_after + 1)})
+        db.session.commit()
+        self.assertEqual(self.worker.claim()[0], claimed[0])
+
+    def test_concurrency_limit(self):
+        enqueue('test_one_at_a_time')
+        enqueue('test_one_at_a_time')
+        enqueue('test_record', value=1)
+        db.session.commit()
+
+        self.assertEqual(self.worker.claim()[1], 'test_one_at_a_time')
+        self.assertEqual(self.worker.claim()[1], 'test_record')
+        self.assertIsNone(self.worker.claim())
+
+    def test_registered(self):
+        self.assertIn('delete_account', JOBS)
+        self.assertIn('deliver_to_followers', JOBS)
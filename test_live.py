@@ -0,0 +1,208 @@
+"""Live update tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_live.py
+
+
+import os
+import time
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
+
+from app import app, CURR_USER_KEY, user_cache
+from fragments import fragment_cache
+from live import CHANNEL, Hub, LocalBroker, PostgresBroker, live, sse
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class HubTestCase(TestCase):
+    def test_dispatch_by_topic(self):
+        hub = Hub()
+        one = hub.subscribe({1, 2})
+        other = hub.subscribe({3})
+        hub.dispatch(2, {'id': 10})
+        self.assertEqual(one.get(timeout=0), {'id': 10})
+        self.assertIsNone(other.get(timeout=0))
+
+        one.close()
+        one.close()
+        self.assertEqual(hub.count, 1)
+        hub.dispatch(2, {'id': 11})
+        self.assertIsNone(one.get(timeout=0))
+
+    def test_overflow(self):
+        hub = Hub()
+        subscription = hub.subscribe({1})
+        for id in range(subscription.queue.maxsize + 1):
+            hub.dispatch(1, {'id': id})
+        self.assertTrue(subscription.overflowed)
+
+    def test_sse(self):
+        self.assertEqual(sse("<li>\n</li>", id=3), "id: 3\ndata: <li>\ndata: </li>\n\n")
+
+
+class LiveTestCase(TestCase):
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        user_cache.clear()
+        fragment_cache.clear()
+
+        users = [User(email=f"{name}@test.com", username=name, password="HASHED_PASSWORD")
+                 for name in ("author", "reader", "stranger")]
+        db.session.add_all(users)
+        db.session.commit()
+        self.author, self.reader, self.stranger = [user.id for user in users]
+        db.session.add(Follows(user_being_followed_id=self.author,
+                               user_following_id=self.reader))
+        db.session.commit()
+
+        self.settings = (live.broker, live.max_streams, live.heartbeat, live.stream_seconds)
+        live.broker = LocalBroker(live.hub)
+        live.max_streams = 10
+        live.heartbeat = 0.01
+        live.stream_seconds = 0.2
+
+    def tearDown(self):
+        live.broker, live.max_streams, live.heartbeat, live.stream_seconds = self.settings
+        db.session.rollback()
+        db.drop_all()
+
+    def post(self, user_id, text):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            client.post("/messages/new", data={"text": text})
+
+    def test_only_committed_messages_are_published(self):
+        subscription = live.subscribe({self.author})
+        try:
+            with app.test_request_context():
+                live.publish(self.author, {'id': 1, 'data': 'rolled back'})
+                db.session.rollback()
+                live.publish(self.author, {'id': 2, 'data': 'committed'})
+                self.assertIsNone(subscription.get(timeout=0))
+                db.session.commit()
+            self.assertEqual(subscription.get(timeout=0)['data'], 'committed')
+        finally:
+            subscription.close()
+
+    def test_stream(self):
+        self.post(self.author, "before the stream")
+        first = Message.query.one().id
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.reader
+            resp = client.get(f"/stream?after={first - 1}", buffered=False)
+            self.assertEqual(resp.mimetype, 'text/event-stream')
+            chunks = (chunk.decode() for chunk in resp.response)
+
+            self.assertEqual(next(chunks), "retry: 1000\n\n")
+            self.assertIn("before the stream", next(chunks))
+            self.assertEqual(live.hub.count, 1)
+
+            self.post(self.stranger, "nobody follows me")
+            self.post(self.author, "hot off the press")
+            events = [chunk for chunk in chunks if not chunk.startswith(":")]
+            resp.close()
+
+        self.assertEqual(len(events), 1)
+        self.assertIn("hot off the press", events[0])
+        self.assertIn(f"id: {first + 2}\n", events[0])
+        # with a like button, as nobody has liked it yet
+        self.assertIn('data-active="false"', events[0])
+        self.assertEqual(live.hub.count, 0)
+
+    def test_stream_needs_login(self):
+        with app.test_client() as client:
+            self.assertEqual(client.get("/stream").status_code, 403)
+
+    def test_homepage_links_stream(self):
+        self.post(self.author, "hello")
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.reader
+            html = client.get("/").get_data(as_text=True)
+            older = client.get("/?before=x").get_data(as_text=True)
+
+        self.assertIn(f'data-stream-url="/stream?after={Message.query.one().id}"', html)
+        self.assertNotIn('data-stream-url', older)
+
+    def test_off_by_default(self):
+        live.broker = None
+        self.post(self.author, "hello")
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.reader
+            self.assertNotIn('data-stream-url', client.get("/").get_data(as_text=True))
+            self.assertEqual(client.get("/stream").status_code, 404)
+
+    def test_full(self):
+        live.max_streams = 0
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.reader
+            self.assertEqual(client.get("/stream").status_code, 503)
+
+
+class PostgresBrokerTestCase(TestCase):
+    def test_notify(self):
+        hub = Hub()
+        broker = PostgresBroker(hub, None, app.logger)
+        subscription = hub.subscribe({1})
+        broker.start(db.engine)
+
+        # the listener connects in the background; publish until it's there
+        for attempt in range(50):
+            with app.app_context():
+                broker.publish(1, {'id': attempt})
+                db.session.commit()
+            event = subscription.get(timeout=0.1)
+            if event is not None:
+                break
+        self.assertIsNotNone(event)
+
+        with app.app_context():
+            broker.publish(1, {'id': 'rolled back'})
+            db.session.rollback()
+        events = [subscription.get(timeout=0.2) for _ in range(3)]
+        self.assertNotIn({'id': 'rolled back'}, events)
+
+    def test_reconnect_closes_old_connection(self):
+        broker = PostgresBroker(Hub(), None, app.logger)
+        broker.retry_delay = 0.01
+        connections = []
+        connect = broker._connect
+
+        def record_connect():
+            connections.append(connect())
+            return connections[-1]
+
+        broker._connect = record_connect
+        with self.assertLogs(app.logger, "ERROR"):
+            broker.start(db.engine)
+            for _ in range(50):
+                if connections:
+                    break
+                time.sleep(0.1)
+            # a notification it can't read, on a connection that's fine
+            with app.app_context():
+                db.session.execute("SELECT pg_notify(:channel, 'not json')",
+                                   dict(channel=CHANNEL))
+                db.session.commit()
+            for _ in range(50):
+                if len(connections) > 1:
+                    break
+                time.sleep(0.1)
+
+        self.assertGreater(len(connections), 1)
+        self.assertTrue(connections[0].closed)
@@ -17,6 +17,8 @@ from models import db, User, Message, Follows, Likes
 # connected to the database
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheap password hashes keep the tests fast
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
 
 
 # Now we can import app
@@ -8,7 +8,7 @@
 import os
 from unittest import TestCase
 # from flask import session
-from models import db, connect_db, Message, User
+from models import db, connect_db, Likes, Message, User
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -16,11 +16,14 @@ from models import db, connect_db, Message, User
 # connected to the database
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheap password hashes keep the tests fast
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
 
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, user_cache
+from fragments import fragment_cache
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -41,6 +44,9 @@ class MessageViewTestCase(TestCase):
 
         db.drop_all()
         db.create_all()
+        # ids get reused from test to test, so don't reuse cached users
+        user_cache.clear()
+        fragment_cache.clear()
 
         self.client = app.test_client()
 
@@ -149,6 +155,27 @@ class MessageViewTestCase(TestCase):
             m = Message.query.get(1234)
             self.assertIsNone(m)
 
+    def test_message_delete_forgets_likers(self):
+        liker = User.signup("liker", "liker@test.com", "password", None)
+        liker.id = 76543
+        db.session.add(Message(id=1234, text="a liked message", user_id=self.testuser_id))
+        db.session.commit()
+        db.session.add(Likes(user_id=76543, message_id=1234))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 76543
+            c.get("/users/76543")
+            self.assertEqual(user_cache.get(76543)['like_count'], 1)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            c.post("/messages/1234/delete")
+
+        self.assertIsNone(user_cache.get(76543))
+        self.assertEqual(User.query.get(76543).like_count, 0)
+
 
     def test_unauthorized_message_delete(self):
 
@@ -0,0 +1,184 @@
+"""Schema migration and query plan tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_migrations.py
+
+
+import os
+from unittest import TestCase, skipUnless
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload
+
+from models import (db, User, Message, Follows, Likes, TimelineEntry,
+                    trigrams_available)
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheap password hashes keep the tests fast
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
+
+
+# Now we can import app
+
+from app import app
+import migrations
+import search
+import timeline
+
+db.create_all()
+
+
+class MigrationTestCase(TestCase):
+    """Test upgrading an old database."""
+
+    def setUp(self):
+        db.drop_all()
+        migrations.migrations_table.drop(db.engine, checkfirst=True)
+        db.create_all()
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+        db.session.rollback()
+        db.session.expunge_all()
+        migrations.migrations_table.drop(db.engine, checkfirst=True)
+        db.drop_all()
+
+    def make_old_schema(self):
+        """Roll the fresh schema back to what the baseline app created."""
+        with db.engine.begin() as conn:
+            conn.execute("DROP TABLE timeline_entries")
+            conn.execute("DROP INDEX ix_messages_user_timestamp")
+            conn.execute("DROP INDEX ix_follows_following_followed")
+            conn.execute("DROP INDEX ix_messages_text_fts")
+            conn.execute("DROP INDEX ix_users_bio_fts")
+            conn.execute("DROP INDEX IF EXISTS ix_users_username_trgm")
+            conn.execute("ALTER TABLE likes DROP CONSTRAINT uq_likes_user_message")
+            conn.execute("ALTER TABLE likes ADD CONSTRAINT likes_message_id_key "
+                         "UNIQUE (message_id)")
+            for name in ['message_count', 'follower_count',
+                         'following_count', 'like_count']:
+                conn.execute(f"ALTER TABLE users DROP COLUMN {name}")
+            conn.execute("INSERT INTO users (id, email, username, password) "
+                         "VALUES (1, 'old@test.com', 'olduser', 'x')")
+            conn.execute("INSERT INTO messages (text, timestamp, user_id) "
+                         "VALUES ('from before', now(), 1)")
+
+    def test_migrate_old_database(self):
+        self.make_old_schema()
+
+        ran = migrations.migrate(db.engine)
+        self.assertEqual(ran, [id for id, step in migrations.MIGRATIONS])
+
+        inspector = inspect(db.engine)
+        self.assertIn('timeline_entries', inspector.get_table_names())
+        self.assertIn('ix_messages_user_timestamp',
+                      {i['name'] for i in inspector.get_indexes('messages')})
+        self.assertIn('ix_follows_following_followed',
+                      {i['name'] for i in inspector.get_indexes('follows')})
+        self.assertEqual(
+            [c['column_names'] for c in inspector.get_unique_constraints('likes')],
+            [['user_id', 'message_id']])
+
+        # counters were filled in for existing users
+        self.assertEqual(User.query.get(1).message_count, 1)
+
+    def test_migrate_is_idempotent(self):
+        migrations.migrate(db.engine)
+        self.assertEqual(migrations.migrate(db.engine), [])
+
+    def test_migrate_fresh_database(self):
+        """Every step copes with a schema that already has its changes."""
+        ran = migrations.migrate(db.engine)
+        self.assertEqual(len(ran), len(migrations.MIGRATIONS))
+
+
+class QueryPlanTestCase(TestCase):
+    """Hot queries must be able to use an index rather than a full scan."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        users = [User(id=i, email=f"u{i}@test.com", username=f"u{i}", password="x")
+                 for i in range(1, 4)]
+        db.session.add_all(users)
+        db.session.commit()
+        db.session.add(Follows(user_being_followed_id=2, user_following_id=1))
+        db.session.add_all([Message(text="hi", user_id=1 + i % 3) for i in range(30)])
+        db.session.commit()
+        db.session.add(Likes(user_id=1, message_id=Message.query.first().id))
+        timeline.rebuild()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.expunge_all()
+        db.drop_all()
+
+    def explain(self, query):
+        """Plan `query` with sequential scans priced out of the running.
+
+        The tables are tiny, so the planner would happily scan them; with
+        enable_seqscan off it only picks a seq scan when no index can do.
+        """
+        statement = query.statement.compile(dialect=db.engine.dialect)
+        cursor = db.session.connection().connection.cursor()
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        cursor.execute(f"EXPLAIN {statement}", statement.params)
+        return "\n".join(row[0] for row in cursor.fetchall())
+
+    def assertIndexScan(self, plan, index_name):
+        self.assertNotIn("Seq Scan", plan)
+        self.assertIn(index_name, plan)
+
+    def test_profile_query(self):
+        query = (Message.query
+                 .filter(Message.user_id == 2)
+                 .order_by(Message.timestamp.desc(), Message.id.desc())
+                 .limit(51))
+        self.assertIndexScan(self.explain(query), "ix_messages_user_timestamp")
+
+    def test_feed_query(self):
+        followed = (db.session.query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == 1))
+        query = (Message.query
+                 .filter(Message.user_id.in_(followed) | (Message.user_id == 1))
+                 .options(joinedload(Message.user))
+                 .order_by(Message.timestamp.desc(), Message.id.desc())
+                 .limit(51))
+        plan = self.explain(query)
+        self.assertIndexScan(plan, "ix_messages_user_timestamp")
+        self.assertIn("ix_follows_following_followed", plan)
+
+    def test_timeline_query(self):
+        query = (timeline.timeline_query(1)
+                 .order_by(TimelineEntry.timestamp.desc(),
+                           TimelineEntry.message_id.desc())
+                 .limit(51))
+        plan = self.explain(query)
+        self.assertIndexScan(plan, "ix_timeline_entries_user_timestamp")
+
+    def test_likes_query(self):
+        query = (Message.query
+                 .join(Likes, Likes.message_id == Message.id)
+                 .filter(Likes.user_id == 1)
+                 .order_by(Message.timestamp.desc(), Message.id.desc())
+                 .limit(51))
+        plan = self.explain(query)
+        self.assertIndexScan(plan, "uq_likes_user_message")
+
+    def test_message_search_query(self):
+        plan = self.explain(search._postgres_messages_query("hi").limit(21))
+        self.assertIndexScan(plan, "ix_messages_text_fts")
+
+    @skipUnless(trigrams_available(db.engine), "needs the pg_trgm extension")
+    def test_user_search_query(self):
+        plan = self.explain(search._postgres_users_query("u1").limit(21))
+        self.assertIndexScan(plan, "ix_users_username_trgm")
+        self.assertIn("ix_users_bio_fts", plan)
@@ -0,0 +1,183 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+
+
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from flask import g
+from sqlalchemy import exc, select
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
+
+from app import app, CURR_USER_KEY, user_cache
+from fragments import fragment_cache
+from replicas import WROTE_AT_KEY, ReplicaRouter, replicas
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ReplicaTestCase(TestCase):
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        user_cache.clear()
+        fragment_cache.clear()
+
+        users = [User(email=f"{name}@test.com", username=name, password="HASHED_PASSWORD",
+                      bio=f"{name} on the primary")
+                 for name in ("reader", "author")]
+        db.session.add_all(users)
+        db.session.commit()
+        self.reader, self.author = [user.id for user in users]
+        db.session.add(Follows(user_being_followed_id=self.author,
+                               user_following_id=self.reader))
+        db.session.add(Message(text="hello", user_id=self.author))
+        db.session.commit()
+
+        # the replica: a SQLite copy of the data, with the bios not caught up
+        self.tmp = tempfile.TemporaryDirectory()
+        self.config = dict(app.config)
+        app.config['DATABASE_REPLICA_URLS'] = f"sqlite:///{self.tmp.name}/replica.db"
+        replicas.init_app(app)
+        self.replica = replicas.replicas[0]
+        db.metadata.create_all(self.replica.engine)
+        for table in db.metadata.sorted_tables:
+            rows = [dict(row) for row in db.session.execute(select([table]))]
+            if table.name == 'users':
+                for row in rows:
+                    row['bio'] = row['bio'].replace("primary", "replica")
+            if rows:
+                self.replica.engine.execute(table.insert(), rows)
+        db.session.remove()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader
+
+    def tearDown(self):
+        self.replica.engine.dispose()
+        app.config.update(self.config)
+        replicas.init_app(app)
+        self.tmp.cleanup()
+        db.session.rollback()
+        db.drop_all()
+
+    def profile(self):
+        resp = self.client.get(f"/users/{self.author}")
+        self.assertEqual(resp.status_code, 200)
+        return resp.get_data(as_text=True)
+
+    def test_reads_from_replica(self):
+        self.assertIn("author on the replica", self.profile())
+        for path in ("/", "/users", f"/users/{self.reader}/likes"):
+            self.assertEqual(self.client.get(path).status_code, 200)
+
+    def test_routing(self):
+        users = User.__table__
+        with app.test_request_context():
+            g.read_replica = self.replica
+            self.assertIs(db.session.get_bind(clause=select([users])), self.replica.engine)
+            self.assertIs(db.session.get_bind(clause=users.update()), db.engine)
+            # once it has written, it reads its writes
+            self.assertIs(db.session.get_bind(clause=select([users])), db.engine)
+            db.session.remove()
+
+            g.read_replica = None
+            self.assertIs(db.session.get_bind(clause=select([users])), db.engine)
+            db.session.remove()
+
+    def test_read_your_writes(self):
+        # a second behind
+        replicas.check_interval = 3600
+        self.replica.lag = 1
+        self.replica.checked_at = time.monotonic()
+
+        resp = self.client.delete(f"/api/users/{self.author}/follow")
+        self.assertEqual(resp.status_code, 200)
+        with self.client.session_transaction() as sess:
+            self.assertIn(WROTE_AT_KEY, sess)
+        self.assertIn("author on the primary", self.profile())
+
+        # once the replica has had time to catch up
+        with self.client.session_transaction() as sess:
+            sess[WROTE_AT_KEY] = time.time() - 60
+        self.assertIn("author on the replica", self.profile())
+
+    def test_lagging_replica(self):
+        replicas.check_interval = 3600
+        self.replica.lag = 60
+        self.replica.checked_at = time.monotonic()
+        self.assertIn("author on the primary", self.profile())
+
+        self.replica.lag = 0
+        self.assertIn("author on the replica", self.profile())
+
+    def test_unreachable_replica(self):
+        self.replica.engine.dispose()
+        app.config['DATABASE_REPLICA_URLS'] = "postgresql:///warbler-no-such-replica"
+        replicas.init_app(app)
+        self.replica = replicas.replicas[0]
+        self.assertIn("author on the primary", self.profile())
+
+    def test_one_lag_check_at_a_time(self):
+        self.replica.lag = 0
+        self.replica.checked_at = time.monotonic() - 60
+        measuring = threading.Event()
+        hung = threading.Event()
+
+        def measure_lag():
+            measuring.set()
+            hung.wait(5)
+            return 0.0
+
+        self.replica.measure_lag = measure_lag
+        checker = threading.Thread(target=self.replica.behind, args=(0, app.logger))
+        checker.start()
+        try:
+            measuring.wait(5)
+            # no waiting for the hung check: the last lag stands
+            started = time.monotonic()
+            self.assertIsNotNone(self.replica.behind(0, app.logger))
+            self.assertLess(time.monotonic() - started, 1)
+        finally:
+            hung.set()
+            checker.join()
+
+    def test_connect_timeout(self):
+        options = ReplicaRouter.engine_options(app.config, "postgresql:///replica")
+        self.assertEqual(options['connect_args'],
+                         {'connect_timeout': app.config['DATABASE_REPLICA_CONNECT_TIMEOUT']})
+        self.assertNotIn('connect_args', ReplicaRouter.engine_options(app.config, "sqlite://"))
+
+    def test_current_user_cached_from_primary(self):
+        self.assertIn("author on the replica", self.profile())
+        self.assertEqual(user_cache.get(self.reader)['bio'], "reader on the primary")
+
+    def test_failover_mid_request(self):
+        replicas.check_interval = 3600
+        self.replica.lag = 0
+        self.replica.checked_at = time.monotonic()
+        # the replica breaks once the request has chosen it...
+        self.replica.engine.execute("DROP TABLE messages")
+
+        def measure_lag():
+            raise exc.OperationalError("SELECT 1", {}, Exception("replica down"))
+
+        self.replica.measure_lag = measure_lag
+        with self.assertLogs(app.logger, "WARNING"):
+            page = self.profile()
+        # ...so the page comes from the primary, and the replica is left out
+        self.assertIn("author on the primary", page)
+        self.assertIsNone(self.replica.lag)
@@ -0,0 +1,172 @@
+"""Search tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_search.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheap password hashes keep the tests fast
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
+
+
+# Now we can import app
+
+from app import app, user_cache
+from fragments import fragment_cache
+import search
+
+db.create_all()
+
+
+class SearchTests:
+    """Tests run against each search backend (set BACKEND in subclasses)."""
+
+    BACKEND = None
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        search.reset()
+        user_cache.clear()
+        fragment_cache.clear()
+
+        app.config['SEARCH_BACKEND'] = self.BACKEND
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        self.client = app.test_client()
+
+        people = [
+            (1, "birdwatcher", "I love watching birds at dawn"),
+            (2, "bird", None),
+            (3, "catlady", "Cats, cats and more cats"),
+            (4, "robin_hood", "Archery enthusiast"),
+            (5, "zebra", "Birds are fine I suppose"),
+        ]
+        db.session.add_all([
+            User(id=id, username=username, bio=bio,
+                 email=f"{username}@test.com", password="x")
+            for id, username, bio in people
+        ])
+        db.session.commit()
+
+        db.session.add_all([
+            Message(id=1, text="Saw a red robin this morning", user_id=1),
+            Message(id=2, text="Robins and robins and more robins", user_id=2),
+            Message(id=3, text="My cat ignores the birds", user_id=3),
+            Message(id=4, text="Nothing to see here", user_id=4),
+        ])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.expunge_all()
+        self.ctx.pop()
+        app.config['SEARCH_BACKEND'] = 'auto'
+        search.reset()
+        db.drop_all()
+
+    def test_username_substring(self):
+        results = search.search_users("bird")
+        ids = [u.id for u in results]
+
+        # exact username first, then longer usernames containing it
+        self.assertEqual(ids[:2], [2, 1])
+        self.assertNotIn(3, ids)
+
+    def test_username_case_insensitive(self):
+        self.assertEqual([u.id for u in search.search_users("CATL")], [3])
+
+    def test_like_wildcards_are_literal(self):
+        self.assertEqual([u.id for u in search.search_users("n_h")], [4])
+        self.assertEqual([u.id for u in search.search_users("%")], [])
+
+    def test_bio_match(self):
+        ids = [u.id for u in search.search_users("birds")]
+        self.assertIn(5, ids)
+        self.assertIn(1, ids)
+
+    def test_message_match(self):
+        results = search.search_messages("robins")
+
+        # stemmed on Postgres; message 2 says it three times either way
+        self.assertEqual(results.items[0].id, 2)
+        self.assertEqual(results.items[0].user.username, "bird")
+
+    def test_message_terms_all_required(self):
+        self.assertEqual([m.id for m in search.search_messages("cat birds")], [3])
+        self.assertEqual([m.id for m in search.search_messages("cat robins")], [])
+
+    def test_pagination(self):
+        db.session.add_all([
+            User(id=100 + i, username=f"wren{i}", email=f"wren{i}@test.com",
+                 password="x")
+            for i in range(5)
+        ])
+        db.session.commit()
+
+        first = search.search_users("wren", page=1, per_page=2)
+        second = search.search_users("wren", page=2, per_page=2)
+        last = search.search_users("wren", page=3, per_page=2)
+
+        self.assertTrue(first.has_next)
+        self.assertTrue(second.has_next)
+        self.assertFalse(last.has_next)
+        seen = [u.id for page in (first, second, last) for u in page]
+        self.assertEqual(sorted(seen), [100, 101, 102, 103, 104])
+
+    def test_sees_committed_changes(self):
+        search.search_messages("anything")      # build any in-process index
+
+        msg = Message.query.get(4)
+        msg.text = "An owl!"
+        db.session.add(Message(id=5, text="Another owl", user_id=5))
+        db.session.delete(Message.query.get(3))
+        User.query.get(3).username = "tabby"
+        db.session.commit()
+
+        self.assertEqual(sorted(m.id for m in search.search_messages("owl")), [4, 5])
+        self.assertEqual([m.id for m in search.search_messages("ignores")], [])
+        self.assertEqual([u.id for u in search.search_users("catlady")], [])
+        self.assertEqual([u.id for u in search.search_users("tabby")], [3])
+
+    def test_ignores_rolled_back_changes(self):
+        search.search_messages("anything")
+
+        db.session.add(Message(id=5, text="A ghostly owl", user_id=5))
+        db.session.flush()
+        db.session.rollback()
+
+        self.assertEqual([m.id for m in search.search_messages("ghostly")], [])
+
+    def test_search_page(self):
+        resp = self.client.get("/users?q=robin")
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("@robin_hood", html)
+        self.assertIn("Saw a red robin", html)
+        self.assertNotIn("@catlady", html)
+
+    def test_search_page_bad_page(self):
+        resp = self.client.get("/users?q=robin&page=0")
+        self.assertEqual(resp.status_code, 400)
+
+
+class PostgresSearchTestCase(SearchTests, TestCase):
+    BACKEND = 'postgres'
+
+
+class PythonSearchTestCase(SearchTests, TestCase):
+    BACKEND = 'python'
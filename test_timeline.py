@@ -0,0 +1,218 @@
+"""Materialized timeline tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_timeline.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, Message, User, Follows, Job, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheap password hashes keep the tests fast
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY, user_cache
+from fragments import fragment_cache
+from jobs import Worker
+from pagination import encode_cursor
+import timeline
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TimelineTestCase(TestCase):
+    """Test fan-out-on-write timelines."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.drop_all()
+        db.create_all()
+        # ids get reused from test to test, so don't reuse cached users
+        user_cache.clear()
+        fragment_cache.clear()
+        app.config['TIMELINE_FANOUT'] = True
+        # deliver as the message is posted
+        self.eager = app.config['JOBS_EAGER']
+        app.config['JOBS_EAGER'] = True
+
+        self.client = app.test_client()
+
+        self.author = User.signup("author", "author@test.com", "password", None)
+        self.author.id = 111
+        self.reader = User.signup("reader", "reader@test.com", "password", None)
+        self.reader.id = 222
+        self.stranger = User.signup("stranger", "stranger@test.com", "password", None)
+        self.stranger.id = 333
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=111, user_following_id=222))
+        db.session.commit()
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+        app.config['TIMELINE_FANOUT'] = False
+        app.config['JOBS_EAGER'] = self.eager
+        db.session.rollback()
+        db.drop_all()
+
+    def timeline_message_ids(self, user_id):
+        return {e.message_id for e in TimelineEntry.query.filter_by(user_id=user_id)}
+
+    def test_post_fans_out_to_followers(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 111
+
+            resp = c.post("/messages/new", data={"text": "fan me out"})
+            self.assertEqual(resp.status_code, 302)
+
+        msg = Message.query.one()
+        self.assertEqual(self.timeline_message_ids(111), {msg.id})
+        self.assertEqual(self.timeline_message_ids(222), {msg.id})
+        self.assertEqual(self.timeline_message_ids(333), set())
+
+    def test_fan_out_in_the_background(self):
+        in_process = app.config['JOBS_IN_PROCESS']
+        app.config['JOBS_EAGER'] = False
+        app.config['JOBS_IN_PROCESS'] = False
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 111
+                c.post("/messages/new", data={"text": "later"})
+
+            msg_id = Message.query.one().id
+            self.assertEqual(self.timeline_message_ids(111), {msg_id})
+            self.assertEqual(self.timeline_message_ids(222), set())
+
+            # following before the job runs backfills the message already
+            with app.app_context():
+                timeline.add_follow(333, 111)
+            db.session.add(Follows(user_being_followed_id=111, user_following_id=333))
+            db.session.commit()
+
+            Worker(app).run(burst=True)
+        finally:
+            app.config['JOBS_IN_PROCESS'] = in_process
+
+        self.assertEqual(self.timeline_message_ids(222), {msg_id})
+        self.assertEqual(self.timeline_message_ids(333), {msg_id})
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_homepage_reads_timeline(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 111
+            c.post("/messages/new", data={"text": "hello followers"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 222
+            resp = c.get("/")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("hello followers", str(resp.data))
+
+    def test_homepage_paginates(self):
+        app.config['MESSAGES_PER_PAGE'] = 1
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 111
+                c.post("/messages/new", data={"text": "first post"})
+                c.post("/messages/new", data={"text": "second post"})
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 222
+                resp = c.get("/")
+                self.assertIn("second post", str(resp.data))
+                self.assertNotIn("first post", str(resp.data))
+
+                newest = Message.query.filter_by(text="second post").one()
+                resp = c.get(f"/?before={encode_cursor(newest.timestamp, newest.id)}")
+                self.assertIn("first post", str(resp.data))
+                self.assertNotIn("second post", str(resp.data))
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 50
+
+    def test_follow_backfills_and_unfollow_prunes(self):
+        m = Message(id=5, text="old news", user_id=333)
+        db.session.add(m)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 222
+
+            c.post("/users/follow/333")
+            self.assertEqual(self.timeline_message_ids(222), {5})
+
+            c.post("/users/stop-following/333")
+            self.assertEqual(self.timeline_message_ids(222), set())
+
+    def test_api_follow_backfills_and_unfollow_prunes(self):
+        db.session.add(Message(id=5, text="old news", user_id=333))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 222
+
+            c.post("/api/users/333/follow")
+            self.assertEqual(self.timeline_message_ids(222), {5})
+
+            c.delete("/api/users/333/follow")
+            self.assertEqual(self.timeline_message_ids(222), set())
+
+    def test_follow_backfills_latest_messages(self):
+        db.session.add_all([Message(id=id, text=f"message {id}", user_id=333)
+                            for id in range(1, 6)])
+        db.session.commit()
+
+        backfill = app.config['TIMELINE_BACKFILL']
+        app.config['TIMELINE_BACKFILL'] = 2
+        try:
+            with app.app_context():
+                timeline.add_follow(222, 333)
+                db.session.commit()
+        finally:
+            app.config['TIMELINE_BACKFILL'] = backfill
+        self.assertEqual(self.timeline_message_ids(222), {4, 5})
+
+    def test_delete_message_removes_entries(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 111
+            c.post("/messages/new", data={"text": "short lived"})
+            msg = Message.query.one()
+
+            c.post(f"/messages/{msg.id}/delete")
+
+        self.assertEqual(TimelineEntry.query.count(), 0)
+
+    def test_rebuild(self):
+        db.session.add_all([
+            Message(id=1, text="by author", user_id=111),
+            Message(id=2, text="by reader", user_id=222),
+        ])
+        db.session.commit()
+
+        timeline.rebuild()
+        db.session.commit()
+
+        self.assertEqual(self.timeline_message_ids(111), {1})
+        self.assertEqual(self.timeline_message_ids(222), {1, 2})
+        self.assertEqual(self.timeline_message_ids(333), set())
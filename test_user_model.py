@@ -9,8 +9,8 @@
 import os
 # from flask_bcrypt import Bcrypt
 from unittest import TestCase
-from sqlalchemy import exc
-from models import db, User, Message, Follows
+from sqlalchemy import exc, inspect
+from models import db, User, Message, Follows, Likes
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -18,10 +18,13 @@ from models import db, User, Message, Follows
 # connected to the database
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheap password hashes keep the tests fast
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
 
 # Now we can import app
 
 from app import app
+from passwords import hasher, PasswordHasher, PasswordHasherBusy
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -54,6 +57,9 @@ class UserModelTestCase(TestCase):
     def tearDown(self):
         """Clean up any fouled transaction."""
         db.session.rollback()
+        # ids restart after drop_all, so don't let the next test's users
+        # collide with this test's objects in the identity map
+        db.session.expunge_all()
         db.drop_all()
 
     def test_user_model(self):
@@ -116,6 +122,39 @@ class UserModelTestCase(TestCase):
 
         self.assertTrue(self.user2.is_followed_by(self.user1))
         self.assertFalse(self.user1.is_followed_by(self.user2))
+
+    def test_is_following_does_not_load_list(self):
+        """Membership checks ask about one pair instead of loading the list"""
+        self.user1.following.append(self.user2)
+        db.session.commit()
+        db.session.expire_all()
+
+        self.assertTrue(self.user1.is_following(self.user2))
+        self.assertFalse(self.user1.is_following(self.user3))
+        self.assertTrue(self.user2.is_followed_by(self.user1))
+        self.assertIn('following', inspect(self.user1).unloaded)
+        self.assertIn('followers', inspect(self.user2).unloaded)
+
+    def test_is_following_sees_pending_follow(self):
+        self.user1.following.append(self.user3)
+
+        self.assertTrue(self.user1.is_following(self.user3))
+        self.assertTrue(self.user3.is_followed_by(self.user1))
+
+    def test_following_ids_among(self):
+        self.user1.following.extend([self.user2, self.user3])
+        db.session.commit()
+        db.session.expire_all()
+
+        ids = [self.user1.id, self.user2.id, self.user3.id, 9999]
+        self.assertEqual(self.user1.following_ids_among(ids),
+                         {self.user2.id, self.user3.id})
+        self.assertEqual(self.user2.following_ids_among(ids), set())
+        self.assertEqual(self.user1.following_ids_among([]), set())
+
+        # same answer from an already-loaded list
+        self.assertEqual(len(self.user1.following), 2)
+        self.assertEqual(self.user1.following_ids_among(ids[:2]), {self.user2.id})
     
 
     # # # # # # # # # # # # # # # # # # 
@@ -137,6 +176,71 @@ class UserModelTestCase(TestCase):
         self.assertEqual(self.user1.likes[0].text, "Test message")
 
 
+    # # # # # # # # # # # # # # # # # # # #
+    # Test denormalized counters on User  #
+    # # # # # # # # # # # # # # # # # # # #
+
+    def assertCounts(self, user, messages, following, followers, likes):
+        db.session.refresh(user)
+        self.assertEqual((user.message_count, user.following_count,
+                          user.follower_count, user.like_count),
+                         (messages, following, followers, likes))
+
+    def test_counters_follow_unfollow(self):
+        self.user1.following.append(self.user2)
+        db.session.commit()
+        self.assertCounts(self.user1, 0, 1, 0, 0)
+        self.assertCounts(self.user2, 0, 0, 1, 0)
+
+        self.user1.following.remove(self.user2)
+        db.session.commit()
+        self.assertCounts(self.user1, 0, 0, 0, 0)
+        self.assertCounts(self.user2, 0, 0, 0, 0)
+
+    def test_counters_messages_and_likes(self):
+        message = Message(text="count me", user_id=self.user1.id)
+        self.user2.messages.append(Message(text="me too"))
+        db.session.add(message)
+        db.session.commit()
+        self.assertCounts(self.user1, 1, 0, 0, 0)
+        self.assertCounts(self.user2, 1, 0, 0, 0)
+
+        db.session.add(Likes(user_id=self.user2.id, message_id=message.id))
+        db.session.commit()
+        self.assertCounts(self.user2, 1, 0, 0, 1)
+
+        # deleting a message takes its likes with it
+        db.session.delete(message)
+        db.session.commit()
+        self.assertCounts(self.user1, 0, 0, 0, 0)
+        self.assertCounts(self.user2, 1, 0, 0, 0)
+
+    def test_counters_delete_user(self):
+        db.session.add_all([
+            Follows(user_being_followed_id=self.user1.id, user_following_id=self.user2.id),
+            Follows(user_being_followed_id=self.user3.id, user_following_id=self.user1.id),
+        ])
+        db.session.commit()
+        self.assertCounts(self.user2, 0, 1, 0, 0)
+        self.assertCounts(self.user3, 0, 0, 1, 0)
+
+        db.session.delete(self.user1)
+        db.session.commit()
+        self.assertCounts(self.user2, 0, 0, 0, 0)
+        self.assertCounts(self.user3, 0, 0, 0, 0)
+
+    def test_recount(self):
+        db.session.add(Message(text="a warble", user_id=self.user1.id))
+        db.session.commit()
+        # knock the counter out of sync behind the hooks' back
+        db.session.execute(User.__table__.update().values(message_count=42))
+        db.session.commit()
+
+        User.recount()
+        db.session.commit()
+        self.assertCounts(self.user1, 1, 0, 0, 0)
+        self.assertCounts(self.user2, 0, 0, 0, 0)
+
     # # # # # # # # # # # # # # # # # # #
     # Test if user sign up functionality #
     # # # # # # # # # # # # # # # # # # #
@@ -188,6 +292,34 @@ class UserModelTestCase(TestCase):
     def test_wrong_password(self):
         self.assertFalse(User.authenticate(self.user1.username, "badpassword"))
 
+    def test_rehash_on_login(self):
+        """Logging in upgrades a hash made at an old bcrypt cost"""
+        self.assertTrue(self.user1.password.startswith("$2b$04$"))
+
+        hasher.log_rounds = 5
+        try:
+            u = User.authenticate(self.user1.username, "password")
+            db.session.commit()
+        finally:
+            hasher.log_rounds = 4
+
+        self.assertTrue(u.password.startswith("$2b$05$"))
+        self.assertTrue(u.check_password("password"))
+
+    def test_hasher_back_pressure(self):
+        """Hashing gives up rather than queueing forever when the pool is full"""
+        busy_hasher = PasswordHasher()
+        busy_hasher.configure({"BCRYPT_LOG_ROUNDS": 4,
+                               "PASSWORD_HASH_WORKERS": 1,
+                               "PASSWORD_HASH_MAX_PENDING": 1,
+                               "PASSWORD_HASH_WAIT": 0})
+        self.assertTrue(busy_hasher.check(busy_hasher.hash("secret"), "secret"))
+
+        # take the only slot, as a long-running hash would
+        busy_hasher._slots.acquire()
+        with self.assertRaises(PasswordHasherBusy):
+            busy_hasher.hash("secret")
+
     def test_password_hashing(self):
         """Test that a plaintext password is hashed"""
         u = User.signup("testuser", "test@test.com", "password123", "/static/images/default-pic.png")
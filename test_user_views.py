@@ -6,22 +6,28 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
 
 from models import db, connect_db, Message, User, Likes, Follows
 from bs4 import BeautifulSoup
 
+import instrumentation
+
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
 # before we import our app, since that will have already
 # connected to the database
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# cheap password hashes keep the tests fast
+os.environ['BCRYPT_LOG_ROUNDS'] = "4"
 
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, user_cache
+from fragments import fragment_cache
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -34,6 +40,12 @@ db.create_all()
 app.config['WTF_CSRF_ENABLED'] = False
 
 
+def count_queries():
+    """Collect every SQL statement run inside the block."""
+
+    return instrumentation.count_queries(db.engine)
+
+
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
 
@@ -42,6 +54,9 @@ class MessageViewTestCase(TestCase):
 
         db.drop_all()
         db.create_all()
+        # ids get reused from test to test, so don't reuse cached users
+        user_cache.clear()
+        fragment_cache.clear()
 
         self.client = app.test_client()
 
@@ -88,6 +103,55 @@ class MessageViewTestCase(TestCase):
             self.assertNotIn("@hij", str(resp.data))
             self.assertIn("@testing", str(resp.data))   
 
+    def test_users_index_paginates(self):
+        app.config['USERS_PER_PAGE'] = 2
+
+        try:
+            with self.client as c:
+                pages = []
+                url = "/users"
+                while url:
+                    resp = c.get(url)
+                    self.assertEqual(resp.status_code, 200)
+                    soup = BeautifulSoup(resp.data, 'html.parser')
+                    pages.append([p.text for p in soup.select(".card-link p")])
+                    more = soup.find("a", {"class": "more-results"})
+                    url = more["href"] if more else None
+        finally:
+            app.config['USERS_PER_PAGE'] = 60
+
+        self.assertEqual(pages, [
+            ["@abc", "@efg"],
+            ["@hij", "@testing"],
+            ["@testuser"],
+        ])
+
+    def test_users_index_follow_buttons(self):
+        self.setup_followers()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            with count_queries() as statements:
+                resp = c.get("/users")
+
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            unfollow = {form["action"] for form in soup.select(".card form")
+                        if "stop-following" in form["action"]}
+            self.assertEqual(unfollow, {f"/users/stop-following/{self.u1_id}",
+                                        f"/users/stop-following/{self.u2_id}"})
+            self.assertEqual(len(soup.select(".card form")), 4)
+
+            # no password hashes pulled in for the cards
+            listing = [s for s in statements if "FROM users" in s
+                       and "LIMIT" in s]
+            self.assertEqual(len(listing), 1)
+            self.assertNotIn("password", listing[0])
+
+            # current user, the page of users, and follow state for the page
+            self.assertLessEqual(len(statements), 3)
+
     def test_user_show(self):
         with self.client as c:
             resp = c.get(f"/users/{self.testuser_id}")
@@ -178,6 +242,76 @@ class MessageViewTestCase(TestCase):
             # check if the like has been deleted
             self.assertEqual(len(likes), 0)
 
+    def test_api_like_and_unlike(self):
+        self.setup_likes()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            with count_queries() as statements:
+                resp = c.post("/api/messages/9876/like")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json["liked"], True)
+            self.assertEqual(resp.json["counts"][str(self.u1_id)]["like_count"], 1)
+            self.assertEqual(Likes.query.filter_by(user_id=self.u1_id).count(), 1)
+
+            # one row written (the counter hooks add the user's count update)
+            writes = [s for s in statements if s.startswith("INSERT")]
+            self.assertEqual(len(writes), 1)
+
+            # liking again changes nothing
+            resp = c.post("/api/messages/9876/like")
+            self.assertEqual(resp.json["counts"][str(self.u1_id)]["like_count"], 1)
+
+            resp = c.delete("/api/messages/9876/like")
+            self.assertEqual(resp.json["liked"], False)
+            self.assertEqual(resp.json["counts"][str(self.u1_id)]["like_count"], 0)
+            self.assertEqual(Likes.query.filter_by(user_id=self.u1_id).count(), 0)
+
+    def test_api_follow_and_unfollow(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.post(f"/api/users/{self.u1_id}/follow")
+            self.assertEqual(resp.json["following"], True)
+            counts = resp.json["counts"]
+            self.assertEqual(counts[str(self.testuser_id)]["following_count"], 1)
+            self.assertEqual(counts[str(self.u1_id)]["follower_count"], 1)
+
+            resp = c.post(f"/api/users/{self.u1_id}/follow")
+            self.assertEqual(Follows.query.count(), 1)
+
+            resp = c.delete(f"/api/users/{self.u1_id}/follow")
+            self.assertEqual(resp.json["following"], False)
+            self.assertEqual(resp.json["counts"][str(self.u1_id)]["follower_count"], 0)
+            self.assertEqual(Follows.query.count(), 0)
+
+            # the logged-in user's cached counters were refreshed
+            resp = c.get("/")
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            stat = soup.find(attrs={"data-user-stat": f"{self.testuser_id}:following_count"})
+            self.assertEqual(stat.text, "0")
+
+    def test_api_errors(self):
+        with self.client as c:
+            resp = c.post(f"/api/users/{self.u1_id}/follow")
+            self.assertEqual(resp.status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.post(f"/api/users/{self.testuser_id}/follow")
+            self.assertEqual(resp.status_code, 400)
+            resp = c.post("/api/users/12345/follow")
+            self.assertEqual(resp.status_code, 404)
+            self.assertEqual(resp.json, {'error': "No such user."})
+            resp = c.post("/api/messages/12345/like")
+            self.assertEqual(resp.status_code, 404)
+            self.assertEqual(resp.json, {'error': "No such message."})
+
     def test_unauthenticated_like(self):
         self.setup_likes()
 
@@ -197,6 +331,193 @@ class MessageViewTestCase(TestCase):
             # The number of likes has not changed since making the request
             self.assertEqual(like_count, Likes.query.count())
 
+    def setup_many_messages(self):
+        """Five messages by testuser, two of them sharing a timestamp."""
+        stamps = [datetime(2020, 1, d) for d in (1, 2, 3, 3, 4)]
+        msgs = [Message(id=100 + i, text=f"warble number {i}", timestamp=ts,
+                        user_id=self.testuser_id)
+                for i, ts in enumerate(stamps)]
+        db.session.add_all(msgs)
+        db.session.commit()
+
+    def collect_pages(self, c, url):
+        """Follow 'Older warbles' links, returning the text of each page."""
+        pages = []
+        while url:
+            resp = c.get(url)
+            self.assertEqual(resp.status_code, 200)
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            pages.append([p.text for p in soup.select("#messages p")
+                          if p.text.startswith("warble number")])
+            older = soup.find("a", {"class": "older-messages"})
+            url = older["href"] if older else None
+        return pages
+
+    def test_user_show_paginates(self):
+        self.setup_many_messages()
+        app.config['MESSAGES_PER_PAGE'] = 2
+
+        try:
+            with self.client as c:
+                pages = self.collect_pages(c, f"/users/{self.testuser_id}")
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 50
+
+        self.assertEqual(pages, [
+            ["warble number 4", "warble number 3"],
+            ["warble number 2", "warble number 1"],
+            ["warble number 0"],
+        ])
+
+    def test_show_likes_paginates(self):
+        self.setup_many_messages()
+        db.session.add_all([Likes(user_id=self.u1_id, message_id=100 + i)
+                            for i in range(5)])
+        db.session.commit()
+        app.config['MESSAGES_PER_PAGE'] = 3
+
+        try:
+            with self.client as c:
+                pages = self.collect_pages(c, f"/users/{self.u1_id}/likes")
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 50
+
+        self.assertEqual(pages, [
+            ["warble number 4", "warble number 3", "warble number 2"],
+            ["warble number 1", "warble number 0"],
+        ])
+
+    def test_bad_cursor(self):
+        with self.client as c:
+            resp = c.get(f"/users/{self.testuser_id}?before=not-a-cursor")
+            self.assertEqual(resp.status_code, 400)
+
+    def setup_busy_timeline(self):
+        """testuser follows four users who have each posted five messages."""
+        others = [self.u1_id, self.u2_id, self.u3.id, self.u4.id]
+        db.session.add_all([Follows(user_being_followed_id=uid,
+                                    user_following_id=self.testuser_id)
+                            for uid in others])
+        db.session.add_all([Message(text=f"busy warble {i}", user_id=uid)
+                            for uid in others for i in range(5)])
+        db.session.commit()
+
+    def test_homepage_query_count(self):
+        self.setup_busy_timeline()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            with count_queries() as statements:
+                resp = c.get("/")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(str(resp.data).count("busy warble"), 20)
+            # current user, the timeline page with its authors, and which
+            # of the page's messages the user has liked
+            self.assertLessEqual(len(statements), 3)
+
+    def test_homepage_like_buttons(self):
+        self.setup_busy_timeline()
+        liked = [m.id for m in Message.query.filter_by(text="busy warble 3")]
+        db.session.add_all([Likes(user_id=self.testuser_id, message_id=id)
+                            for id in liked])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get("/")
+
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            pressed = {form["action"] for form in soup.select(".messages-form")
+                       if "btn-primary" in form.button["class"]}
+            self.assertEqual(pressed, {f"/users/add_like/{id}" for id in liked})
+            self.assertEqual(len(soup.select(".messages-form")), 20)
+
+    def test_message_show_like_button(self):
+        self.setup_likes()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get("/messages/9876")
+
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            self.assertIn("btn-primary", soup.select_one(".messages-form button")["class"])
+
+    def test_user_show_query_count(self):
+        self.setup_busy_timeline()
+
+        with self.client as c:
+            with count_queries() as statements:
+                resp = c.get(f"/users/{self.u1_id}")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(str(resp.data).count("busy warble"), 5)
+            # profile user (stats included), then the message page
+            self.assertLessEqual(len(statements), 2)
+
+    def test_current_user_is_cached(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            with count_queries() as first:
+                c.get(f"/users/{self.u1_id}")
+            with count_queries() as second:
+                resp = c.get(f"/users/{self.u1_id}")
+
+            self.assertIn('alt="testuser"', str(resp.data))
+            self.assertEqual(len(second), len(first) - 1)
+
+    def test_cached_user_has_no_secrets(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            c.get("/")
+
+            record = user_cache.get(self.testuser_id)
+            self.assertEqual(set(record), set(User.CACHE_COLUMNS))
+            self.assertNotIn('password', record)
+
+            # anything that needs the hash loads it from the database
+            user = User.from_cache_record(record)
+            self.assertTrue(user.password.startswith("$2b$"))
+            db.session.remove()
+
+    def test_current_user_loaded_lazily(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            with count_queries() as statements:
+                resp = c.get("/logout")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(statements, [])
+
+    def test_profile_edit_refreshes_cached_user(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            self.assertIn("@testuser", str(c.get("/").data))
+
+            resp = c.post("/users/profile", data={
+                "username": "renamed",
+                "email": "test@test.com",
+                "password": "testuser",
+            })
+            self.assertEqual(resp.status_code, 302)
+
+            home = str(c.get("/").data)
+            self.assertIn("@renamed", home)
+            self.assertNotIn("@testuser", home)
+
     def setup_followers(self):
         f1 = Follows(user_being_followed_id=self.u1_id, user_following_id=self.testuser_id)
         f2 = Follows(user_being_followed_id=self.u2_id, user_following_id=self.testuser_id)
@@ -278,6 +599,80 @@ class MessageViewTestCase(TestCase):
             self.assertNotIn("@abc", str(resp.data))
             self.assertIn("Access unauthorized", str(resp.data))
 
+    def test_homepage_etag(self):
+        self.setup_busy_timeline()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            first = c.get("/")
+            etag = first.headers["ETag"]
+            self.assertEqual(first.headers["Cache-Control"], "private, no-cache")
+
+            # nothing changed: 304, without rendering the page
+            again = c.get("/", headers={"If-None-Match": etag})
+            self.assertEqual(again.status_code, 304)
+            self.assertEqual(again.data, b"")
+            self.assertEqual(again.headers["ETag"], etag)
+
+            # a followed user posts
+            db.session.add(Message(text="brand new", user_id=self.u1_id))
+            db.session.commit()
+            resp = c.get("/", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("brand new", str(resp.data))
+            self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_user_show_etag_follows_viewer_state(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            etag = c.get(f"/users/{self.u1_id}").headers["ETag"]
+            self.assertEqual(c.get(f"/users/{self.u1_id}",
+                                   headers={"If-None-Match": etag}).status_code, 304)
+
+            c.post(f"/api/users/{self.u1_id}/follow")
+            resp = c.get(f"/users/{self.u1_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Unfollow", str(resp.data))
+
+    def test_no_etag_with_pending_flash(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            etag = c.get(f"/users/{self.u1_id}").headers["ETag"]
+            with c.session_transaction() as sess:
+                sess["_flashes"] = [("success", "Hello there")]
+
+            resp = c.get(f"/users/{self.u1_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Hello there", str(resp.data))
+            self.assertNotIn("ETag", resp.headers)
+
+    def test_cache_policy(self):
+        with self.client as c:
+            resp = c.get("/login")
+            self.assertEqual(resp.headers["Cache-Control"], "no-store")
+
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            css = soup.select_one('link[rel="stylesheet"][href^="/static/"]')["href"]
+            self.assertRegex(css, r"^/static/stylesheets/style\.css\?v=\w+$")
+
+            resp = c.get(css)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("immutable", resp.headers["Cache-Control"])
+            self.assertIn("max-age=31536000", resp.headers["Cache-Control"])
+            resp.close()
+
+            for url in ("/static/stylesheets/style.css",
+                        "/static/stylesheets/style.css?v=stale"):
+                resp = c.get(url)
+                self.assertEqual(resp.headers["Cache-Control"], "public, no-cache")
+                resp.close()
+
 
 # to do:
 # replace 'testuser' and 'user' names to be more coherent such as testuser1 testuser2 testuser3 etc
\ No newline at end of file
@@ -0,0 +1,140 @@
+"""Materialized home timelines (fan-out on write).
+
+When TIMELINE_FANOUT is enabled, every posted message is pushed into the
+`timeline_entries` inbox of its author and each of the author's followers.
+Reading the homepage is then a range scan over one user's inbox, so it costs
+O(page size) no matter how many accounts that user follows.
+
+All writes here are set-based (INSERT ... SELECT / DELETE ... WHERE) and
+only add statements to the current session; the caller commits. Delivering
+to followers is a job (see jobs.py), so a user with many followers doesn't
+keep their request waiting. Following someone backfills only their latest
+TIMELINE_BACKFILL messages, so it costs the same however much they've
+posted; older ones are in their profile.
+"""
+
+from flask import current_app
+from sqlalchemy import exists, literal, select
+
+from jobs import enqueue, job
+from models import db, Follows, Message, TimelineEntry
+
+timeline_table = TimelineEntry.__table__
+TIMELINE_COLUMNS = ['user_id', 'message_id', 'timestamp']
+
+
+def is_enabled():
+    """Is the materialized timeline turned on for this app?"""
+
+    return current_app.config.get('TIMELINE_FANOUT', False)
+
+
+def fan_out(message):
+    """Deliver a newly posted `message` to its author, and queue delivering
+    it to their followers."""
+
+    # we need the id and timestamp, which are only set once the row is flushed
+    db.session.flush()
+
+    db.session.add(TimelineEntry(user_id=message.user_id,
+                                 message_id=message.id,
+                                 timestamp=message.timestamp))
+    enqueue('deliver_to_followers', message_id=message.id)
+
+
+@job('deliver_to_followers')
+def deliver_to_followers(message_id):
+    """Put message `message_id` in the timelines of its author's followers."""
+
+    message = (db.session.query(Message.user_id, Message.timestamp)
+               .filter(Message.id == message_id).first())
+    if message is None:
+        # deleted before we got to it
+        return
+
+    # someone who followed the author since it was posted already has it
+    # (see add_follow), as does everyone if this is a retry
+    delivered = (exists()
+                 .where(timeline_table.c.message_id == message_id)
+                 .where(timeline_table.c.user_id == Follows.user_following_id))
+    followers = (select([Follows.user_following_id,
+                         literal(message_id),
+                         literal(message.timestamp)])
+                 .where(Follows.user_being_followed_id == message.user_id)
+                 .where(Follows.user_following_id != message.user_id)
+                 .where(~delivered))
+    db.session.execute(
+        timeline_table.insert().from_select(TIMELINE_COLUMNS, followers))
+
+
+def remove_message(message_id):
+    """Remove a deleted message from every timeline it was delivered to."""
+
+    db.session.execute(
+        timeline_table.delete()
+        .where(timeline_table.c.message_id == message_id))
+
+
+def add_follow(follower_id, followed_id):
+    """Backfill `follower_id`'s timeline with the latest messages from
+    `followed_id`."""
+
+    if follower_id == followed_id:
+        # a user's own messages are already in their timeline
+        return
+
+    backfill = (select([literal(follower_id), Message.id, Message.timestamp])
+                .where(Message.user_id == followed_id)
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .limit(current_app.config.get('TIMELINE_BACKFILL', 100)))
+    db.session.execute(
+        timeline_table.insert().from_select(TIMELINE_COLUMNS, backfill))
+
+
+def remove_follow(follower_id, followed_id):
+    """Drop `followed_id`'s messages from `follower_id`'s timeline."""
+
+    if follower_id == followed_id:
+        return
+
+    followed_messages = select([Message.id]).where(Message.user_id == followed_id)
+    db.session.execute(
+        timeline_table.delete()
+        .where(timeline_table.c.user_id == follower_id)
+        .where(timeline_table.c.message_id.in_(followed_messages)))
+
+
+def timeline_query(user_id):
+    """Query for the messages in a user's timeline.
+
+    Paginate it on (TimelineEntry.timestamp, TimelineEntry.message_id) so the
+    ordering is served by the timeline index.
+    """
+
+    return (Message
+            .query
+            .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+            .filter(TimelineEntry.user_id == user_id))
+
+
+def rebuild():
+    """Recompute every timeline from the messages and follows tables.
+
+    Used to turn fan-out on for an existing database, and after bulk loads.
+    """
+
+    db.session.execute(timeline_table.delete())
+
+    own_messages = select([Message.user_id, Message.id, Message.timestamp])
+    db.session.execute(
+        timeline_table.insert().from_select(TIMELINE_COLUMNS, own_messages))
+
+    followed_messages = (select([Follows.user_following_id,
+                                 Message.id,
+                                 Message.timestamp])
+                         .select_from(Message.__table__.join(
+                             Follows.__table__,
+                             Follows.user_being_followed_id == Message.user_id))
+                         .where(Follows.user_following_id != Message.user_id))
+    db.session.execute(
+        timeline_table.insert().from_select(TIMELINE_COLUMNS, followed_messages))